@@ -1,7 +1,6 @@
 # api/admin_api.py
 from flask import Blueprint, request, jsonify
 from functools import wraps
-import sqlite3
 from pathlib import Path
 import shutil
 import json
@@ -9,28 +8,15 @@ import os
 import time
 
 
-# ml helper for embeddings (must exist in ml/)
-from ml.embeddings import compute_folder_embedding
+# in-memory gallery used by /api/recognize
+# (other workers pick changes up from the gallery_changes feed)
+from services.embedding_service import gallery
+from services.attendance_service import forget_attendance
 
-
-
-# ✅ ADD THIS HELPER FUNCTION (top of file or utils)🔑 
-# Rule on Windows
-# Never delete a folder immediately after file I/O + ML inference
-
-# ✔ Best fix: retry deletion safely
-# Replace your Step 7 with this robust deletion helper.
-
-def safe_rmtree(path, retries=5, delay=0.5):
-    import time, shutil
-    for i in range(retries):
-        try:
-            if path.exists():
-                shutil.rmtree(path)
-            return True
-        except Exception:
-            time.sleep(delay)
-    return False
+# approvals run as background jobs (services/jobs.py)
+from services.job_queue import enqueue, find_active, get_job, list_jobs
+from services.model_version import active_model, version_counts
+from ml.embeddings import MODELS_DIR
 
 
 admin_bp = Blueprint("admin_bp", __name__)
@@ -47,43 +33,11 @@ def admin_required(view):
         return view(*args, **kwargs)
     return wrapped
 
-# DB path relative to project root (avoid circular imports)
+# project root (dataset folders live under storage/)
 BASE_DIR = Path(__file__).resolve().parents[1]
-DB_PATH = BASE_DIR / "database" / "attendance.db"
-
-print("USING DATABASE:", DB_PATH)
-print("ABSOLUTE PATH:", os.path.abspath(DB_PATH))
-
-
 
-# def db_conn_local():
-#     conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
-#     conn.row_factory = sqlite3.Row
-#     return conn
-
-
-# ------------------------------------
-# Enable WAL mode (MOST IMPORTANT)
-# ✅ WAL = Write-Ahead Logging
-# ✅ Allows reads while writing
-# WAL = Write-Ahead Logging
-
-# Without WAL:
-# SQLite locks the entire database during a write ❌
-
-# With WAL:
-# One writer + many readers can work together,
-# Reads do NOT block writes, Writes do NOT block reads
-# ------------------------------------------
-def db_conn_local():
-    conn = sqlite3.connect(str(DB_PATH), timeout=30, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-
-    # 🔥 IMPORTANT
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
-
-    return conn
+# DB connections are shared and pooled (WAL, PRAGMAs applied once): database/db.py
+from database.db import db_conn
 
 # -------------------------
 # Pending list
@@ -91,7 +45,7 @@ def db_conn_local():
 @admin_bp.route("/pending", methods=["GET"])
 @admin_required
 def list_pending():
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
     cur.execute("SELECT id, name, temp_folder, requested_at FROM pending_enrollments ORDER BY requested_at DESC")
     rows = [dict(r) for r in cur.fetchall()]
@@ -104,7 +58,7 @@ def list_pending():
 @admin_bp.route("/users", methods=["GET"])
 @admin_required
 def list_users():
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
 
     cur.execute(" SELECT id, name, folder, created_at, admin_note FROM users ORDER BY id DESC")
@@ -115,151 +69,122 @@ def list_users():
 
 
 # -------------------------
-# Approve pending (immediate)
+# Approve pending (background job)
 # -------------------------
 @admin_bp.route("/approve", methods=["POST"])
 @admin_required
 def approve_pending():
-    import time
-    from datetime import datetime
-
     data = request.get_json() or {}
     pid = data.get("pending_id")
     if pid is None:
         return jsonify({"error": "pending_id required"}), 400
+    try:
+        pid = int(pid)
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid pending_id"}), 400
 
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
-
-    cur.execute(
-        "SELECT id, name, temp_folder FROM pending_enrollments WHERE id=?",
-        (pid,)
-    )
+    cur.execute("SELECT id FROM pending_enrollments WHERE id=?", (pid,))
     row = cur.fetchone()
+    conn.close()
     if not row:
-        conn.close()
         return jsonify({"error": "pending not found"}), 404
 
-    name = row["name"]
-    temp_folder = Path(row["temp_folder"])
+    # double clicks reuse the job already in flight
+    job = find_active("approve", "pending_id", pid)
+    job_id = job["id"] if job else enqueue("approve", {"pending_id": pid})
 
-    if not temp_folder.exists():
-        cur.execute("DELETE FROM pending_enrollments WHERE id=?", (pid,))
-        conn.commit()
-        conn.close()
-        return jsonify({"error": "pending folder missing"}), 500
-
-    # ------------------------------------------------
-    # 1️⃣ Prepare dataset folder
-    # ------------------------------------------------
-    safe_name = "".join(c for c in name if c.isalnum() or c in "_- ").strip()
-    safe_name = safe_name.replace(" ", "_")
-
-    dataset_dir = Path(BASE_DIR) / "storage" / "dataset"
-    dataset_dir.mkdir(parents=True, exist_ok=True)
-
-    # temporary folder (needed for NOT NULL folder column)
-    temp_dest = dataset_dir / f"{safe_name}__pending"
-    temp_dest.mkdir(parents=True, exist_ok=True)
-
-    # ------------------------------------------------
-    # 2️⃣ Insert user with folder
-    # ------------------------------------------------
-    created_at = int(time.time())
-    created_at_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cur.execute(
-        "INSERT INTO users (name, folder, created_at) VALUES (?, ?, ?)",
-        (name, str(temp_dest), created_at_str)
-    )
-    user_id = cur.lastrowid
+    return jsonify({"status": "queued", "job_id": job_id, "pending_id": pid}), 202
 
-    # ------------------------------------------------
-    # 3️⃣ Rename temp folder to final folder: name__uID
-    # ------------------------------------------------
-    final_dest = dataset_dir / f"{safe_name}__u{user_id}"
-    temp_dest.rename(final_dest)
 
-    # update folder path in DB
-    cur.execute(
-        "UPDATE users SET folder=? WHERE id=?",
-        (str(final_dest), user_id)
-    )
-
-    # ------------------------------------------------
-    # 4️⃣ Move images (rename to avoid overwrite)
-    # ------------------------------------------------
-    moved_any = False
-    for i, src in enumerate(sorted(temp_folder.glob("*.*"))):
+# -------------------------
+# Bulk approve / re-embed all (background jobs)
+# -------------------------
+@admin_bp.route("/approve_bulk", methods=["POST"])
+@admin_required
+def approve_bulk():
+    data = request.get_json() or {}
+    ids = data.get("pending_ids", "all")
+    if ids != "all":
         try:
-            new_name = f"u{user_id}_{int(time.time())}_{i}{src.suffix}"
-            target = final_dest / new_name
-            shutil.move(str(src), str(target))
-            moved_any = True
-        except Exception as e:
-            print("Move failed:", e)
-
-    if not moved_any:
-        conn.rollback()
-        conn.close()
-        return jsonify({"error": "no images moved"}), 500
-
-    # ------------------------------------------------
-    # 5️⃣ Compute embedding
-    # ------------------------------------------------
-    emb = compute_folder_embedding(str(final_dest))
-    if emb is None:
-        conn.rollback()
-        safe_rmtree(final_dest)  # clean partially moved images
-        conn.close()
-        return jsonify({
-            "error": "face_quality_low",
-            "message": "Face images are too blurry / dark / unclear. Please re-enroll with better lighting and camera stability.",
-            "tips": [
-                "Ensure face is well-lit",
-                "Look straight at camera",
-                "Do not move while capturing",
-                "Keep face close to camera"
-            ]
-        }), 400
-
-    # ------------------------------------------------
-    # 6️⃣ Store embedding
-    # ------------------------------------------------
-    emb_bytes = emb.astype("float32").tobytes()
-    cur.execute(
-        "INSERT INTO user_embeddings (user_id, embedding, created_at) "
-        "VALUES (?, ?, ?)",
-        (user_id, emb_bytes, created_at)
-    )
+            ids = sorted({int(i) for i in ids})
+        except (TypeError, ValueError):
+            return jsonify({"error": "pending_ids must be a list of ids or \"all\""}), 400
+        if not ids:
+            return jsonify({"error": "pending_ids required"}), 400
+
+    # repeated clicks reuse the bulk job already in flight (json_extract
+    # returns a list payload as compact JSON text); rows another job
+    # approves meanwhile are skipped by the job itself (ml/processor.py)
+    key = ids if ids == "all" else json.dumps(ids, separators=(",", ":"))
+    job = find_active("approve_bulk", "pending_ids", key)
+    job_id = job["id"] if job else enqueue("approve_bulk", {"pending_ids": ids})
+    return jsonify({"status": "queued", "job_id": job_id}), 202
+
+
+@admin_bp.route("/reembed_all", methods=["POST"])
+@admin_required
+def reembed_all():
+    job = find_active("reembed_all", "all", 1)
+    job_id = job["id"] if job else enqueue("reembed_all", {"all": 1})
+    return jsonify({"status": "queued", "job_id": job_id}), 202
 
-    # ------------------------------------------------
-    # 7️⃣ Cleanup pending
-    # ------------------------------------------------
-    cur.execute("DELETE FROM pending_enrollments WHERE id=?", (pid,))
-    conn.commit()
-    conn.close()
 
-    # ------------------------------------------------
-    # 8️⃣ Remove pending folder completely (SAFE)
-    # ------------------------------------------------
-    deleted = safe_rmtree(temp_folder)
-    if not deleted:
-        print("WARNING: Pending folder could not be deleted:", temp_folder)
-    else:
-        print("Pending folder deleted:", temp_folder)
-
-    # ------------------------------------------------
-    # ✅ Return updated info for frontend
-    # ------------------------------------------------
+# -------------------------
+# Embedding model version / online upgrade
+# -------------------------
+@admin_bp.route("/model", methods=["GET"])
+@admin_required
+def model_status():
+    name, version = active_model()
+    counts = version_counts()
     return jsonify({
-        "status": "approved",
-        "pending_id": pid,
-        "user_id": user_id,
-        "folder": final_dest.name,
-        "name": name  # frontend uses this
+        "model": name,
+        "model_version": version,
+        "versions": [
+            {"model_version": v, "users": u, "templates": t, "active": v == version}
+            for v, (u, t) in counts.items()
+        ],
+        "available": sorted(p.name for p in MODELS_DIR.glob("*.onnx") if not p.name.startswith("scrfd"))
     })
 
 
+@admin_bp.route("/model/upgrade", methods=["POST"])
+@admin_required
+def model_upgrade():
+    data = request.get_json() or {}
+    model = data.get("model")
+    if not model or Path(model).name != model or not (MODELS_DIR / model).exists():
+        return jsonify({"error": "model must be a file under ml/models/"}), 400
+
+    job = find_active("migrate_model", "model", model)
+    job_id = job["id"] if job else enqueue(
+        "migrate_model", {"model": model, "force": bool(data.get("force"))}
+    )
+    return jsonify({"status": "queued", "job_id": job_id, "model": model}), 202
+
+
+# -------------------------
+# Job status (polled by the dashboard)
+# -------------------------
+@admin_bp.route("/jobs/<int:job_id>", methods=["GET"])
+@admin_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+
+@admin_bp.route("/jobs", methods=["GET"])
+@admin_required
+def jobs_list():
+    status = request.args.get("status")
+    limit = min(int(request.args.get("limit", 50)), 500)
+    return jsonify(list_jobs(limit, status))
+
+
 #Reject users
 @admin_bp.route("/reject", methods=["POST"])
 @admin_required
@@ -270,7 +195,7 @@ def reject_pending():
     if not pid:
         return jsonify({"error": "pending_id required"}), 400
 
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
 
     cur.execute(
@@ -323,13 +248,15 @@ def update_user():
     if not uid or not name:
         return jsonify({"error": "id and name required"}), 400
 
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
 
     cur.execute("UPDATE users SET name=? WHERE id=?", (name, uid))
     conn.commit()
     conn.close()
 
+    gallery.sync()
+
     return jsonify({"status": "updated", "user_id": uid})
 
 
@@ -342,10 +269,14 @@ def update_user():
 def delete_user():
     data = request.get_json() or {}
     uid = data.get("id")
-    if not uid:
+    if uid is None or uid == "":
         return jsonify({"error": "id required"}), 400
+    try:
+        uid = int(uid)          # the presence bitmap is keyed by int ids
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid id"}), 400
 
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
 
     # get folder to delete
@@ -367,6 +298,9 @@ def delete_user():
     conn.commit()
     conn.close()
 
+    gallery.sync()
+    forget_attendance(uid)
+
     return jsonify({"status": "deleted", "user_id": uid})
 
 
@@ -382,7 +316,7 @@ def admin_attendance():
     user_id = data.get("user_id")
     device = data.get("device")
 
-    conn = db_conn_local()
+    conn = db_conn()
     cur = conn.cursor()
 
     q = """
@@ -1,20 +1,27 @@
 # user_api.py
 
+import os
+import numpy as np
 from flask import Blueprint, request, jsonify
-from utils.encoding import b64_to_cv2
-from ml.embeddings import get_embedding_model
-from services.embedding_service import find_top_k_users
-from services.attendance_service import mark_attendance
+from utils.encoding import b64_to_bytes, bytes_to_cv2, bytes_to_cv2_reduced
+from services.embedding_service import active_embedder, find_top_k_users, gallery
+from services.face_tracker import tracker_for, face_quality, appearance
+from services.attendance_service import mark_attendance, mark_attendance_many
+from services.group_recognition import (
+    GROUP_MIN_FACE, GROUP_MIN_DET_SCORE, GROUP_MAX_FACES, match_faces,
+)
+from services.recognition_session import (
+    FRAME_VOTES_REQUIRED, SESSION_MAX_FRAMES, SESSION_TTL,
+    create_session, get_session, close_session,
+)
 
 # -----------------------------
-# Load SCRFD + alignment ONCE
+# SCRFD + ArcFace come from the shared model registry
+# (loaded once per process, on first use)
 # -----------------------------
-from ml.scrfd_detector import SCRFDDetector
+from ml.registry import get_detector
 from ml.face_align import align_face
 
-scrfd = SCRFDDetector()          # loads ONNX model once
-embedding_model = get_embedding_model()     # loads face embedding model once
-
 
 # =========================
 # Face Recognition Constants
@@ -23,79 +30,152 @@ REJECT_THRESHOLD = 0.70
 STRONG_ACCEPT_THRESHOLD = 0.92
 TOP2_MARGIN = 0.10
 
-# FRAME_VOTES_REQUIRED = 3
+# multi-frame sessions: FRAME_VOTES_REQUIRED (default 3) agreeing frames
+# accept without a strong single frame (services/recognition_session.py)
+
+# Large uploads are decoded at 1/2 or 1/4 resolution for detection.
+# Faces at least this wide in the reduced frame are aligned from it
+# directly (ArcFace input is 112x112); smaller ones are re-read at full quality.
+REDUCED_DECODE = os.environ.get("REDUCED_DECODE", "1") == "1"
+ALIGN_MIN_FACE = 112
 
 
 # ---------------------------------------
 user_bp = Blueprint("user_bp", __name__)
 # ---------------------------------------
 
-@user_bp.route("/recognize", methods=["POST"])
-def recognize():
-    payload = request.get_json() or {}
-    img_b64 = payload.get("image")
+# Raw request bodies accepted as an encoded image
+BINARY_IMAGE_TYPES = ("image/jpeg", "image/png", "application/octet-stream")
 
-    if not img_b64:
-        return jsonify({"recognized": False, "error": "image required"}), 400
 
-    img = b64_to_cv2(img_b64)
+def read_request_image():
+    """
+    Returns (encoded image bytes, device) from the current request.
+
+    Accepts, cheapest first:
+      - raw body with Content-Type image/jpeg (device in ?device=)
+      - multipart/form-data with an "image" file part (device form field)
+      - JSON {"image": <data URL / base64>, "device": ...} (legacy)
+
+    Image bytes are None when no image was sent, b"" when it could not
+    be decoded from base64.
+    """
+    if request.mimetype in BINARY_IMAGE_TYPES:
+        data = request.get_data(cache=False)
+        return data or None, request.args.get("device", "camera")
+
+    if request.mimetype == "multipart/form-data":
+        part = request.files.get("image")
+        data = part.read() if part else None
+        return data or None, request.form.get("device", request.args.get("device", "camera"))
+
+    payload = request.get_json(silent=True) or {}
+    img_b64 = payload.get("image")
+    data = (b64_to_bytes(img_b64) or b"") if img_b64 else None
+    return data, payload.get("device", "camera")
+
+
+def _detect_face(data):
+    """
+    Decode a frame and detect the single face in it.
+
+    Returns (img, factor, face, None, None) on success, else
+    (None, None, None, response body, HTTP status). factor maps img
+    coordinates to the full-resolution frame.
+    """
+    detector = get_detector()
+    if REDUCED_DECODE:
+        img, factor = bytes_to_cv2_reduced(data, detector.input_size)
+    else:
+        img, factor = bytes_to_cv2(data), 1.0
     if img is None:
-        return jsonify({"recognized": False, "error": "invalid image"}), 400
+        return None, None, None, {"recognized": False, "error": "invalid image"}, 400
 
     # ------------------------------------------------
     # STEP 1: FACE DETECTION (STRICT)
     # ------------------------------------------------
-    faces = scrfd.detect(img, conf_threshold=0.3)
+    faces = detector.detect(img, conf_threshold=0.3)
 
     if len(faces) == 0:
-        return jsonify({
+        return None, None, None, {
             "recognized": False,
             "reason": "No face detected",
             "score": 0
-        }), 200
+        }, 200
 
     if len(faces) > 1:
-        return jsonify({
+        return None, None, None, {
             "recognized": False,
             "reason": "Multiple faces detected",
             "score": 0
-        }), 200
+        }, 200
 
     # face = max(faces, key=lambda f: f["score"])
 
-    face = faces[0]
+    return img, factor, faces[0], None, None
+
+
+def _embed_face(data, img, factor, face):
+    """
+    Align and embed a detected face.
+
+    Returns (emb, embedder, None, None) on success, else
+    (None, None, response body, HTTP status).
+    """
     kps = face["kps"]
 
+    # small face in a reduced decode: align from the full-quality frame
+    if factor > 1 and face["box"][2] < ALIGN_MIN_FACE:
+        full = bytes_to_cv2(data)
+        if full is not None:
+            img = full
+            kps = [(x * factor, y * factor) for (x, y) in kps]
+
     # ------------------------------------------------
     # STEP 2: ALIGN + EMBEDDING
     # ------------------------------------------------
     try:
         aligned_face = align_face(img, kps)
     except Exception as e:
-        return jsonify({
+        return None, None, {
             "recognized": False,
             "error": "Face alignment failed",
             "details": str(e),
             "score": 0
-        }), 500
+        }, 500
 
-    emb = embedding_model.get_embedding(aligned_face)
+    # the model the gallery was built with (changes only on a model upgrade)
+    embedder = active_embedder()
+    emb = embedder.get_embedding(aligned_face)
     if emb is None:
-        return jsonify({
+        return None, None, {
             "recognized": False,
             "error": "Embedding failed",
             "score": 0
-        }), 400
+        }, 400
+
+    return emb, embedder, None, None
+
 
+def _frame_embedding(data):
+    """Detect + embed; returns (emb, embedder, error body, HTTP status)."""
+    img, factor, face, error, status = _detect_face(data)
+    if error is not None:
+        return None, None, error, status
+    return _embed_face(data, img, factor, face)
 
-    top_matches = find_top_k_users(emb, k=2)
 
+def _check_match(top_matches):
+    """
+    Reject / ambiguity checks on the top-2 gallery matches.
+    Returns None when the best match is acceptable, else the response body.
+    """
     if not top_matches:
-        return jsonify({
+        return {
             "recognized": False,
             "reason": "No enrolled users",
             "score": 0
-        }), 200
+        }
 
     best = top_matches[0]
     second = top_matches[1] if len(top_matches) > 1 else None
@@ -106,11 +186,11 @@ def recognize():
     # STEP 4: HARD REJECT
     # ------------------------------------------------
     if score < REJECT_THRESHOLD:
-        return jsonify({
+        return {
             "recognized": False,
             "reason": "Unknown user",
             "score": score
-        }), 200
+        }
 
     # ------------------------------------------------
     # STEP 5: AMBIGUITY CHECK (CRITICAL)
@@ -118,30 +198,322 @@ def recognize():
     if second:
         margin = score - second["score"]
         if margin < TOP2_MARGIN:
-            return jsonify({
+            return {
                 "recognized": False,
                 "reason": "Face too similar to another user",
                 "score": score,
                 "borderline": True
-            }), 200
+            }
+
+    return None
 
+
+def _accept(best, score, device):
     # ------------------------------------------------
     # STEP 6: ATTENDANCE
     # ------------------------------------------------
     borderline = score < STRONG_ACCEPT_THRESHOLD
-    device = payload.get("device", "camera")
 
     attendance_result = mark_attendance(best["user_id"], device)
 
-    return jsonify({
+    return {
         "recognized": True,
         "user_id": best["user_id"],
         "name": best["name"],
         "score": score,
         "borderline": borderline,
         "attendance": attendance_result
+    }
+
+
+def _kiosk_id():
+    """
+    Stable id of the sending kiosk (?kiosk= or X-Kiosk-Id header), None
+    when missing. "device" is a free-form label shared by many kiosks, so
+    face tracking is keyed by this id only.
+    """
+    kiosk = (request.args.get("kiosk") or request.headers.get("X-Kiosk-Id") or "").strip()
+    return kiosk[:64] or None
+
+
+def _tracked_response(track, device):
+    body = _accept(track.match, track.match["score"], device)
+    body["tracked"] = True
+    return jsonify(body)
+
+
+@user_bp.route("/recognize", methods=["POST"])
+def recognize():
+    data, device = read_request_image()
+
+    if data is None:
+        return jsonify({"recognized": False, "error": "image required"}), 400
+
+    img, factor, face, error, status = _detect_face(data)
+    if error is not None:
+        return jsonify(error), status
+
+    # same person as in this kiosk's previous frames: reuse the identity
+    track = None
+    kiosk = _kiosk_id()
+    if kiosk:
+        quality = face_quality(face, factor)
+        patch = appearance(img, face["box"])
+        box = tuple(v * factor for v in face["box"])
+        track = tracker_for(kiosk).observe([box])[0]
+
+    emb = embedder = None
+    if track is not None and track.match is not None:
+        gallery.sync()
+        if track.can_reuse(quality, gallery.version, patch):
+            if not track.needs_verification():
+                track.reuses += 1
+                return _tracked_response(track, device)
+
+            # periodic check: still the face the identity came from?
+            emb, embedder, error, status = _embed_face(data, img, factor, face)
+            if error is not None:
+                return jsonify(error), status
+            if track.same_face(emb):
+                track.reuses = 0
+                return _tracked_response(track, device)
+
+    if emb is None:
+        emb, embedder, error, status = _embed_face(data, img, factor, face)
+        if error is not None:
+            return jsonify(error), status
+
+    top_matches = find_top_k_users(emb, k=2, model_version=embedder.version)
+
+    rejected = _check_match(top_matches)
+    if rejected is not None:
+        if track is not None:
+            track.remember(None, None, quality, gallery.version, patch)
+        return jsonify(rejected), 200
+
+    best = top_matches[0]
+    if track is not None:
+        track.remember(best, emb, quality, gallery.version, patch)
+    return jsonify(_accept(best, best["score"], device))
+
+
+# -----------------------------------
+# Group / classroom capture
+# -----------------------------------
+# Every face above a size / confidence floor is recognized from one
+# frame: batched alignment + ArcFace, one gallery matrix product,
+# one-to-one assignment (services/group_recognition.py) and one
+# attendance transaction.
+
+@user_bp.route("/recognize/group", methods=["POST"])
+def recognize_group():
+    data, device = read_request_image()
+
+    if data is None:
+        return jsonify({"recognized": False, "error": "image required"}), 400
+
+    detector = get_detector()
+    if REDUCED_DECODE:
+        img, factor = bytes_to_cv2_reduced(data, detector.input_size)
+    else:
+        img, factor = bytes_to_cv2(data), 1.0
+    if img is None:
+        return jsonify({"recognized": False, "error": "invalid image"}), 400
+
+    # ------------------------------------------------
+    # STEP 1: DETECTION + SIZE / QUALITY FLOOR
+    # ------------------------------------------------
+    detected = detector.detect(img, conf_threshold=0.3)
+    faces = [
+        f for f in detected
+        if f["score"] >= GROUP_MIN_DET_SCORE and f["box"][2] * factor >= GROUP_MIN_FACE
+    ]
+    faces.sort(key=lambda f: f["score"], reverse=True)
+    faces = faces[:GROUP_MAX_FACES]
+    skipped = len(detected) - len(faces)
+
+    if not faces:
+        return jsonify({
+            "recognized": False,
+            "reason": "No face detected",
+            "faces": [],
+            "skipped": skipped
+        }), 200
+
+    # ------------------------------------------------
+    # STEP 2: ALIGN ALL (small faces from the full-quality frame)
+    # ------------------------------------------------
+    full = None
+    if factor > 1 and any(f["box"][2] < ALIGN_MIN_FACE for f in faces):
+        full = bytes_to_cv2(data)
+
+    results = []
+    aligned = []
+    for f in faces:
+        x, y, w, h = (v * factor for v in f["box"])
+        result = {
+            "box": [round(x), round(y), round(w), round(h)],
+            "det_score": round(f["score"], 3),
+            "recognized": False
+        }
+        results.append(result)
+
+        src, kps = img, f["kps"]
+        if full is not None and f["box"][2] < ALIGN_MIN_FACE:
+            src, kps = full, [(px * factor, py * factor) for (px, py) in kps]
+        try:
+            aligned.append((result, align_face(src, kps)))
+        except Exception:
+            result.update({"error": "Face alignment failed", "score": 0})
+
+    # ------------------------------------------------
+    # STEP 3: ONE BATCHED EMBEDDING CALL
+    # ------------------------------------------------
+    embedder = active_embedder()
+    try:
+        embs = embedder.get_embeddings([a for _, a in aligned]) if aligned else None
+    except Exception as e:
+        return jsonify({
+            "recognized": False,
+            "error": "Embedding failed",
+            "details": str(e)
+        }), 500
+
+    queries = []
+    for i, (result, _) in enumerate(aligned):
+        if embs[i].any():
+            queries.append((result, embs[i]))
+        else:
+            result.update({"error": "Embedding failed", "score": 0})
+
+    # ------------------------------------------------
+    # STEP 4: MATCH ALL FACES AT ONCE (one-to-one)
+    # ------------------------------------------------
+    if queries:
+        matches = match_faces(
+            np.stack([e for _, e in queries]), embedder.version,
+            REJECT_THRESHOLD, TOP2_MARGIN
+        )
+        for (result, _), match in zip(queries, matches):
+            result.update(match)
+
+    # ------------------------------------------------
+    # STEP 5: ATTENDANCE (one transaction)
+    # ------------------------------------------------
+    matched = [r for r in results if "user_id" in r]
+    attendance = mark_attendance_many([r["user_id"] for r in matched], device)
+    for r in matched:
+        r["recognized"] = True
+        r["borderline"] = r["score"] < STRONG_ACCEPT_THRESHOLD
+        r["attendance"] = attendance[r["user_id"]]
+
+    return jsonify({
+        "recognized": bool(matched),
+        "recognized_count": len(matched),
+        "faces": results,
+        "skipped": skipped
     })
 
+
+# -----------------------------------
+# Multi-frame recognition session
+# -----------------------------------
+# A kiosk opens a session, then streams small frames over one keep-alive
+# connection until the response status is no longer "pending". Each
+# frame carries the session token from the open call (X-Session-Token);
+# the state itself stays on the server.
+# See services/recognition_session.py for the voting rules.
+
+SESSION_TOKEN_HEADER = "X-Session-Token"
+
+
+@user_bp.route("/recognize/session", methods=["POST"])
+def open_recognition_session():
+    payload = request.get_json(silent=True) or {}
+    session = create_session(payload.get("device", request.args.get("device", "camera")))
+    return jsonify({
+        "session_id": session.id,
+        "session_token": session.token,
+        "ttl": SESSION_TTL,
+        "max_frames": SESSION_MAX_FRAMES,
+        "votes_required": FRAME_VOTES_REQUIRED
+    }), 201
+
+
+def _session_response(session, status, body):
+    if status != "pending":
+        close_session(session)      # decided: the token is dead from now on
+    return dict(body, status=status, **session.summary())
+
+
+@user_bp.route("/recognize/session/frame", methods=["POST"])
+def recognize_session_frame():
+    token = request.headers.get(SESSION_TOKEN_HEADER) or request.args.get("token", "")
+    session = get_session(token)
+    if session is None:
+        return jsonify({"recognized": False, "error": "unknown or expired session"}), 404
+
+    # frames of one session are handled one at a time
+    with session.lock:
+        if session.closed:
+            return jsonify({"recognized": False, "error": "unknown or expired session"}), 404
+        return _session_frame(session)
+
+
+def _session_frame(session):
+    data, _ = read_request_image()
+    if data is None:
+        return jsonify({"recognized": False, "error": "image required"}), 400
+
+    session.frames += 1
+    out_of_frames = session.frames >= SESSION_MAX_FRAMES
+
+    emb, embedder, error, status = _frame_embedding(data)
+    if error is not None:
+        if status != 200:
+            return jsonify(error), status   # bad upload, not a bad frame
+        # no face / several faces: wait for the next frame
+        return jsonify(_session_response(
+            session, "rejected" if out_of_frames else "pending", error))
+
+    top_matches = find_top_k_users(emb, k=2, model_version=embedder.version)
+    if not top_matches:
+        return jsonify(_session_response(session, "rejected", _check_match(top_matches)))
+
+    best = top_matches[0]
+    rejected = _check_match(top_matches)
+
+    # early stop: one strong, unambiguous frame is enough
+    if rejected is None and best["score"] >= STRONG_ACCEPT_THRESHOLD:
+        return jsonify(_session_response(
+            session, "accepted", _accept(best, best["score"], session.device)))
+
+    session.add_embedding(emb, embedder.version)
+    if rejected is None:
+        session.votes[best["user_id"]] += 1
+
+    # enough votes: confirm them against the averaged embedding
+    if session.votes:
+        leader, count = session.votes.most_common(1)[0]
+        if count >= FRAME_VOTES_REQUIRED:
+            mean_matches = find_top_k_users(
+                session.mean_embedding(), k=2, model_version=embedder.version)
+            if (_check_match(mean_matches) is None
+                    and mean_matches[0]["user_id"] == leader):
+                mean_best = mean_matches[0]
+                return jsonify(_session_response(
+                    session, "accepted",
+                    _accept(mean_best, mean_best["score"], session.device)))
+
+    frame_result = rejected or {
+        "recognized": False,
+        "reason": "Collecting frames",
+        "score": best["score"]
+    }
+    return jsonify(_session_response(
+        session, "rejected" if out_of_frames else "pending", frame_result))
+
+
 # -----------------------------------
 # Save Admin Note
 # -----------------------------------
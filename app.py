@@ -9,12 +9,6 @@ import uuid
 import sqlite3
 
 
-from ml.download_models import download_if_missing
-
-print("🚀 Starting app, ensuring models exist...")
-download_if_missing()
-print("✅ Models ready")
-
 from flask import (
     Flask, render_template, request, jsonify, session,
     redirect, url_for, send_from_directory
@@ -39,7 +33,7 @@ except Exception:
     HAVE_CV2 = False
 
 # --- Embedding model import (for recognition) ---
-# ml.embeddings should provide compute_folder_embedding and model loader
+# ml.embeddings provides the model loader
 
 # from ml.embedding_model import EmbeddingModel
 
@@ -76,72 +70,16 @@ app.register_blueprint(enroll_bp, url_prefix="/api/enroll")
 # ------------------------------------------------------
 # DB helper
 # ------------------------------------------------------
-def db_conn():
-    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+# shared, pooled connections (see database/db.py)
+from database.db import db_conn
 
 # ------------------------------------------------------
-# Create tables (includes user_embeddings for Option A)
+# Startup: models verified, tables created, gallery loaded (once; before
+# the fork under gunicorn preload). ONNX sessions are built per worker in
+# the background, see services/startup.py and gunicorn.conf.py
 # ------------------------------------------------------
-def ensure_tables():
-    conn = db_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS admins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password_hash TEXT,
-        created_at INTEGER DEFAULT CURRENT_TIMESTAMP
-    )""")
-
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        folder TEXT NOT NULL,
-        admin_note TEXT DEFAULT '',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-    
-
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS pending_enrollments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        temp_folder TEXT NOT NULL,
-        requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS attendance (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        device TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )""")
-
-    # user_embeddings table: store embedding JSON text per user (option A)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS user_embeddings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        embedding BLOB NOT NULL,
-        created_at INTEGER DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )""")
-      
-
-    conn.commit()
-    conn.close()
-
-ensure_tables()
-
+from services.startup import prepare, start_worker, readiness
+prepare()
 
 
 # --- Create default admin ---
@@ -159,6 +97,11 @@ def ensure_default_admin():
 
 ensure_default_admin()
 
+# --- Per-worker startup (warmup + job workers) when no post_fork hook ran ---
+@app.before_request
+def ensure_worker_started():
+    start_worker()
+
 # ------------------------------------------------------
 # Admin login decorator (for blueprint use)
 # ------------------------------------------------------
@@ -280,6 +223,19 @@ def admin_dashboard():
 
 
 
+# ------------------------------------------------------
+# Health / readiness (load balancers, orchestrators)
+# ------------------------------------------------------
+@app.route("/healthz")
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz")
+def readyz():
+    ready, details = readiness()
+    return jsonify(dict(details, ready=ready)), (200 if ready else 503)
+
+
 # ------------------------------------------------------
 # API: Static file
 # ------------------------------------------------------
@@ -293,4 +249,5 @@ def static_files(filename):
 # ------------------------------------------------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
+    start_worker()
     app.run(host="0.0.0.0", port=port)
@@ -1,5 +1,15 @@
 # database/db.py
+# Single place that opens SQLite connections for the whole app.
+# Connections are pooled per process: PRAGMAs are applied once per
+# connection, prepared statements stay cached on it, and close() hands
+# the connection back to the pool instead of reopening the file next time.
+# db_conn() returns a handle for one borrow only: after its close() the
+# handle is dead, so a stray second close() (or a late query) can never
+# touch the connection once another thread has borrowed it.
+
+import os
 import sqlite3
+import threading
 from pathlib import Path
 
 
@@ -15,19 +25,133 @@ from pathlib import Path
 BASE_DIR = Path(__file__).resolve().parents[1]
 DB_PATH = BASE_DIR / "database" / "attendance.db"
 
-def db_conn():
-    conn = sqlite3.connect(str(DB_PATH), timeout=30, check_same_thread=False)
+# Pool / tuning knobs (per process)
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+STATEMENT_CACHE_SIZE = 256
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))   # bytes
+CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16 * 1024))   # page cache
+# newest gallery_changes rows kept; a worker further behind reloads fully
+GALLERY_CHANGES_KEEP = max(1, int(os.environ.get("GALLERY_CHANGES_KEEP", 10000)))
+
+
+class PooledConnection:
+    """
+    One borrow of a pooled sqlite3 connection. Behaves like the
+    connection; close() gives it back to the pool (rolling back an open
+    transaction) and invalidates this handle, so closing twice is a no-op
+    and any other use afterwards raises sqlite3.ProgrammingError.
+    """
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        object.__setattr__(self, "_conn", conn)
+
+    def _live(self):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._live(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._live(), name, value)
+
+    def __enter__(self):
+        self._live().__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._live().__exit__(*exc)
+
+    def close(self):
+        with _pool_lock:
+            conn = self._conn
+            object.__setattr__(self, "_conn", None)
+        if conn is None:
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        _release(conn)
+
+
+_pool = []
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+
+
+def _open():
+    conn = sqlite3.connect(
+        str(DB_PATH),
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
     conn.row_factory = sqlite3.Row
 
+    # WAL: one writer + many readers, reads do not block writes
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE};")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
 
     return conn
 
 
+def _release(conn):
+    with _pool_lock:
+        if os.getpid() == _pool_pid and len(_pool) < POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn.close()
+
+
+def db_conn():
+    """
+    Borrow a connection; call .close() when done to give it back.
+    The returned handle is only valid until that close().
+    """
+    global _pool_pid
+    with _pool_lock:
+        # never reuse connections inherited across fork (gunicorn --preload)
+        if os.getpid() != _pool_pid:
+            _pool.clear()
+            _pool_pid = os.getpid()
+        conn = _pool.pop() if _pool else None
+
+    if conn is None:
+        conn = _open()
+    return PooledConnection(conn)
+
+
+def close_all():
+    """Close every pooled connection (tests / shutdown)."""
+    with _pool_lock:
+        conns = list(_pool)
+        _pool.clear()
+    for conn in conns:
+        conn.close()
+
+
+_tables_ready = False
+
+
 def ensure_tables():
+    """
+    Create / migrate every table (once per process). Called by the app's
+    startup (services/startup.py) and the command line tools.
+    """
+    global _tables_ready
+    if _tables_ready:
+        return
+
     conn = db_conn()
     cur = conn.cursor()
+    # one transaction: a failed migration leaves the schema untouched
+    cur.execute("BEGIN IMMEDIATE")
 
     # admins, users, pending_enrollments, attendance, user_embeddings (Option A)
     cur.execute("""
@@ -61,9 +185,34 @@ def ensure_tables():
         user_id INTEGER,
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         device TEXT,
+        attendance_date TEXT,
         FOREIGN KEY(user_id) REFERENCES users(id)
     )""")
 
+    # Migration: stored attendance_date + UNIQUE(user_id, attendance_date)
+    # so "already marked today" is an index lookup, not a DATE(timestamp) scan
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(attendance)")}
+    if "attendance_date" not in cols:
+        cur.execute("ALTER TABLE attendance ADD COLUMN attendance_date TEXT")
+        cur.execute("""
+            UPDATE attendance SET attendance_date = DATE(timestamp)
+            WHERE timestamp IS NOT NULL
+        """)
+        # legacy duplicates (same user, same day): keep the first mark as
+        # the day's key, later rows stay in the log without one
+        cur.execute("""
+            UPDATE attendance SET attendance_date = NULL
+            WHERE attendance_date IS NOT NULL AND id NOT IN (
+                SELECT MIN(id) FROM attendance
+                WHERE attendance_date IS NOT NULL
+                GROUP BY user_id, attendance_date
+            )
+        """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_user_date
+        ON attendance (user_id, attendance_date)
+    """)
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS user_embeddings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -74,8 +223,118 @@ def ensure_tables():
     )""")
       
 
+    # Migration: optional quantized copy of each template (float16 / int8),
+    # see services/quantization.py; embedding stays the float32 original
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(user_embeddings)")}
+    if "embedding_q" not in cols:
+        cur.execute("ALTER TABLE user_embeddings ADD COLUMN embedding_q BLOB")
+    if "embedding_q_dtype" not in cols:
+        cur.execute("ALTER TABLE user_embeddings ADD COLUMN embedding_q_dtype TEXT")
+    # Migration: embedding model version of each template (NULL = written
+    # before versioning; claimed by the first active model, see
+    # services/model_version.py)
+    if "model_version" not in cols:
+        cur.execute("ALTER TABLE user_embeddings ADD COLUMN model_version TEXT")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_embeddings_user
+        ON user_embeddings (user_id)
+    """)
+
+    # Gallery change-feed: every change to a user's embeddings or name
+    # appends a row, so workers holding an in-memory gallery can compare
+    # MAX(seq) with their own version and reload only the changed users.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS gallery_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+    gallery_triggers = [
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_embeddings_insert AFTER INSERT ON user_embeddings
+        BEGIN
+            INSERT INTO gallery_changes (user_id) VALUES (NEW.user_id);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_embeddings_update AFTER UPDATE ON user_embeddings
+        BEGIN
+            INSERT INTO gallery_changes (user_id) VALUES (NEW.user_id);
+            INSERT INTO gallery_changes (user_id)
+                SELECT OLD.user_id WHERE OLD.user_id IS NOT NEW.user_id;
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_embeddings_delete AFTER DELETE ON user_embeddings
+        BEGIN
+            INSERT INTO gallery_changes (user_id) VALUES (OLD.user_id);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_rename AFTER UPDATE OF name ON users
+        BEGIN
+            INSERT INTO gallery_changes (user_id) VALUES (NEW.id);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO gallery_changes (user_id) VALUES (OLD.id);
+        END""",
+    ]
+    # execute() one by one: executescript() would commit the migration halfway
+    for sql in gallery_triggers:
+        cur.execute(sql)
+
+    # Keep the feed bounded: only the newest GALLERY_CHANGES_KEEP rows stay.
+    # AUTOINCREMENT never reuses a seq, so MAX(seq) keeps growing; a worker
+    # whose version is older than the oldest kept row reloads the whole
+    # gallery (services/embedding_service.py). Recreated on every start so
+    # a changed GALLERY_CHANGES_KEEP takes effect.
+    cur.execute("DROP TRIGGER IF EXISTS trg_gallery_changes_prune")
+    cur.execute(f"""
+        CREATE TRIGGER trg_gallery_changes_prune AFTER INSERT ON gallery_changes
+        BEGIN
+            DELETE FROM gallery_changes WHERE seq <= NEW.seq - {GALLERY_CHANGES_KEEP};
+        END""")
+    cur.execute(
+        "DELETE FROM gallery_changes WHERE seq <= (SELECT MAX(seq) FROM gallery_changes) - ?",
+        (GALLERY_CHANGES_KEEP,)
+    )
+
+    # Key/value settings, e.g. the active embedding model version
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+    # Background jobs (services/job_queue.py): approvals etc. run outside
+    # the HTTP request; the dashboard polls status / progress
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        message TEXT,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER DEFAULT 0,
+        max_attempts INTEGER DEFAULT 3,
+        worker TEXT,
+        run_after REAL,
+        created_at REAL,
+        updated_at REAL,
+        started_at REAL,
+        heartbeat_at REAL,
+        finished_at REAL
+    )""")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_status
+        ON jobs (status, run_after)
+    """)
+
     conn.commit()
     conn.close()
-
-# Ensure tables when module is imported
-ensure_tables()
+    _tables_ready = True
@@ -33,11 +33,17 @@ CREATE TABLE IF NOT EXISTS users (
 CREATE TABLE IF NOT EXISTS user_embeddings (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
-    embedding BLOB NOT NULL,
+    embedding BLOB NOT NULL,           -- float32 original
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    embedding_q BLOB,                  -- optional float16 / int8 copy
+    embedding_q_dtype TEXT,            -- 'float16' | 'int8' | NULL
+    model_version TEXT,                -- embedding model that produced it
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_user_embeddings_user
+    ON user_embeddings (user_id);
+
 -- -----------------------------
 -- PENDING ENROLLMENTS
 -- -----------------------------
@@ -56,5 +62,85 @@ CREATE TABLE IF NOT EXISTS attendance (
     user_id INTEGER,
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     device TEXT,
+    attendance_date TEXT,              -- local day of the mark (YYYY-MM-DD)
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
+
+-- one mark per user per day
+CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_user_date
+    ON attendance (user_id, attendance_date);
+
+-- -----------------------------
+-- GALLERY CHANGE-FEED
+-- (filled by triggers; workers reload only users changed since their seq)
+-- -----------------------------
+CREATE TABLE IF NOT EXISTS gallery_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_embeddings_insert AFTER INSERT ON user_embeddings
+BEGIN
+    INSERT INTO gallery_changes (user_id) VALUES (NEW.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_embeddings_update AFTER UPDATE ON user_embeddings
+BEGIN
+    INSERT INTO gallery_changes (user_id) VALUES (NEW.user_id);
+    INSERT INTO gallery_changes (user_id)
+        SELECT OLD.user_id WHERE OLD.user_id IS NOT NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_embeddings_delete AFTER DELETE ON user_embeddings
+BEGIN
+    INSERT INTO gallery_changes (user_id) VALUES (OLD.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_rename AFTER UPDATE OF name ON users
+BEGIN
+    INSERT INTO gallery_changes (user_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+BEGIN
+    INSERT INTO gallery_changes (user_id) VALUES (OLD.id);
+END;
+
+-- -----------------------------
+-- SETTINGS (key/value)
+-- embedding_model / embedding_model_version: model serving recognition
+-- -----------------------------
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- -----------------------------
+-- BACKGROUND JOBS
+-- (services/job_queue.py; times are UNIX seconds)
+-- -----------------------------
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed
+    progress INTEGER DEFAULT 0,
+    total INTEGER DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 0,
+    max_attempts INTEGER DEFAULT 3,
+    worker TEXT,
+    run_after REAL,
+    created_at REAL,
+    updated_at REAL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status
+    ON jobs (status, run_after);
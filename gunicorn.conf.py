@@ -0,0 +1,24 @@
+# gunicorn.conf.py
+# ------------------------------------------------------
+#   gunicorn app:app -c gunicorn.conf.py
+#
+# preload_app: app.py is imported once in the master (models verified,
+# tables migrated, gallery loaded — see services/startup.py) and workers
+# fork from it, sharing that memory copy-on-write. Each worker then builds
+# and warms its own ONNX sessions in the background; GET /readyz turns 200
+# once it is warm.
+# ------------------------------------------------------
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+
+def post_fork(server, worker):
+    from services.startup import start_worker
+    start_worker()
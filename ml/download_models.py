@@ -1,29 +1,320 @@
+# ml/download_models.py
+# ------------------------------------------------------
+# Model store: where the ONNX models live and how they get there.
+#
+#   ml/models.json   manifest: url, sha256 and size of every required model
+#                    (sha256 / size null = not pinned yet)
+#   MODEL_DIR        model store directory (default: ml/models)
+#
+# verify_models() stats every file and only re-hashes it when its size /
+# mtime differ from the last verified state (MODEL_DIR/.verified.json).
+# Missing models are downloaded at startup as before; with
+# MODEL_AUTO_DOWNLOAD=0 (air-gapped hosts) a missing or corrupt model
+# fails fast with instructions instead.
+#
+# Installing always writes a temporary file in MODEL_DIR, checks it, then
+# renames it into place, so a reader never sees a half-written model.
+#
+# A model without a pinned sha256 in the manifest is accepted with a loud
+# warning (only its size is checked) until the published digests are
+# committed to ml/models.json. MODEL_REQUIRE_PINNED=1 refuses such models
+# instead. `pin` is a maintainer tool for updating the manifest in the
+# source tree from a trusted install, not a per-host setup step.
+#
+# Command line:
+#   python -m ml.download_models status
+#   python -m ml.download_models seed models.tar.gz   (air-gapped hosts)
+#   python -m ml.download_models download             (needs network)
+#   python -m ml.download_models pin                  (write sha256/size of
+#                                                      the installed models
+#                                                      into the manifest)
+# ------------------------------------------------------
+
 import os
-import requests
+import json
+import hashlib
+import threading
 
-MODELS = {
-    "arcface.onnx": "https://huggingface.co/tayyab-077/attendance-system-vision/resolve/main/arcface.onnx",
-    "scrfd_2.5g_bnkps.onnx": "https://huggingface.co/tayyab-077/attendance-system-vision/resolve/main/scrfd_2.5g_bnkps.onnx"
-}
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "models.json")
+MODEL_DIR = os.environ.get("MODEL_DIR", os.path.join(os.path.dirname(__file__), "models"))
 
-MODEL_DIR = os.path.join(os.path.dirname(__file__), "models")
-os.makedirs(MODEL_DIR, exist_ok=True)
+# download missing models at startup (0 on air-gapped hosts: fail fast)
+AUTO_DOWNLOAD = os.environ.get("MODEL_AUTO_DOWNLOAD", "1") == "1"
 
-def download_if_missing():
-    for name, url in MODELS.items():
-        path = os.path.join(MODEL_DIR, name)
+# strict mode: refuse manifest entries whose sha256 is still null
+REQUIRE_PINNED = os.environ.get("MODEL_REQUIRE_PINNED", "0") == "1"
 
-        if os.path.exists(path) and os.path.getsize(path) > 5_000_000:
-            print(f"✅ {name} already exists")
-            continue
+# files smaller than this are truncated downloads / error pages
+MIN_MODEL_BYTES = 5_000_000
+
+_CACHE_NAME = ".verified.json"
+_cache_lock = threading.Lock()
+
+
+class ModelStoreError(RuntimeError):
+    pass
+
+
+def load_manifest():
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+MODELS = load_manifest()
+
+
+def model_path(name):
+    return os.path.join(MODEL_DIR, name)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# --------------------------------------------------
+# Verification cache (stat -> sha256)
+# --------------------------------------------------
+def _cache_path():
+    return os.path.join(MODEL_DIR, _CACHE_NAME)
+
+
+def _read_cache():
+    try:
+        with open(_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache):
+    tmp = f"{_cache_path()}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp, _cache_path())
+    except OSError as e:
+        print("Could not write model verification cache:", e)
+
+
+def _remember(name, digest):
+    st = os.stat(model_path(name))
+    cache = _read_cache()
+    cache[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+    _write_cache(cache)
+
+
+def model_sha256(name):
+    """
+    sha256 of an installed model (any file in MODEL_DIR), hashing it only
+    when its size / mtime changed since it was last hashed.
+    """
+    st = os.stat(model_path(name))
+    with _cache_lock:
+        entry = _read_cache().get(name)
+        if entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+            return entry["sha256"]
+
+        digest = file_sha256(model_path(name))
+        _remember(name, digest)
+        return digest
+
+
+_warned_unpinned = set()
+
+
+def _warn_unpinned(name):
+    """Once per model and process: this file is not checked against a digest."""
+    if name in _warned_unpinned:
+        return
+    _warned_unpinned.add(name)
+    print(f"⚠️ WARNING: {name} has no sha256 pinned in {MANIFEST_PATH}; "
+          f"its contents are NOT verified (size check only). Commit the published "
+          f"sha256 / size to the manifest, or set MODEL_REQUIRE_PINNED=1 to refuse it.")
 
-        print(f"⬇️ Downloading {name}...")
-        r = requests.get(url, stream=True, timeout=300)
-        r.raise_for_status()
 
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
+def check_model(name):
+    """None when the installed model matches the manifest, else the problem."""
+    info = MODELS.get(name, {})
+    path = model_path(name)
+    if not os.path.exists(path):
+        return "missing"
+
+    size = os.path.getsize(path)
+    if info.get("size") is not None and size != info["size"]:
+        return f"size {size} != {info['size']}"
+    if info.get("size") is None and size < MIN_MODEL_BYTES:
+        return f"size {size} too small"
+
+    pinned = info.get("sha256")
+    if not pinned:
+        if REQUIRE_PINNED:
+            return "sha256 not pinned in manifest"
+        _warn_unpinned(name)
+        return None
+    if model_sha256(name) != pinned.lower():
+        return "sha256 mismatch"
+    return None
+
+
+def verify_models():
+    """
+    Startup check; downloads missing models unless MODEL_AUTO_DOWNLOAD=0.
+    Raises ModelStoreError listing the models that are missing or do not
+    match the manifest.
+    """
+    problems = {}
+    for name in MODELS:
+        problem = check_model(name)
+        if problem and AUTO_DOWNLOAD:
+            download_model(name)
+            problem = check_model(name)
+        if problem:
+            problems[name] = problem
+        else:
+            print(f"✅ {name} verified")
+
+    if problems:
+        details = ", ".join(f"{n}: {p}" for n, p in problems.items())
+        raise ModelStoreError(
+            f"Model store {MODEL_DIR} is not ready ({details}). Install the models with "
+            f"`python -m ml.download_models seed <models.tar.gz>` or, with network access, "
+            f"`python -m ml.download_models download`."
+        )
+
+
+# --------------------------------------------------
+# Installing
+# --------------------------------------------------
+def _install_stream(name, chunks):
+    """
+    Write chunks to a temporary file in MODEL_DIR, check size / sha256
+    against the manifest, then atomically rename into place.
+    """
+    info = MODELS.get(name, {})
+    if not info.get("sha256"):
+        if REQUIRE_PINNED:
+            raise ModelStoreError(
+                f"{name}: no sha256 pinned in {MANIFEST_PATH}; refusing to install an "
+                f"unverified file (MODEL_REQUIRE_PINNED=1)"
+            )
+        _warn_unpinned(name)
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    path = model_path(name)
+    tmp = f"{path}.{os.getpid()}.part"
+
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
                 if chunk:
                     f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        digest = h.hexdigest()
+        if info.get("sha256") and digest != info["sha256"].lower():
+            raise ModelStoreError(f"{name}: sha256 mismatch ({digest} != {info['sha256']})")
+        if info.get("size") is not None and size != info["size"]:
+            raise ModelStoreError(f"{name}: size mismatch ({size} != {info['size']})")
+        if size < MIN_MODEL_BYTES:
+            raise ModelStoreError(f"{name}: only {size} bytes")
+
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    # record the digest we just computed: no re-hash on the next start
+    with _cache_lock:
+        _remember(name, digest)
+    return digest
+
+
+def download_model(name):
+    import requests
+
+    print(f"⬇️ Downloading {name}...")
+    r = requests.get(MODELS[name]["url"], stream=True, timeout=300)
+    r.raise_for_status()
+    _install_stream(name, r.iter_content(chunk_size=1 << 20))
+    print(f"✅ Downloaded {name}")
+
+
+def download_missing():
+    for name in MODELS:
+        if check_model(name) is None:
+            print(f"✅ {name} verified")
+            continue
+        download_model(name)
+
+
+def seed_from_tarball(tar_path):
+    """Install every manifest model found in a .tar / .tar.gz (by file name)."""
+    import tarfile
+
+    installed = []
+    with tarfile.open(tar_path) as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name not in MODELS:
+                continue
+            f = tar.extractfile(member)
+            _install_stream(name, iter(lambda: f.read(1 << 20), b""))
+            installed.append(name)
+            print(f"✅ Installed {name}")
+
+    missing = [n for n in MODELS if check_model(n) is not None]
+    if missing:
+        raise ModelStoreError(f"Still missing after seeding: {', '.join(missing)}")
+    return installed
+
+
+def pin_manifest():
+    """Write sha256 / size of the installed models into the manifest."""
+    manifest = load_manifest()
+    for name in manifest:
+        if os.path.exists(model_path(name)):
+            manifest[name]["sha256"] = model_sha256(name)
+            manifest[name]["size"] = os.path.getsize(model_path(name))
+    tmp = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.write("\n")
+    os.replace(tmp, MANIFEST_PATH)
+    return manifest
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m ml.download_models")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status", help="verify the installed models")
+    seed = sub.add_parser("seed", help="install models from a tarball")
+    seed.add_argument("tarball")
+    sub.add_parser("download", help="download missing / corrupt models")
+    sub.add_parser("pin", help="record sha256 / size of installed models in the manifest")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "status":
+        print(f"Model store: {MODEL_DIR}")
+        for name in MODELS:
+            print(f"  {name}: {check_model(name) or 'ok'}")
+    elif args.cmd == "seed":
+        seed_from_tarball(args.tarball)
+    elif args.cmd == "download":
+        download_missing()
+    else:
+        for name, info in pin_manifest().items():
+            print(f"  {name}: {info['sha256']} ({info['size']} bytes)")
+
 
-        print(f"✅ Downloaded {name}")
+if __name__ == "__main__":
+    main()
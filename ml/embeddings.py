@@ -1,7 +1,7 @@
 # ml/embeddings.py
 # Handles loading the ONNX embedding model (EmbeddingModel)
 # and provides helper functions for computing embeddings
-# from images or folders.
+# from images and turning them into per-user templates.
 
 # ---------------------------------------------
 # Loads ArcFace/MobileFaceNet and returns embeddings
@@ -9,136 +9,261 @@
 # ONNX model expects NHWC
 # ---------------------------------------------
 
+import os
 import cv2
 import numpy as np
-import onnxruntime as ort
 from pathlib import Path
 
+from ml.inference_config import create_session
+from ml.download_models import MODEL_DIR, model_sha256
+
+
+# Bump when preprocess_batch changes (crop size, color order, scaling):
+# vectors computed before and after are not comparable.
+PREPROCESS_SIGNATURE = "112-rgb-nhwc-m127.5s128"
+
+# model store (MODEL_DIR), see ml/download_models.py
+MODELS_DIR = Path(MODEL_DIR)
+
+
+def model_version(model_name):
+    """
+    Version string stored with every template: model file name, content
+    hash and preprocessing signature. Templates of different versions are
+    never compared with each other.
+    """
+    return f"{model_name}:{model_sha256(model_name)[:12]}:{PREPROCESS_SIGNATURE}"
+
 
 class EmbeddingModel:
     def __init__(self, model_name="arcface.onnx"):
-        base_dir = Path(__file__).resolve().parents[1]
-        model_path = base_dir / "ml" / "models" / model_name
+        model_path = MODELS_DIR / model_name
 
         if not model_path.exists():
             raise FileNotFoundError(f"Embedding model not found: {model_path}")
 
-        self.session = ort.InferenceSession(
-            str(model_path),
-            providers=["CPUExecutionProvider"]
-        )
-        self.input_name = self.session.get_inputs()[0].name
+        self.model_name = model_name
+        self.version = model_version(model_name)
+
+        # thread counts, optimization level, cache: see ml/inference_config.py
+        self.session = create_session(model_path)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+
+        # models exported with a fixed batch size (usually 1) are run in chunks
+        batch = model_input.shape[0]
+        self.max_batch = batch if isinstance(batch, int) and batch > 0 else None
 
         # 🔍 Debug once (optional)
-        print("Embedding model input shape:", self.session.get_inputs()[0].shape)
+        print("Embedding model input shape:", model_input.shape)
 
     def preprocess(self, face):
         """
         face: 112x112 BGR aligned
         output: NHWC float32 normalized
         """
+        return self.preprocess_batch([face])
 
-        face = cv2.resize(face, (112, 112))
-        face = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
+    def preprocess_batch(self, faces):
+        """
+        faces: list of 112x112 BGR aligned crops
+        output: (N, 112, 112, 3) NHWC float32 normalized
+        """
+        crops = [
+            f if f.shape[:2] == (112, 112) else cv2.resize(f, (112, 112))
+            for f in faces
+        ]
+        batch = np.stack(crops)[..., ::-1]          # BGR -> RGB
 
-        face = face.astype(np.float32)
-        face = (face - 127.5) / 128.0   # ArcFace standard [-1, 1]
+        batch = batch.astype(np.float32)
+        batch = (batch - 127.5) / 128.0   # ArcFace standard [-1, 1]
 
         # ✅ KEEP NHWC
-        face = np.expand_dims(face, axis=0)  # (1, 112, 112, 3)
+        return batch
 
-        return face
+    def get_embeddings(self, faces):
+        """
+        Batched inference: one session.run per chunk instead of per face.
+        Returns (N, D) float32 L2-normalized rows; a row is all zeros
+        when the model produced a degenerate (zero-norm) embedding.
+        """
+        if len(faces) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
 
-    def get_embedding(self, face):
-        try:
-            inp = self.preprocess(face)
+        inp = self.preprocess_batch(faces)
 
-            emb = self.session.run(
-                None,
-                {self.input_name: inp}
-            )[0]
+        step = self.max_batch or len(inp)
+        outs = [
+            self.session.run(None, {self.input_name: inp[i:i + step]})[0]
+            for i in range(0, len(inp), step)
+        ]
+        embs = np.concatenate(outs).reshape(len(inp), -1).astype(np.float32)
 
-            emb = emb.flatten()
+        # L2-normalize → important for matching
+        norms = np.linalg.norm(embs, axis=1, keepdims=True)
+        return np.divide(embs, norms, out=np.zeros_like(embs), where=norms > 0)
 
-            # L2-normalize → important for matching
-            norm = np.linalg.norm(emb)
-            if norm == 0:
+    def get_embedding(self, face):
+        try:
+            emb = self.get_embeddings([face])[0]
+            if not emb.any():
                 return None
-
-            return emb / norm
+            return emb
 
         except Exception as e:
             print("Embedding error:", e)
             return None
 
 
-# Used by the API
+# Used by the API (shared instance, see ml/registry.py)
 def get_embedding_model():
-    return EmbeddingModel("arcface.onnx")
+    from ml.registry import get_embedder
+    return get_embedder()
+
+
+# ----------------------------------
+# 🔑 QUALITY GATE (VERY IMPORTANT)
+# ----------------------------------
+MIN_VALID_FACES = 2
+
+# Templates kept per user; larger enrollments are reduced to k-means centroids
+MAX_TEMPLATES = int(os.environ.get("MAX_TEMPLATES", 8))
+
+
+# Bulk pipeline knobs (approve-all / re-embed-all)
+BULK_DETECT_BATCH = int(os.environ.get("BULK_DETECT_BATCH", 8))     # frames per SCRFD run
+BULK_EMBED_BATCH = int(os.environ.get("BULK_EMBED_BATCH", 64))      # faces per ArcFace run
+BULK_DECODE_THREADS = int(os.environ.get("BULK_DECODE_THREADS", 4))  # JPEG decoding ahead
+
+IMAGE_EXTS = (".jpg", ".png", ".jpeg")
+
+
+def list_images(folder_path):
+    """Face image paths in a folder, sorted by name."""
+    return [
+        os.path.join(folder_path, f)
+        for f in sorted(os.listdir(folder_path))
+        if f.lower().endswith(IMAGE_EXTS)
+    ]
+
+
+def _read_images(paths, threads=BULK_DECODE_THREADS, ahead=None):
+    """Yields decoded images in order, decoding up to `ahead` in parallel."""
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    ahead = ahead or max(threads, 2 * BULK_DETECT_BATCH)
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        pending = deque()
+        it = iter(paths)
+        for path in it:
+            pending.append(pool.submit(cv2.imread, path))
+            if len(pending) >= ahead:
+                break
+        while pending:
+            img = pending.popleft().result()
+            for path in it:
+                pending.append(pool.submit(cv2.imread, path))
+                break
+            yield img
 
 
 # ------------------------------------------------------
-# Compute mean embedding for a folder of aligned images
+# Per-image embeddings for many groups of images at once
 # ------------------------------------------------------
-def compute_folder_embedding(folder_path):
+def embed_image_groups(groups, conf_threshold=0.45, on_images=None, model=None):
     """
-    folder_path: str, path to folder containing face images
+    groups: list of lists of image paths (one list per user / folder)
+    on_images: optional callback(n) after every n images processed
+    model: EmbeddingModel to use (default: the shared one)
     Returns:
-        mean embedding (np.ndarray of shape (512,))
-        OR None if failed
+        list of (N_i, 512) np.ndarray, one L2-normalized row per usable
+        image of group i (N_i may be 0)
+
+    Images are decoded ahead in a thread pool, detected BULK_DETECT_BATCH
+    at a time (one session.run when the SCRFD export is batched) and the
+    aligned faces of every group go through ArcFace BULK_EMBED_BATCH at a time.
     """
-    import os
     from ml.face_align import align_face
-    from ml.scrfd_detector import SCRFDDetector
-
-    model = get_embedding_model()
-    detector = SCRFDDetector()
-
-    embeddings = []
-
-    for file in sorted(os.listdir(folder_path)):
-        if not file.lower().endswith((".jpg", ".png", ".jpeg")):
-            continue
-
-        path = os.path.join(folder_path, file)
-        img = cv2.imread(path)
+    from ml.registry import get_detector, get_embedder
+
+    model = model or get_embedder()
+    detector = get_detector()
+
+    flat = [(g, path) for g, paths in enumerate(groups) for path in paths]
+    aligned_faces, owners = [], []
+    frames, frame_owners = [], []
+
+    def flush():
+        for img, owner, faces in zip(frames, frame_owners,
+                                     detector.detect_batch(frames, conf_threshold=conf_threshold)):
+            if len(faces) == 0:
+                continue
+            best = max(faces, key=lambda x: x["score"])
+            try:
+                aligned = align_face(img, best["kps"])
+            except:
+                continue
+            if aligned is None:
+                continue
+            aligned_faces.append(aligned)
+            owners.append(owner)
+        if on_images:
+            on_images(len(frames))
+        frames.clear()
+        frame_owners.clear()
+
+    for (g, _), img in zip(flat, _read_images([path for _, path in flat])):
         if img is None:
+            if on_images:
+                on_images(1)
             continue
+        frames.append(img)
+        frame_owners.append(g)
+        if len(frames) >= BULK_DETECT_BATCH:
+            flush()
+    if frames:
+        flush()
 
-        faces = detector.detect(img, conf_threshold=0.45)
-        if len(faces) == 0:
-            continue
+    empty = np.zeros((0, 0), dtype=np.float32)
+    if not aligned_faces:
+        return [empty for _ in groups]
 
-        best = max(faces, key=lambda x: x["score"])
-        kps = best["kps"]
+    # inference errors propagate: the job fails (or retries) with the real
+    # error instead of reporting every user as a low-quality enrollment
+    embs = np.concatenate([
+        model.get_embeddings(aligned_faces[i:i + BULK_EMBED_BATCH])
+        for i in range(0, len(aligned_faces), BULK_EMBED_BATCH)
+    ])
 
-        try:
-            aligned = align_face(img, kps)
-            print("Aligned shape:", aligned.shape)
-        except:
-            continue
+    owners = np.asarray(owners)
+    usable = embs.any(axis=1)
+    return [embs[(owners == g) & usable] for g in range(len(groups))]
 
-        emb = model.get_embedding(aligned)
-        if emb is None:
-            continue
 
-        embeddings.append(emb)
+# ------------------------------------------------------
+# Multiple templates per user (lighting / pose variation)
+# ------------------------------------------------------
+def reduce_templates(embeddings, max_templates=MAX_TEMPLATES):
+    """
+    Keeps every embedding when there are at most max_templates of them,
+    otherwise returns k-means centroids (re-normalized).
+    """
+    if len(embeddings) <= max_templates:
+        return embeddings.astype(np.float32)
+
+    from sklearn.cluster import KMeans
+
+    km = KMeans(n_clusters=max_templates, n_init=4, random_state=0)
+    km.fit(embeddings)
+    centers = km.cluster_centers_.astype(np.float32)
+    return centers / (np.linalg.norm(centers, axis=1, keepdims=True) + 1e-6)
 
-    # if len(embeddings) == 0:
-    #     return None
-    
-    
-    # ----------------------------------
-    # 🔑 QUALITY GATE (VERY IMPORTANT)
-    # ----------------------------------
-    MIN_VALID_FACES = 2
 
+def templates_from_embeddings(embeddings, max_templates=MAX_TEMPLATES):
+    """Quality gate + template reduction for one user's per-image embeddings."""
     if len(embeddings) < MIN_VALID_FACES:
         print(f"❌ Not enough good faces for embedding: {len(embeddings)} found")
         return None
 
-    emb_mat = np.vstack(embeddings)
-    mean_emb = emb_mat.mean(axis=0)
-
-    # normalize again
-    return mean_emb / (np.linalg.norm(mean_emb) + 1e-6)
+    return reduce_templates(embeddings, max_templates)
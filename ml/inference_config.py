@@ -0,0 +1,116 @@
+# ml/inference_config.py
+# ---------------------------------------------
+# Central ONNX Runtime configuration for every model we load.
+#
+# Under gunicorn each worker owns its own sessions; by default every
+# session spawns one intra-op thread per core, so N workers oversubscribe
+# the CPU N times. Defaults here split the cores across workers
+# (WEB_CONCURRENCY, as set by gunicorn / most PaaS) and everything can be
+# overridden per deployment:
+#
+#   ORT_INTRA_OP_THREADS     threads inside one operator   (default: cores / workers)
+#   ORT_INTER_OP_THREADS     threads across operators      (default: 1)
+#   ORT_EXECUTION_MODE       sequential | parallel         (default: sequential)
+#   ORT_GRAPH_OPT_LEVEL      disable | basic | extended | all  (default: all)
+#   ORT_ENABLE_MEM_ARENA     1 | 0                         (default: 1)
+#   ORT_OPTIMIZED_MODEL_DIR  where optimized graphs are cached (default: off)
+#   ORT_PROVIDERS            comma separated provider list (default: CPUExecutionProvider)
+# ---------------------------------------------
+
+import os
+from pathlib import Path
+import onnxruntime as ort
+
+_GRAPH_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def default_intra_op_threads():
+    workers = max(1, _env_int("WEB_CONCURRENCY", 1))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def get_providers():
+    raw = os.environ.get("ORT_PROVIDERS", "")
+    providers = [p.strip() for p in raw.split(",") if p.strip()]
+    return providers or ["CPUExecutionProvider"]
+
+
+def get_session_options():
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = _env_int("ORT_INTRA_OP_THREADS", default_intra_op_threads())
+    so.inter_op_num_threads = _env_int("ORT_INTER_OP_THREADS", 1)
+
+    mode = os.environ.get("ORT_EXECUTION_MODE", "sequential").lower()
+    so.execution_mode = _EXECUTION_MODES.get(mode, ort.ExecutionMode.ORT_SEQUENTIAL)
+
+    level = os.environ.get("ORT_GRAPH_OPT_LEVEL", "all").lower()
+    so.graph_optimization_level = _GRAPH_LEVELS.get(level, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+
+    so.enable_cpu_mem_arena = os.environ.get("ORT_ENABLE_MEM_ARENA", "1") == "1"
+    return so
+
+
+def _optimized_model_path(model_path: Path):
+    """
+    Cache file for the optimized graph of model_path, or None when caching
+    is off. The name carries the source size/mtime and the optimization
+    level so a replaced model or a changed level never reuses a stale graph.
+    """
+    cache_dir = os.environ.get("ORT_OPTIMIZED_MODEL_DIR")
+    if not cache_dir:
+        return None
+    st = model_path.stat()
+    level = os.environ.get("ORT_GRAPH_OPT_LEVEL", "all").lower()
+    name = f"{model_path.stem}.{st.st_size}-{st.st_mtime_ns}.{level}.onnx"
+    return Path(cache_dir) / name
+
+
+def create_session(model_path, providers=None):
+    """
+    Build an InferenceSession for model_path with the deployment-wide
+    options. With ORT_OPTIMIZED_MODEL_DIR set, the first process saves the
+    optimized graph and later cold starts load it with optimization off.
+    """
+    model_path = Path(model_path)
+    providers = providers or get_providers()
+    so = get_session_options()
+
+    cached = _optimized_model_path(model_path)
+    if cached is not None and cached.exists():
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return ort.InferenceSession(str(cached), sess_options=so, providers=providers)
+        except Exception as e:
+            print("Optimized model cache unusable, rebuilding:", e)
+            so = get_session_options()
+
+    if cached is None:
+        return ort.InferenceSession(str(model_path), sess_options=so, providers=providers)
+
+    # workers may start together: write to a private name, then rename
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    so.optimized_model_filepath = str(tmp)
+    session = ort.InferenceSession(str(model_path), sess_options=so, providers=providers)
+    try:
+        os.replace(tmp, cached)
+    except OSError as e:
+        print("Could not save optimized model:", e)
+    return session
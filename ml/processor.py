@@ -1,156 +1,357 @@
 # ml/processor.py
 # ---------------------------------------------------------
 # Finalizes pending enrollment:
-#   - moves pending images → dataset/<name>
 #   - detects faces + aligns each face
-#   - computes embedding for each face (ArcFace 112x112)
-#   - averages all embeddings → final per-user embedding
-#   - inserts user + embedding into DB
+#   - computes embedding templates (ArcFace 112x112)
+#   - copies pending images → dataset/<name>__u<id>
+#   - inserts user + templates into DB
 # ---------------------------------------------------------
 
 from pathlib import Path
+import os
 import shutil
 import json
-import numpy as np
-import cv2
 import time
+import uuid
+from datetime import datetime
 
 from database.db import db_conn
-from utils.file_utils import sanitize_name, ensure_dir, remove_dir
-from ml.embeddings import EmbeddingModel
-from ml.scrfd_detector import SCRFDDetector
-from ml.face_align import align_face
+from utils.file_utils import sanitize_name, ensure_dir, safe_rmtree
+from ml.embeddings import embed_image_groups, list_images, templates_from_embeddings
+from services.quantization import quantized_columns
+from services.embedding_service import active_embedder
+from services.model_version import ACTIVE_VERSION_KEY, get_setting
+from services.job_queue import TransientJobError
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 PENDING_DIR = BASE_DIR / "storage" / "pending"
 DATASET_DIR = BASE_DIR / "storage" / "dataset"
 
 # ---------------------------------------------
-# Compute embedding for a folder of images
+# APPROVE PENDING ENROLLMENT
+# (runs in a background job, see services/jobs.py)
 # ---------------------------------------------
-def compute_folder_embedding(folder_path: str):
-    model = EmbeddingModel()                 # ArcFace ONNX
-    detector = SCRFDDetector()               # SCRFD face detector
+FACE_QUALITY_TIPS = [
+    "Ensure face is well-lit",
+    "Look straight at camera",
+    "Do not move while capturing",
+    "Keep face close to camera"
+]
 
-    embeddings = []
+# users per chunk in bulk operations (one inference pass + one commit each)
+BULK_CHUNK_USERS = int(os.environ.get("BULK_CHUNK_USERS", 32))
 
-    for img_path in sorted(Path(folder_path).glob("*.jpg")):
-        img = cv2.imread(str(img_path))
-        if img is None:
-            continue
 
-        detections = detector.detect(img)
-        if not detections:
-            continue
+def _face_quality_error():
+    return {
+        "error": "face_quality_low",
+        "message": "Face images are too blurry / dark / unclear. Please re-enroll with better lighting and camera stability.",
+        "tips": FACE_QUALITY_TIPS
+    }
 
-        # pick the highest-score detection
-        det = max(detections, key=lambda d: d["score"])
-        kps = det["kps"]
 
-        if len(kps) != 5:
-            continue
+def _load_pending(pending_ids=None):
+    """
+    Pending rows (all when pending_ids is None) with their image lists.
+    Returns (ready, errors): ready = [(row, [image paths])],
+    errors = [{"pending_id", "error"}]. Rows whose folder is gone are deleted.
+    """
+    conn = db_conn()
+    cur = conn.cursor()
+    if pending_ids is None:
+        cur.execute("SELECT id, name, temp_folder FROM pending_enrollments ORDER BY id")
+        rows = cur.fetchall()
+    else:
+        rows = []
+        for i in range(0, len(pending_ids), 500):
+            chunk = list(pending_ids[i:i + 500])
+            cur.execute(
+                f"SELECT id, name, temp_folder FROM pending_enrollments "
+                f"WHERE id IN ({','.join('?' * len(chunk))}) ORDER BY id",
+                chunk
+            )
+            rows.extend(cur.fetchall())
+        found = {r["id"] for r in rows}
+    conn.close()
 
-        aligned = align_face(img, kps)
-        if aligned is None:
-            continue
+    errors = []
+    if pending_ids is not None:
+        errors = [{"pending_id": pid, "error": "pending not found"}
+                  for pid in pending_ids if pid not in found]
 
-        emb = model.get_embedding(aligned)
-        if emb is None:
+    ready, missing = [], []
+    for row in rows:
+        temp_folder = Path(row["temp_folder"])
+        if not temp_folder.exists():
+            missing.append(row["id"])
+            errors.append({"pending_id": row["id"], "error": "pending folder missing"})
             continue
+        images = [str(p) for p in sorted(temp_folder.glob("*.*")) if p.is_file()]
+        if not images:
+            errors.append({"pending_id": row["id"], "error": "no images"})
+            continue
+        ready.append((row, images))
 
-        embeddings.append(emb.flatten())
+    if missing:
+        conn = db_conn()
+        conn.executemany("DELETE FROM pending_enrollments WHERE id=?", [(pid,) for pid in missing])
+        conn.commit()
+        conn.close()
 
-    if not embeddings:
-        return None
+    return ready, errors
 
-    # average all embeddings → consistent 512-D vector
-    final_emb = np.mean(np.array(embeddings), axis=0)
-    norm = np.linalg.norm(final_emb)
-    if norm == 0:
-        return None
-    return final_emb / norm
 
+def _insert_templates(cur, user_id, templates, created_at, model_version):
+    cur.executemany(
+        "INSERT INTO user_embeddings "
+        "(user_id, embedding, created_at, embedding_q, embedding_q_dtype, model_version) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (user_id, t.astype("float32").tobytes(), created_at, *quantized_columns(t), model_version)
+            for t in templates
+        ]
+    )
+
+
+def _save_approvals(items, model_version):
+    """
+    items: [(pending row, [image paths], templates)]
+    model_version: version of the model that computed the templates; if
+    another model became active meanwhile, nothing is saved and
+    TransientJobError is raised (the retry embeds with the new model).
+    Copies every user's images into a staging folder, then one short
+    transaction creates the users, their folders and their templates.
+    Each pending row is deleted first in that transaction: a row another
+    job already approved (or an admin removed) is skipped, so one pending
+    enrollment never becomes two users.
+    Raises OSError on filesystem failures (nothing is committed then and
+    the pending images are kept, so the job can simply be retried).
+    Returns (one result dict per approved item, pending ids skipped).
+    """
+    # ------------------------------------------------
+    # 1️⃣ Copy images into staging folders (no DB lock held)
+    # ------------------------------------------------
+    staged = []
+    try:
+        for row, images, templates in items:
+            safe_name = sanitize_name(row["name"]) or "user"
+            # unique per call: two jobs may stage the same pending row
+            staging = ensure_dir(DATASET_DIR / f"{safe_name}__pending{row['id']}_{uuid.uuid4().hex[:8]}")
+            staged.append(staging)
+            for i, src in enumerate(images):
+                shutil.copy2(src, str(staging / f"{i}{Path(src).suffix}"))
+    except OSError:
+        for staging in staged:
+            safe_rmtree(staging)
+        raise
+
+    # ------------------------------------------------
+    # 2️⃣ One short transaction: users, folders, templates
+    # ------------------------------------------------
+    created_at = int(time.time())
+    created_at_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    finals = []
+    saved, gone = [], []
 
-# ---------------------------------------------
-# APPROVE PENDING ENROLLMENT
-# ---------------------------------------------
-def process_pending_approve(pending_id):
     conn = db_conn()
     cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        for (row, images, templates), staging in zip(items, staged):
+            # claim the pending row first (write lock held until commit)
+            cur.execute("DELETE FROM pending_enrollments WHERE id=?", (row["id"],))
+            if cur.rowcount != 1:
+                gone.append(row["id"])
+                continue
+            saved.append(row)
+            cur.execute(
+                "INSERT INTO users (name, folder, created_at) VALUES (?, ?, ?)",
+                (row["name"], str(staging), created_at_str)
+            )
+            user_id = cur.lastrowid
 
-    cur.execute(
-        "SELECT id, name, temp_folder FROM pending_enrollments WHERE id=?",
-        (pending_id,)
-    )
-    row = cur.fetchone()
-
-    if not row:
-        conn.close()
-        return False, "pending not found"
+            safe_name = sanitize_name(row["name"]) or "user"
+            final_dest = DATASET_DIR / f"{safe_name}__u{user_id}"
+            staging.rename(final_dest)
+            finals.append(final_dest)
+            for i, src in enumerate(images):
+                suffix = Path(src).suffix
+                (final_dest / f"{i}{suffix}").rename(final_dest / f"u{user_id}_{created_at}_{i}{suffix}")
 
-    name = row["name"]
-    temp_folder = Path(row["temp_folder"])
+            cur.execute("UPDATE users SET folder=? WHERE id=?", (str(final_dest), user_id))
+            _insert_templates(cur, user_id, templates, created_at, model_version)
+            results.append({
+                "pending_id": row["id"],
+                "user_id": user_id,
+                "name": row["name"],
+                "folder": final_dest.name,
+                "templates": len(templates)
+            })
 
-    if not temp_folder.exists():
-        # cleanup DB row
-        cur.execute("DELETE FROM pending_enrollments WHERE id=?", (pending_id,))
+        # write lock is held now: a model switchover cannot slip in between
+        if get_setting(cur, ACTIVE_VERSION_KEY) != model_version:
+            raise TransientJobError("embedding model changed during approval")
         conn.commit()
+    except Exception:
+        conn.rollback()
+        for folder in finals + staged:
+            safe_rmtree(folder)
+        raise
+    finally:
         conn.close()
-        return False, "pending folder missing"
-
-    # safe destination
-    safe_name = sanitize_name(name)
-    dest = ensure_dir(DATASET_DIR / safe_name)
-
-    # move images from pending → dataset
-    moved = False
-    for src in sorted(temp_folder.glob("*.jpg")):
-        try:
-            shutil.move(str(src), str(dest / src.name))
-            moved = True
-        except:
-            try:
-                shutil.copy(str(src), str(dest / src.name))
-                moved = True
-            except:
-                pass
-
-    if not moved:
-        conn.close()
-        return False, "no images moved"
 
-    # compute final user embedding
-    emb = compute_folder_embedding(str(dest))
-    if emb is None:
-        conn.close()
-        return False, "could not compute embeddings"
+    # ------------------------------------------------
+    # 3️⃣ Remove pending folders (SAFE)
+    # ------------------------------------------------
+    # staging copies of rows someone else approved are not needed
+    for (row, _, _), staging in zip(items, staged):
+        if row["id"] in gone:
+            safe_rmtree(staging)
+    for row in saved:
+        if not safe_rmtree(Path(row["temp_folder"])):
+            print("WARNING: Pending folder could not be deleted:", row["temp_folder"])
 
-    # insert user
-    cur.execute(
-        "INSERT INTO users (name, folder) VALUES (?, ?)",
-        (name, str(dest))
-    )
-    user_id = cur.lastrowid
-
-    # store embedding as JSON
-    # emb_list = emb.astype(float).tolist()
-    
-    emb_bytes = emb.astype("float32").tobytes()
-    created_at = int(time.time())  # current UNIX timestamp
-
-    cur.execute(
-    "INSERT INTO user_embeddings (user_id, embedding, created_at) VALUES (?, ?, ?)",
-    (user_id, emb_bytes, created_at)
-)
-
-    # cleanup pending
-    cur.execute("DELETE FROM pending_enrollments WHERE id=?", (pending_id,))
-    conn.commit()
+    return results, gone
+
+
+def process_pending_approve(pending_id, progress=None):
+    """
+    Approve one pending enrollment:
+      embeddings are computed from the pending folder first, then one short
+      write transaction creates the user, its folder and its templates.
+
+    Returns (True, {...user info}) or (False, {"error": ...}).
+    Raises OSError on filesystem failures (the job queue retries those).
+    """
+    progress = progress or (lambda *a, **k: None)
+
+    ready, errors = _load_pending([pending_id])
+    if not ready:
+        return False, {"error": errors[0]["error"]}
+    row, images = ready[0]
+
+    progress(0, 2, "computing embeddings")
+    model = active_embedder()
+    templates = templates_from_embeddings(embed_image_groups([images], model=model)[0])
+    if templates is None:
+        return False, _face_quality_error()
+
+    progress(1, 2, "saving user")
+    results, gone = _save_approvals([(row, images, templates)], model.version)
+    if gone:
+        return False, {"error": "pending already approved"}
+    progress(2, 2, "approved")
+    return True, results[0]
+
+
+# ---------------------------------------------
+# BULK OPERATIONS (approve many / re-embed all)
+# ---------------------------------------------
+class _Throughput:
+    """Counts processed images and reports progress as images/sec."""
+
+    def __init__(self, total, progress):
+        self.total = total
+        self.done = 0
+        self.progress = progress or (lambda *a, **k: None)
+        self.t0 = time.perf_counter()
+
+    def rate(self):
+        return self.done / max(time.perf_counter() - self.t0, 1e-9)
+
+    def add(self, n):
+        self.done += n
+        self.progress(self.done, self.total, f"{self.done}/{self.total} images, {self.rate():.1f} images/s")
+
+    def summary(self):
+        seconds = time.perf_counter() - self.t0
+        print(f"⏱ {self.done} images in {seconds:.1f}s ({self.rate():.1f} images/s)")
+        return {"images": self.done, "seconds": round(seconds, 2), "images_per_sec": round(self.rate(), 2)}
+
+
+def process_pending_bulk(pending_ids=None, progress=None, chunk=BULK_CHUNK_USERS):
+    """
+    Approve many pending enrollments (all when pending_ids is None).
+    Every chunk of users goes through batched detection / embedding and
+    is committed in one transaction.
+    """
+    ready, failed = _load_pending(pending_ids)
+    meter = _Throughput(sum(len(images) for _, images in ready), progress)
+    approved = []
+    model = active_embedder()
+
+    for i in range(0, len(ready), chunk):
+        part = ready[i:i + chunk]
+        embeddings = embed_image_groups([images for _, images in part], on_images=meter.add, model=model)
+
+        items = []
+        for (row, images), embs in zip(part, embeddings):
+            templates = templates_from_embeddings(embs)
+            if templates is None:
+                failed.append(dict(_face_quality_error(), pending_id=row["id"]))
+                continue
+            items.append((row, images, templates))
+
+        if items:
+            saved, gone = _save_approvals(items, model.version)
+            approved.extend(saved)
+            failed.extend({"pending_id": pid, "error": "pending already approved"} for pid in gone)
+
+    return dict(meter.summary(), approved=approved, failed=failed)
+
+
+def reembed_users(user_ids=None, progress=None, model=None, chunk=BULK_CHUNK_USERS):
+    """
+    Recompute users' templates (all when user_ids is None) from
+    storage/dataset with model (default: the active one), replacing only
+    that model version's rows. Used after a model upgrade / by the online
+    migration (services/model_version.py). Users whose folder yields too
+    few good faces keep their current templates. One transaction per
+    chunk of users.
+    """
+    model = model or active_embedder()
+
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT id, name, folder FROM users ORDER BY id")
+    users = cur.fetchall()
     conn.close()
+    if user_ids is not None:
+        wanted = set(user_ids)
+        users = [row for row in users if row["id"] in wanted]
 
-    try:
-        remove_dir(temp_folder)
-    except:
-        pass
+    ready, skipped = [], []
+    for row in users:
+        folder = Path(row["folder"] or "")
+        images = list_images(str(folder)) if row["folder"] and folder.is_dir() else []
+        if images:
+            ready.append((row, images))
+        else:
+            skipped.append({"user_id": row["id"], "error": "no images"})
+
+    meter = _Throughput(sum(len(images) for _, images in ready), progress)
+    updated = 0
+
+    for i in range(0, len(ready), chunk):
+        part = ready[i:i + chunk]
+        embeddings = embed_image_groups([images for _, images in part], on_images=meter.add, model=model)
+        created_at = int(time.time())
+
+        conn = db_conn()
+        cur = conn.cursor()
+        for (row, _), embs in zip(part, embeddings):
+            templates = templates_from_embeddings(embs)
+            if templates is None:
+                skipped.append({"user_id": row["id"], "error": "face_quality_low"})
+                continue
+            cur.execute(
+                "DELETE FROM user_embeddings WHERE user_id=? AND model_version IS ?",
+                (row["id"], model.version)
+            )
+            _insert_templates(cur, row["id"], templates, created_at, model.version)
+            updated += 1
+        conn.commit()
+        conn.close()
 
-    return True, {"user_id": user_id, "name": name}
+    return dict(meter.summary(), updated=updated, skipped=skipped, model_version=model.version)
@@ -0,0 +1,54 @@
+# ml/registry.py
+# ---------------------------------------------
+# Process-wide model registry.
+# Owns one lazily created SCRFD detector and the ArcFace embedder(s),
+# shared by every caller (recognition, approvals, re-embedding).
+# ONNX Runtime sessions are safe to run from several threads, and the
+# detector keeps its preprocessing buffers per thread.
+# ---------------------------------------------
+
+import os
+import threading
+
+_lock = threading.Lock()
+_detector = None
+_embedders = {}
+
+DEFAULT_EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "arcface.onnx")
+
+
+def get_detector():
+    """Shared SCRFDDetector (loaded on first use)."""
+    global _detector
+    if _detector is None:
+        with _lock:
+            if _detector is None:
+                from ml.scrfd_detector import SCRFDDetector
+
+                # SCRFD_INPUT_SIZE=320/480 suits kiosk cameras where faces are large
+                _detector = SCRFDDetector(
+                    input_size=int(os.environ.get("SCRFD_INPUT_SIZE", 640)),
+                    letterbox=os.environ.get("SCRFD_LETTERBOX", "0") == "1",
+                )
+    return _detector
+
+
+def get_embedder(model_name=None):
+    """
+    Shared EmbeddingModel for model_name (loaded on first use).
+    Default: EMBEDDING_MODEL. The model actually serving recognition is
+    the active one recorded in the DB (services.embedding_service.active_embedder);
+    several can be loaded side by side while an upgrade re-embeds the
+    gallery (services/model_version.py).
+    """
+    model_name = model_name or DEFAULT_EMBEDDING_MODEL
+    model = _embedders.get(model_name)
+    if model is None:
+        with _lock:
+            model = _embedders.get(model_name)
+            if model is None:
+                from ml.embeddings import EmbeddingModel
+
+                model = EmbeddingModel(model_name)
+                _embedders[model_name] = model
+    return model
@@ -10,33 +10,55 @@
 """
 Production-ready SCRFD ONNX wrapper with decoding, scaling and NMS.
 
-Place model at: <project_root>/ml/models/scrfd_2.5g_bnkps.onnx
+Place model at: <MODEL_DIR>/scrfd_2.5g_bnkps.onnx (default <project_root>/ml/models/)
 Usage:
     from ml.scrfd_detector import SCRFDDetector
     det = SCRFDDetector()
     results = det.detect(img, conf_threshold=0.45, iou_thresh=0.4)
     # results: list of {"box": (x,y,w,h), "score": float, "kps": [(x,y),...5]}
+    batch_results = det.detect_batch([img1, img2, ...])   # one list per image
 """
 
 from pathlib import Path
+import threading
 import numpy as np
-import onnxruntime as ort
 import cv2
 from typing import List, Dict, Tuple
 
-def _iou(boxA, boxB):
-    # box: (x1,y1,x2,y2)
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-    interW = max(0, xB - xA)
-    interH = max(0, yB - yA)
-    interArea = interW * interH
-    areaA = max(0, boxA[2] - boxA[0]) * max(0, boxA[3] - boxA[1])
-    areaB = max(0, boxB[2] - boxB[0]) * max(0, boxB[3] - boxB[1])
+from ml.inference_config import create_session
+from ml.download_models import MODEL_DIR
+
+def _iou(box, boxes):
+    """
+    IoU of one box against many.
+    box: (4,) x1,y1,x2,y2 ; boxes: (N,4) x1,y1,x2,y2 ; returns (N,) float
+    """
+    xA = np.maximum(box[0], boxes[:, 0])
+    yA = np.maximum(box[1], boxes[:, 1])
+    xB = np.minimum(box[2], boxes[:, 2])
+    yB = np.minimum(box[3], boxes[:, 3])
+    interArea = np.maximum(0, xB - xA) * np.maximum(0, yB - yA)
+    areaA = max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+    areaB = np.maximum(0, boxes[:, 2] - boxes[:, 0]) * np.maximum(0, boxes[:, 3] - boxes[:, 1])
     denom = areaA + areaB - interArea
-    return 0.0 if denom <= 0 else interArea / denom
+    return np.where(denom > 0, interArea / np.maximum(denom, 1e-12), 0.0)
+
+def nms_indices(boxes: np.ndarray, scores: np.ndarray, iou_thresh: float = 0.4) -> np.ndarray:
+    """
+    boxes: (N,4) x1,y1,x2,y2 ; scores: (N,)
+    returns indices of kept boxes, highest score first
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boxes = np.asarray(boxes, dtype=np.float64)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while len(order):
+        cur = order[0]
+        keep.append(cur)
+        rest = order[1:]
+        order = rest[_iou(boxes[cur], boxes[rest]) < iou_thresh]
+    return np.asarray(keep, dtype=np.int64)
 
 def nms_boxes(boxes: List[Tuple[int,int,int,int,float]], iou_thresh: float = 0.4):
     """
@@ -45,41 +67,102 @@ def nms_boxes(boxes: List[Tuple[int,int,int,int,float]], iou_thresh: float = 0.4
     """
     if not boxes:
         return []
-    boxes = sorted(boxes, key=lambda b: b[4], reverse=True)
-    keep = []
-    while boxes:
-        cur = boxes.pop(0)
-        keep.append(cur)
-        boxes = [b for b in boxes if _iou((cur[0],cur[1],cur[2],cur[3]), (b[0],b[1],b[2],b[3])) < iou_thresh]
-    return keep
+    arr = np.asarray(boxes, dtype=np.float64)
+    keep = nms_indices(arr[:, :4], arr[:, 4], iou_thresh=iou_thresh)
+    return [boxes[i] for i in keep]
 
 class SCRFDDetector:
-    def __init__(self, model_name: str = "scrfd_2.5g_bnkps.onnx", input_size: int = 640, providers=None):
+    def __init__(self, model_name: str = "scrfd_2.5g_bnkps.onnx", input_size: int = 640, providers=None,
+                 letterbox: bool = False):
         """
-        model_name: filename placed under project_root/ml/models/
-        input_size: SCRFD model input size (most ONNX scrfd models use 640)
+        model_name: filename placed in the model store (MODEL_DIR, default ml/models/)
+        input_size: SCRFD model input size (most ONNX scrfd models use 640;
+                    dynamic-shape exports also run at 320/480, which is
+                    2-4x cheaper when faces are large, e.g. kiosk cameras)
+        letterbox: keep the aspect ratio (pad bottom/right) instead of
+                   stretching the frame to a square
         """
-        base_dir = Path(__file__).resolve().parents[1]  # project_root
-        model_path = base_dir / "ml" / "models" / model_name
+        model_path = Path(MODEL_DIR) / model_name      # model store, see ml/download_models.py
 
         if not model_path.exists():
             raise FileNotFoundError(f"SCRFD model not found: {model_path}")
 
-        providers = providers or ["CPUExecutionProvider"]
-        self.session = ort.InferenceSession(str(model_path), providers=providers)
-        self.input_name = self.session.get_inputs()[0].name
+        # thread counts, optimization level, cache: see ml/inference_config.py
+        self.session = create_session(model_path, providers=providers)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
         self.input_size = int(input_size)
+        self.letterbox = bool(letterbox)
+
+        # fixed-shape exports only accept their own input size
+        fixed = model_input.shape[2] if len(model_input.shape) == 4 else None
+        if isinstance(fixed, int) and fixed != self.input_size:
+            print(f"SCRFD model has fixed input {fixed}, ignoring input_size={self.input_size}")
+            self.input_size = fixed
+
+        # exports with a batch axis (outputs [B, N, C]) take several frames
+        # per run; others (outputs [N, C]) are run one frame at a time
+        batch = model_input.shape[0]
+        self.batched = len(self.session.get_outputs()[0].shape) == 3 and \
+            not (isinstance(batch, int) and batch == 1)
+
         # SCRFD typically uses three strides
         self.strides = [8, 16, 32]
+        # anchor-center grids, keyed by (input_size, stride)
+        self._anchor_cache = {}
+        # per-thread preprocessing buffers (reused across frames)
+        self._local = threading.local()
+
+    def _buffers(self) -> dict:
+        buf = getattr(self._local, "buf", None)
+        if buf is None or buf["size"] != self.input_size:
+            size = self.input_size
+            buf = {
+                "size": size,
+                "canvas": np.zeros((size, size, 3), dtype=np.uint8),
+                "blob": np.zeros((1, 3, size, size), dtype=np.float32),
+                "resized": None,
+            }
+            self._local.buf = buf
+        return buf
 
     def _preprocess(self, img: np.ndarray):
+        """
+        Writes the frame into this thread's preallocated NCHW RGB float32
+        blob. Returns (blob, (w0, h0), (sx, sy), (nx, ny)) where (sx, sy)
+        maps model-space pixels back to the original image and (nx, ny)
+        maps normalized 0..1 model coordinates back to it.
+        """
         # Keep original width/height for scaling back later
         h0, w0 = img.shape[:2]
-        resized = cv2.resize(img, (self.input_size, self.input_size))
-        # convert BGR->RGB, CHW, float32
-        rgb = resized[:, :, ::-1].astype(np.float32)
-        blob = np.transpose(rgb, (2, 0, 1))[None, ...]
-        return blob, (w0, h0)
+        size = self.input_size
+        buf = self._buffers()
+        canvas = buf["canvas"]
+
+        if self.letterbox:
+            r = min(size / w0, size / h0)
+            nw = max(1, min(size, int(round(w0 * r))))
+            nh = max(1, min(size, int(round(h0 * r))))
+            resized = buf["resized"]
+            if resized is None or resized.shape[:2] != (nh, nw):
+                # frame size changed: new resize target, clear the padding
+                resized = np.empty((nh, nw, 3), dtype=np.uint8)
+                buf["resized"] = resized
+                canvas.fill(0)
+            cv2.resize(img, (nw, nh), dst=resized)
+            canvas[:nh, :nw] = resized
+            sx = sy = 1.0 / r
+            norm = (size * sx, size * sy)
+        else:
+            cv2.resize(img, (size, size), dst=canvas)
+            sx, sy = w0 / size, h0 / size
+            norm = (w0, h0)
+
+        # convert BGR->RGB, HWC->CHW, float32 (in place)
+        blob = buf["blob"]
+        for c in range(3):
+            blob[0, c] = canvas[:, :, 2 - c]
+        return blob, (w0, h0), (sx, sy), norm
 
     def _safe_get_outputs(self, raw_outputs):
         """
@@ -105,21 +188,34 @@ class SCRFDDetector:
             while len(kps) < 3: kps.append(np.zeros((0,10)))
         return scores, bboxes, kps
 
-    def detect(self, img: np.ndarray, conf_threshold: float = 0.45, iou_thresh: float = 0.4) -> List[Dict]:
+    def _anchor_centers(self, stride: int) -> np.ndarray:
         """
-        Run SCRFD detection on BGR image.
-        Returns list of dicts: {"box": (x,y,w,h), "score": float, "kps": [(x,y)...5]}
+        (fm_h*fm_w, 2) array of anchor centers (cx, cy) in model space,
+        row-major over the feature map. Built once per (input_size, stride).
         """
-        if img is None:
-            return []
+        key = (self.input_size, stride)
+        centers = self._anchor_cache.get(key)
+        if centers is None:
+            fm = self.input_size // stride
+            ys, xs = np.mgrid[0:fm, 0:fm]
+            centers = np.stack([xs.ravel(), ys.ravel()], axis=1).astype(np.float64)
+            centers = (centers + 0.5) * stride
+            self._anchor_cache[key] = centers
+        return centers
 
-        blob, (w0, h0) = self._preprocess(img)
-        # run ONNX
-        raw_outputs = self.session.run(None, {self.input_name: blob})
-        scores_list, boxes_list, kps_list = self._safe_get_outputs(raw_outputs)
-
-        proposals = []  # will hold tuples (x1,y1,x2,y2,score, kps_list)
+    def _decode(self, scores_list, boxes_list, kps_list, w0: int, h0: int, ratio, norm,
+                conf_threshold: float):
+        """
+        Vectorized decode of all stride levels.
+        Returns (boxes [N,4] x1,y1,x2,y2 int, scores [N] float, kps [N,5,2] int)
+        in original image coordinates, ordered by stride then anchor position.
+        """
         input_size = self.input_size
+        scale = np.array(ratio, dtype=np.float64)
+        size = np.array(norm, dtype=np.float64)
+        upper = np.array([w0 - 1, h0 - 1], dtype=np.float64)
+
+        all_boxes, all_scores, all_kps = [], [], []
 
         # For each stride-level feature map
         for idx, stride in enumerate(self.strides):
@@ -129,105 +225,119 @@ class SCRFDDetector:
             if scores is None or bboxes is None or kpss is None:
                 continue
 
-            # feature map dims for this stride (based on input_size)
-            fm_h = input_size // stride
-            fm_w = input_size // stride
-
-            # Flatten possibility: ensure shapes are [fm_h*fm_w, ...]
             scores_flat = np.asarray(scores).reshape(-1)
             bboxes_flat = np.asarray(bboxes).reshape(-1, 4)
             kpss_flat = np.asarray(kpss).reshape(-1, 10)
 
-            total = fm_h * fm_w
-            # iterate positions
-            for i in range(min(len(scores_flat), total)):
-                score = float(scores_flat[i])
-                if score < conf_threshold:
-                    continue
-
-                y = i // fm_w
-                x = i % fm_w
-                cx = (x + 0.5) * stride
-                cy = (y + 0.5) * stride
-
-                bbox = bboxes_flat[i]  # often [dx,dy, dw_log, dh_log] or normalized
-                # decode width/height
-                # if bbox values are very small (<3) we assume they are log-sizes as many SCRFD exports do
-                if np.max(np.abs(bbox)) > 1.01:
-                    # bbox interpreted as [dx, dy, w_log, h_log] in model-space
-                    dx = float(bbox[0]) * stride
-                    dy = float(bbox[1]) * stride
-                    w = float(np.exp(bbox[2])) * stride
-                    h = float(np.exp(bbox[3])) * stride
-                    x1_model = cx + dx - w * 0.5
-                    y1_model = cy + dy - h * 0.5
-                else:
-                    # bbox likely normalized (0..1) => scale to model space
-                    x1_model = float(bbox[0]) * input_size
-                    y1_model = float(bbox[1]) * input_size
-                    x2_model = float(bbox[2]) * input_size
-                    y2_model = float(bbox[3]) * input_size
-                    w = x2_model - x1_model
-                    h = y2_model - y1_model
-                    x1_model = x1_model
-                    y1_model = y1_model
-
-                # scale to original image coordinates
-                sx = w0 / input_size
-                sy = h0 / input_size
-                x1 = int(max(0, min(w0 - 1, round(x1_model * sx))))
-                y1 = int(max(0, min(h0 - 1, round(y1_model * sy))))
-                w_px = int(max(1, round(w * sx)))
-                h_px = int(max(1, round(h * sy)))
-                x2 = min(w0 - 1, x1 + w_px)
-                y2 = min(h0 - 1, y1 + h_px)
-
-                # decode landmarks: kpss typically gives offsets in model-space relative to grid or normalized
-                kps_raw = kpss_flat[i]
-                kps_pts = []
-                # try two decodings: if values >1 assume model-space coords; else normalized
-                if np.max(np.abs(kps_raw)) > 1.01:
-                    # model-space: convert each (px,py) -> original
-                    for j in range(0, 10, 2):
-                        px_model = float(kps_raw[j])
-                        py_model = float(kps_raw[j+1])
-                        px = int(max(0, min(w0 - 1, round(px_model * sx))))
-                        py = int(max(0, min(h0 - 1, round(py_model * sy))))
-                        kps_pts.append((px, py))
-                else:
-                    # normalized 0..1
-                    for j in range(0, 10, 2):
-                        px_n = float(kps_raw[j])
-                        py_n = float(kps_raw[j+1])
-                        px = int(max(0, min(w0 - 1, round(px_n * w0))))
-                        py = int(max(0, min(h0 - 1, round(py_n * h0))))
-                        kps_pts.append((px, py))
-
-                proposals.append((x1, y1, x2, y2, score, kps_pts))
-
-        # Run NMS (convert to x1,y1,x2,y2,score)
-        nms_in = [(x1, y1, x2, y2, s) for (x1, y1, x2, y2, s, kps) in proposals]
-        kept = nms_boxes(nms_in, iou_thresh=iou_thresh)
-
-        # build final results with associated kps (match by proximity)
+            centers = self._anchor_centers(stride)
+            n = min(len(scores_flat), len(centers))
+
+            # one boolean mask on score
+            keep = np.nonzero(~(scores_flat[:n] < conf_threshold))[0]
+            if len(keep) == 0:
+                continue
+
+            ctr = centers[keep]
+            bbox = bboxes_flat[keep]
+            kps_raw = kpss_flat[keep]
+            b = bbox.astype(np.float64)
+
+            # bbox is either [dx, dy, w_log, h_log] in stride units,
+            # or normalized (0..1) x1,y1,x2,y2 when all values are small
+            log_mode = np.max(np.abs(bbox), axis=1) > 1.01
+
+            wh_log = np.exp(bbox[:, 2:4]).astype(np.float64) * stride
+            xy_log = ctr + b[:, 0:2] * stride - wh_log * 0.5
+
+            xy1_norm = b[:, 0:2] * input_size
+            wh_norm = b[:, 2:4] * input_size - xy1_norm
+
+            xy1_model = np.where(log_mode[:, None], xy_log, xy1_norm)
+            wh_model = np.where(log_mode[:, None], wh_log, wh_norm)
+
+            # scale to original image coordinates
+            xy1 = np.clip(np.round(xy1_model * scale), 0, upper)
+            wh = np.maximum(1, np.round(wh_model * scale))
+            xy2 = np.minimum(upper, xy1 + wh)
+
+            # landmarks: model-space coords, or normalized 0..1
+            kps = kps_raw.astype(np.float64).reshape(-1, 5, 2)
+            kps_model = np.max(np.abs(kps_raw), axis=1) > 1.01
+            kps_scale = np.where(kps_model[:, None, None], scale, size)
+            kps = np.clip(np.round(kps * kps_scale), 0, upper)
+
+            all_boxes.append(np.concatenate([xy1, xy2], axis=1).astype(np.int64))
+            all_scores.append(scores_flat[keep].astype(np.float64))
+            all_kps.append(kps.astype(np.int64))
+
+        if not all_boxes:
+            return (
+                np.zeros((0, 4), dtype=np.int64),
+                np.zeros(0, dtype=np.float64),
+                np.zeros((0, 5, 2), dtype=np.int64),
+            )
+        return np.concatenate(all_boxes), np.concatenate(all_scores), np.concatenate(all_kps)
+
+    def detect(self, img: np.ndarray, conf_threshold: float = 0.45, iou_thresh: float = 0.4) -> List[Dict]:
+        """
+        Run SCRFD detection on BGR image.
+        Returns list of dicts: {"box": (x,y,w,h), "score": float, "kps": [(x,y)...5]}
+        """
+        if img is None:
+            return []
+
+        blob, (w0, h0), ratio, norm = self._preprocess(img)
+        # run ONNX
+        raw_outputs = self.session.run(None, {self.input_name: blob})
+        if self.batched:
+            raw_outputs = [o[0] for o in raw_outputs]
+        return self._postprocess(raw_outputs, w0, h0, ratio, norm, conf_threshold, iou_thresh)
+
+    def detect_batch(self, imgs: List[np.ndarray], conf_threshold: float = 0.45,
+                     iou_thresh: float = 0.4) -> List[List[Dict]]:
+        """
+        detect() for several images. Batched exports run them through one
+        session.run; other exports fall back to one run per image.
+        """
+        if not self.batched or len(imgs) <= 1:
+            return [self.detect(img, conf_threshold, iou_thresh) for img in imgs]
+
+        size = self.input_size
+        valid = [i for i, img in enumerate(imgs) if img is not None]
+        batch = np.empty((len(valid), 3, size, size), dtype=np.float32)
+        metas = []
+        for j, i in enumerate(valid):
+            blob, (w0, h0), ratio, norm = self._preprocess(imgs[i])
+            batch[j] = blob[0]
+            metas.append((w0, h0, ratio, norm))
+
+        results = [[] for _ in imgs]
+        if not valid:
+            return results
+        raw_outputs = self.session.run(None, {self.input_name: batch})
+        for j, i in enumerate(valid):
+            w0, h0, ratio, norm = metas[j]
+            results[i] = self._postprocess([o[j] for o in raw_outputs], w0, h0, ratio, norm,
+                                           conf_threshold, iou_thresh)
+        return results
+
+    def _postprocess(self, raw_outputs, w0, h0, ratio, norm, conf_threshold, iou_thresh):
+        """Decode + NMS of one image's outputs."""
+        scores_list, boxes_list, kps_list = self._safe_get_outputs(raw_outputs)
+
+        boxes, scores, kpss = self._decode(scores_list, boxes_list, kps_list, w0, h0, ratio, norm,
+                                            conf_threshold)
+
+        # NMS returns indices, so landmarks come from the same proposal
+        keep = nms_indices(boxes, scores, iou_thresh=iou_thresh)
+
         final = []
-        for (x1, y1, x2, y2, score) in kept:
-            # find nearest proposal's kps by center distance
-            cx = (x1 + x2) / 2
-            cy = (y1 + y2) / 2
-            best_kps = None
-            best_dist = None
-            for (px1, py1, px2, py2, s, kps) in proposals:
-                pcx = (px1 + px2) / 2
-                pcy = (py1 + py2) / 2
-                d = (pcx - cx)**2 + (pcy - cy)**2
-                if best_kps is None or d < best_dist:
-                    best_dist = d
-                    best_kps = kps
+        for i in keep.tolist():
+            x1, y1, x2, y2 = boxes[i].tolist()
             final.append({
-                "box": (int(x1), int(y1), int(x2 - x1), int(y2 - y1)),
-                "score": float(score),
-                "kps": best_kps or []
+                "box": (x1, y1, x2 - x1, y2 - y1),
+                "score": float(scores[i]),
+                "kps": [tuple(p) for p in kpss[i].tolist()]
             })
 
         return final
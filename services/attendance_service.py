@@ -1,35 +1,258 @@
 # services/attendance_service.py
+# ------------------------------------------------------
+# Attendance writes go through one writer thread per process.
+#
+# Concurrent requests queue their marks; the writer flushes them in one
+# transaction every ATTENDANCE_FLUSH_MS milliseconds or ATTENDANCE_BATCH
+# rows, whichever comes first, so a morning rush costs a few WAL commits
+# instead of one per recognition. A caller blocks until the transaction
+# holding its mark has committed, so it still gets a definite result.
+#
+# Who is already present today is kept in memory as a bitmap over user
+# ids, loaded from the attendance table on first use each day and updated
+# on every insert: a repeat scan is answered "already marked" with no DB
+# I/O at all. UNIQUE(user_id, attendance_date) stays the source of truth
+# across gunicorn workers (a mark made by another worker after the load
+# is learned from the insert conflict).
+#
+# The attendance day is the local date in ATTENDANCE_TZ (IANA name, e.g.
+# "Asia/Karachi"; default: the server's local time); the bitmap rolls
+# over at midnight there.
+#
+# ATTENDANCE_BATCHING=0 writes in the calling thread (scripts, debugging).
+# ------------------------------------------------------
+
+import os
+import time
+import queue
+import threading
 from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from database.db import db_conn
 
-def mark_attendance(user_id, device="camera"):
-    db = db_conn()
-    cur = db.cursor()
+ATTENDANCE_BATCHING = os.environ.get("ATTENDANCE_BATCHING", "1") == "1"
+ATTENDANCE_FLUSH_MS = float(os.environ.get("ATTENDANCE_FLUSH_MS", 5))
+ATTENDANCE_BATCH = int(os.environ.get("ATTENDANCE_BATCH", 64))
 
-    # 1️⃣ Verify user exists
-    cur.execute("SELECT id FROM users WHERE id=?", (user_id,))
-    if not cur.fetchone():
-        db.close()
-        return {"success": False, "reason": "User not found"}
 
-    # 2️⃣ Prevent duplicate attendance
-    today = datetime.now().strftime("%Y-%m-%d")
-    cur.execute("""
-        SELECT id FROM attendance
-        WHERE user_id=? AND DATE(timestamp)=?
-    """, (user_id, today))
+def _load_tz(name):
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        print(f"Unknown ATTENDANCE_TZ {name!r}, using server local time")
+        return None
+
+
+ATTENDANCE_TZ = _load_tz(os.environ.get("ATTENDANCE_TZ"))
+
+MARKED = {"success": True, "reason": "Attendance marked"}
+ALREADY_MARKED = {"success": False, "reason": "Attendance already marked today"}
+NOT_FOUND = {"success": False, "reason": "User not found"}
+
+
+def attendance_now():
+    """Current wall-clock time in ATTENDANCE_TZ (naive, as stored)."""
+    if ATTENDANCE_TZ is None:
+        return datetime.now()
+    return datetime.now(ATTENDANCE_TZ).replace(tzinfo=None)
+
 
-    if cur.fetchone():
+class PresenceBitmap:
+    """
+    Users present on one attendance day, one bit per user id.
+    Loaded from the attendance table on first use of a day.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.day = None
+        self._bits = bytearray()
+
+    def _load(self, day):
+        db = db_conn()
+        cur = db.cursor()
+        cur.execute("SELECT user_id FROM attendance WHERE attendance_date = ?", (day,))
+        ids = [r[0] for r in cur.fetchall()]
         db.close()
-        return {"success": False, "reason": "Attendance already marked today"}
 
-    # 3️⃣ Insert attendance
-    cur.execute("""
-        INSERT INTO attendance (user_id, timestamp, device)
-        VALUES (?, ?, ?)
-    """, (user_id, datetime.now(), device))
+        bits = bytearray((max(ids) >> 3) + 1 if ids else 0)
+        for user_id in ids:
+            bits[user_id >> 3] |= 1 << (user_id & 7)
+        return bits
+
+    def _switch(self, day):
+        # caller holds the lock; once per day per process
+        if self.day != day:
+            self._bits = self._load(day)
+            self.day = day
+
+    def contains(self, user_id, day):
+        with self._lock:
+            self._switch(day)
+            byte = user_id >> 3
+            return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << (user_id & 7)))
+
+    def add(self, user_ids, day):
+        with self._lock:
+            if self.day != day:
+                return          # marks of a day that already rolled over
+            for user_id in user_ids:
+                byte = user_id >> 3
+                if byte >= len(self._bits):
+                    self._bits.extend(bytes(byte + 1 - len(self._bits)))
+                self._bits[byte] |= 1 << (user_id & 7)
+
+    def discard(self, user_id):
+        with self._lock:
+            byte = user_id >> 3
+            if 0 <= byte < len(self._bits):
+                self._bits[byte] &= ~(1 << (user_id & 7)) & 0xFF
+
+
+class _Request:
+    """Marks of one caller; flushed together, in one transaction."""
+
+    def __init__(self, user_ids, device, now):
+        self.user_ids = user_ids
+        self.device = device
+        self.now = now
+        self.day = now.strftime("%Y-%m-%d")
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+class AttendanceWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.present = PresenceBitmap()
+
+    def forget(self, user_id):
+        self.present.discard(user_id)
+
+    # --------------------------------------------------
+    # Writing
+    # --------------------------------------------------
+    def mark(self, user_ids, device="camera"):
+        """{user_id: result} for every id, once its row is committed."""
+        req = _Request(list(dict.fromkeys(user_ids)), device, attendance_now())
+        known = [u for u in req.user_ids if self.present.contains(u, req.day)]
+        for user_id in known:
+            req.results[user_id] = ALREADY_MARKED
+        req.user_ids = [u for u in req.user_ids if u not in req.results]
+
+        if req.user_ids:
+            if ATTENDANCE_BATCHING:
+                self._submit(req)
+                req.done.wait()
+                if req.error is not None:
+                    raise req.error
+            else:
+                self._flush([req])
+                if req.error is not None:
+                    raise req.error
+        return req.results
+
+    def _submit(self, req):
+        # one writer thread per process (gunicorn workers fork after import)
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,),
+                                     name="attendance-writer", daemon=True).start()
+                    self._pid = os.getpid()
+        self._queue.put(req)
+
+    def _run(self, q):
+        while True:
+            batch = [q.get()]
+            rows = len(batch[0].user_ids)
+            deadline = time.monotonic() + ATTENDANCE_FLUSH_MS / 1000
+            while rows < ATTENDANCE_BATCH:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    req = q.get(timeout=wait)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                rows += len(req.user_ids)
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # never leave a caller waiting
+                for req in batch:
+                    if not req.done.is_set():
+                        req.error = e
+                        req.done.set()
+                print("Attendance writer error:", e)
+
+    def _flush(self, batch):
+        db = db_conn()
+        cur = db.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            # Insert only for an existing user, and only once a day.
+            # UNIQUE(user_id, attendance_date) makes this atomic across
+            # processes: concurrent marks for one user cannot both insert.
+            for req in batch:
+                for user_id in req.user_ids:
+                    cur.execute("""
+                        INSERT INTO attendance (user_id, timestamp, device, attendance_date)
+                        SELECT id, ?, ?, ? FROM users WHERE id=?
+                        ON CONFLICT (user_id, attendance_date) DO NOTHING
+                    """, (req.now, req.device, req.day, user_id))
+                    if cur.rowcount == 1:
+                        req.results[user_id] = MARKED
+
+            # Nothing inserted: unknown user, or already marked today
+            rest = {u for req in batch for u in req.user_ids if u not in req.results}
+            existing = set()
+            if rest:
+                marks = ",".join("?" * len(rest))
+                cur.execute(f"SELECT id FROM users WHERE id IN ({marks})", list(rest))
+                existing = {r[0] for r in cur.fetchall()}
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for req in batch:
+                req.results.clear()
+                req.error = e
+                req.done.set()
+            print("Attendance write failed:", e)
+            return
+        finally:
+            db.close()
+
+        for req in batch:
+            for user_id in req.user_ids:
+                if user_id not in req.results:
+                    req.results[user_id] = ALREADY_MARKED if user_id in existing else NOT_FOUND
+            self.present.add([u for u in req.user_ids if req.results[u] is not NOT_FOUND], req.day)
+            req.done.set()
+
+
+writer = AttendanceWriter()
+
+
+def mark_attendance(user_id, device="camera"):
+    return dict(writer.mark([user_id], device)[user_id])
+
+
+def mark_attendance_many(user_ids, device="camera"):
+    """
+    mark_attendance for several users in one transaction (group capture).
+    Returns {user_id: result} with the same results as mark_attendance.
+    """
+    return {u: dict(r) for u, r in writer.mark(user_ids, device).items()}
 
-    db.commit()
-    db.close()
 
-    return {"success": True, "reason": "Attendance marked"}
+def forget_attendance(user_id):
+    """Drop a user from today's presence bitmap (user deleted)."""
+    writer.forget(user_id)
@@ -2,52 +2,415 @@
 # ------------------------------------------------------
 # Compare face embedding with DB embeddings
 # ------------------------------------------------------
+# The gallery lives in process memory as one contiguous, pre-normalized
+# template matrix (float32 by default) with parallel id / name arrays. It is loaded from the DB
+# once per process and then kept in sync through the gallery_changes
+# feed (see database/db.py): every search first compares MAX(seq) with
+# the version it holds and reloads only the users changed since then, so
+# an approve / delete / rename handled by any gunicorn worker is visible
+# to all workers on their next request. The feed only keeps its newest
+# rows; a worker that fell further behind reloads the whole gallery.
+#
+# A user may own several templates (rows of user_embeddings). Rows of one
+# user are kept contiguous, so matching is one matrix-vector product
+# followed by a segment-max (best template per user), and top-k stays
+# one entry per user. For very large galleries the search can go through
+# an approximate IVF index instead (services/vector_index.py), and the
+# templates can be held as float16 / int8 (services/quantization.py) with
+# the final top users re-scored against the exact float32 vectors.
+#
+# Only templates of the active embedding model are loaded (settings table,
+# see services/model_version.py); when an upgrade switches the active
+# model every worker notices it on its next sync and reloads.
 
+import threading
 import numpy as np
 from database.db import db_conn
+from services.vector_index import ExactIndex, build_index, index_tag
+from services.quantization import GALLERY_DTYPE, RESCORE_CANDIDATES, quantized_columns, store_class
+from services.model_version import ACTIVE_MODEL_KEY, ACTIVE_VERSION_KEY, active_model
 
-def find_top_k_users(embedding, k=2):
+
+def _normalize_rows(mat):
+    return mat / (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-6)
+
+
+# quantized copy when it is stored in the configured dtype, else float32
+_GALLERY_QUERY = """
+    SELECT u.id, u.name,
+           CASE WHEN e.embedding_q_dtype = :dtype THEN e.embedding_q ELSE e.embedding END,
+           e.embedding_q_dtype = :dtype
+    FROM users u
+    JOIN user_embeddings e ON u.id = e.user_id
+    WHERE e.model_version = :version {where}
+    ORDER BY u.id, e.id
+"""
+
+# what the gallery was built from: change-feed position + active model
+_HEAD_QUERY = f"""
+    SELECT (SELECT MAX(seq) FROM gallery_changes),
+           (SELECT value FROM settings WHERE key = '{ACTIVE_MODEL_KEY}'),
+           (SELECT value FROM settings WHERE key = '{ACTIVE_VERSION_KEY}')
+"""
+
+
+def _segment_starts(ids):
+    """Index of the first row of every user (rows grouped by user)."""
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+
+class GalleryIndex:
     """
-    Returns top-k matching users sorted by similarity (desc)
+    In-memory embedding gallery.
 
-    Output:
-    [
-      {"user_id": 1, "name": "A", "score": 0.93},
-      {"user_id": 2, "name": "B", "score": 0.82}
-    ]
+    Mutations build new arrays and swap them in (copy-on-write), so
+    searches never take the lock and never see a half-updated gallery.
     """
 
-    embedding = embedding.reshape(-1).astype(np.float32)
-    embedding /= (np.linalg.norm(embedding) + 1e-6)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None        # gallery_changes seq we are in sync with
+        # (templates [N, D] float32, user id per row [N] int64,
+        #  name per row [N] object, first row of each user [U] int64,
+        #  search backend built over these arrays,
+        #  (embedding model file, model version) the templates come from)
+        self._store_cls = store_class(GALLERY_DTYPE)
+        empty = (
+            self._store_cls.from_float32(np.zeros((0, 0), dtype=np.float32)),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=object),
+            np.zeros(0, dtype=np.int64),
+        )
+        self._state = empty + (ExactIndex(empty[0], empty[1], empty[3]), (None, None))
+
+    def __len__(self):
+        """Number of users (not templates)."""
+        return len(self._state[3])
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def model_name(self):
+        return self._state[5][0]
+
+    @property
+    def model_version(self):
+        return self._state[5][1]
+
+    @property
+    def index_kind(self):
+        return self._state[4].kind
+
+    def arrays(self):
+        """(templates, user id per row, name per row, first row per user)"""
+        return self._state[:4]
+
+    # --------------------------------------------------
+    # Loading / syncing
+    # --------------------------------------------------
+    @staticmethod
+    def _head(cur):
+        """(change-feed seq, (active model file, active model version))"""
+        cur.execute(_HEAD_QUERY)
+        seq, name, version = cur.fetchone()
+        return seq or 0, (name, version)
+
+    def _rows_to_arrays(self, rows):
+        """
+        rows: (user_id, name, blob, blob is already in the gallery dtype)
+        Returns (template store, user id per row, name per row).
+        """
+        store_cls = self._store_cls
+        dtype = store_cls.dtype
+        ids, names, blobs = [], [], []
+        dim = None
+        for user_id, name, emb_blob, is_quantized in rows:
+            if emb_blob is None:
+                continue
+            if dtype == "float32" or not is_quantized:
+                vec = np.frombuffer(emb_blob, dtype=np.float32)
+                dim = len(vec)
+                if dtype != "float32":
+                    # not migrated yet: quantize on load
+                    emb_blob, _ = quantized_columns(vec, dtype)
+            ids.append(user_id)
+            names.append(name)
+            blobs.append(emb_blob)
+
+        if not blobs:
+            store = store_cls.from_float32(np.zeros((0, 0), dtype=np.float32))
+        else:
+            if dim is None:
+                size = len(blobs[0])
+                dim = size // 2 if dtype == "float16" else size - 4
+            store = store_cls.from_blobs(blobs, dim)
+            if dtype == "float32":
+                store = store_cls(_normalize_rows(store.data))
+        return store, np.asarray(ids, dtype=np.int64), np.asarray(names, dtype=object)
+
+    def load(self):
+        """(Re)build the whole gallery from the DB."""
+        active_model()                  # first start: record the active model
+
+        db = db_conn()
+        cur = db.cursor()
+        # one read snapshot: the rows match the seq / model we record
+        cur.execute("BEGIN")
+        version, model = self._head(cur)
+        cur.execute(
+            _GALLERY_QUERY.format(where=""),
+            {"dtype": self._store_cls.dtype, "version": model[1]}
+        )
+        rows = cur.fetchall()
+        db.commit()
+        db.close()
+
+        matrix, ids, names = self._rows_to_arrays(rows)
+        starts = _segment_starts(ids)
+        index = build_index(matrix, ids, starts, tag=index_tag(model[1]))
+        with self._lock:
+            self._state = (matrix, ids, names, starts, index, model)
+            self._version = version
+
+    def sync(self):
+        """
+        Bring the gallery up to date with the change-feed.
+        Costs one indexed integer read when nothing changed.
+        """
+        if self._version is None:
+            self.load()
+            return
+
+        db = db_conn()
+        cur = db.cursor()
+        version, model = self._head(cur)
+        if model != self._state[5]:
+            # the active embedding model was switched: full reload
+            db.close()
+            self.load()
+            return
+        if version <= self._version:
+            db.close()
+            return
+
+        cur.execute("BEGIN")
+        version, model = self._head(cur)
+        if model != self._state[5]:
+            db.commit()
+            db.close()
+            self.load()
+            return
+        oldest = cur.execute("SELECT MIN(seq) FROM gallery_changes").fetchone()[0]
+        if oldest is not None and oldest > self._version + 1:
+            # the changes we missed were pruned from the feed: full reload
+            db.commit()
+            db.close()
+            self.load()
+            return
+        cur.execute(
+            "SELECT DISTINCT user_id FROM gallery_changes WHERE seq > ?",
+            (self._version,)
+        )
+        changed = [r[0] for r in cur.fetchall()]
+        rows = []
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i + 500]
+            params = {f"u{j}": uid for j, uid in enumerate(chunk)}
+            params["dtype"] = self._store_cls.dtype
+            params["version"] = model[1]
+            marks = ",".join(f":u{j}" for j in range(len(chunk)))
+            cur.execute(_GALLERY_QUERY.format(where=f"AND u.id IN ({marks})"), params)
+            rows.extend(cur.fetchall())
+        db.commit()
+        db.close()
+
+        self._replace_users(changed, rows, version, model)
+
+    def _replace_users(self, user_ids, rows, version, model):
+        new_matrix, new_ids, new_names = self._rows_to_arrays(rows)
+
+        with self._lock:
+            if self._version is not None and version <= self._version:
+                return              # another thread already applied it
+            matrix, ids, names, _, index, current = self._state
+            if current != model:
+                return              # a reload for another model won the race
+            keep = ~np.isin(ids, np.asarray(user_ids, dtype=np.int64))
 
-    db = db_conn()
-    cur = db.cursor()
+            kept = keep             # new matrix = kept rows, then the new rows
+            if len(new_ids) == 0:
+                matrix, ids, names = matrix.select(keep), ids[keep], names[keep]
+            elif keep.any() and matrix.shape[1] == new_matrix.shape[1]:
+                matrix = matrix.select(keep).concat(new_matrix)
+                ids = np.concatenate([ids[keep], new_ids])
+                names = np.concatenate([names[keep], new_names])
+            else:
+                matrix, ids, names = new_matrix, new_ids, new_names
+                kept = None
 
-    cur.execute("""
-        SELECT u.id, u.name, e.embedding
-        FROM users u
-        JOIN user_embeddings e ON u.id = e.user_id
-    """)
+            # changed users are appended as whole groups: rows stay contiguous
+            starts = _segment_starts(ids)
+            index = build_index(matrix, ids, starts, previous=index, tag=index_tag(model[1]), kept=kept)
+            self._state = (matrix, ids, names, starts, index, model)
+            self._version = version
 
-    rows = cur.fetchall()
-    db.close()
+    # --------------------------------------------------
+    # Search
+    # --------------------------------------------------
+    def search(self, embedding, k=2, model_version=None):
+        """
+        model_version: version of the model that produced embedding; no
+        match is returned if the gallery was built by another model.
+        """
+        self.sync()
+        _, ids, names, _, index, (_, gallery_version) = self._state
 
-    results = []
+        if len(ids) == 0:
+            return []
+        if model_version is not None and model_version != gallery_version:
+            print("Embedding model switched during request, skipping match")
+            return []
 
-    for user_id, name, emb_blob in rows:
-        if emb_blob is None:
-            continue
+        query = embedding.reshape(-1).astype(np.float32)
+        query /= (np.linalg.norm(query) + 1e-6)
 
-        db_emb = np.frombuffer(emb_blob, dtype=np.float32).copy()
-        db_emb /= (np.linalg.norm(db_emb) + 1e-6)
+        # best template per user, top-k users
+        if index.matrix.exact:
+            rows, scores = index.top_k(query, k)
+        else:
+            # quantized scores only shortlist; decide on exact float32 scores
+            rows, _ = index.top_k(query, max(k, RESCORE_CANDIDATES))
+            rows, scores = self._rescore(rows, ids, query, k, gallery_version)
 
-        score = float(np.dot(embedding, db_emb))
+        return [
+            {"user_id": int(ids[r]), "name": names[r], "score": float(s)}
+            for r, s in zip(rows, scores)
+        ]
 
-        results.append({
-            "user_id": user_id,
-            "name": name,
-            "score": score
-        })
+    def score_users(self, embeddings, model_version=None):
+        """
+        Best-template score of every user for several queries at once
+        (group recognition): one matrix product over the whole gallery.
 
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results[:k]
\ No newline at end of file
+        Returns (user ids (U,), names (U,), scores (Q, U)); no users when
+        the gallery is empty or was built by another model.
+        """
+        self.sync()
+        matrix, ids, names, starts, _, (_, gallery_version) = self._state
+
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object),
+                 np.zeros((len(queries), 0), dtype=np.float32))
+        if len(ids) == 0 or len(queries) == 0:
+            return empty
+        if model_version is not None and model_version != gallery_version:
+            print("Embedding model switched during request, skipping match")
+            return empty
+
+        queries = _normalize_rows(queries)
+
+        # (templates, Q) -> best template per user -> (Q, users)
+        scores = np.maximum.reduceat(matrix @ queries.T, starts, axis=0).T
+        scores = np.ascontiguousarray(scores, dtype=np.float32)
+
+        if not matrix.exact:
+            # quantized scores only shortlist; the top users of every query
+            # are re-scored exactly from their float32 templates
+            n = min(RESCORE_CANDIDATES, scores.shape[1])
+            cand = np.unique(np.argpartition(-scores, n - 1, axis=1)[:, :n])
+            exact = self._exact_user_scores(ids[starts[cand]], queries, gallery_version)
+            scores[:, cand] = exact
+
+        return ids[starts], names[starts], scores
+
+    @staticmethod
+    def _exact_user_scores(user_ids, queries, model_version):
+        """(Q, len(user_ids)) exact float32 best-template scores."""
+        db = db_conn()
+        cur = db.cursor()
+        marks = ",".join("?" * len(user_ids))
+        cur.execute(
+            f"SELECT user_id, embedding FROM user_embeddings "
+            f"WHERE user_id IN ({marks}) AND model_version = ?",
+            [int(u) for u in user_ids] + [model_version]
+        )
+        rows = cur.fetchall()
+        db.close()
+
+        col = {int(u): j for j, u in enumerate(user_ids)}
+        out = np.full((len(queries), len(user_ids)), -np.inf, dtype=np.float32)
+        for user_id, blob in rows:
+            vec = np.frombuffer(blob, dtype=np.float32)
+            sims = (queries @ vec) / (float(np.linalg.norm(vec)) + 1e-6)
+            j = col[user_id]
+            out[:, j] = np.maximum(out[:, j], sims)
+        return out
+
+    @staticmethod
+    def _rescore(rows, ids, query, k, model_version):
+        """Exact float32 best-template score for the candidate users."""
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        cand = [int(ids[r]) for r in rows]
+
+        db = db_conn()
+        cur = db.cursor()
+        marks = ",".join("?" * len(cand))
+        cur.execute(
+            f"SELECT user_id, embedding FROM user_embeddings "
+            f"WHERE user_id IN ({marks}) AND model_version = ?",
+            cand + [model_version]
+        )
+        best = {}
+        for user_id, blob in cur.fetchall():
+            vec = np.frombuffer(blob, dtype=np.float32)
+            score = float(vec @ query) / (float(np.linalg.norm(vec)) + 1e-6)
+            best[user_id] = max(score, best.get(user_id, -np.inf))
+        db.close()
+
+        found = [(r, best[u]) for r, u in zip(rows, cand) if u in best]
+        found.sort(key=lambda x: x[1], reverse=True)
+        found = found[:k]
+        return [r for r, _ in found], np.asarray([sc for _, sc in found], dtype=np.float32)
+
+
+# Process-wide gallery shared by every request
+gallery = GalleryIndex()
+
+
+def load_gallery():
+    gallery.load()
+
+
+def active_embedder():
+    """EmbeddingModel of the active model version (what the gallery holds)."""
+    from ml.registry import get_embedder
+
+    gallery.sync()
+    return get_embedder(gallery.model_name)
+
+
+def find_top_k_users(embedding, k=2, model_version=None):
+    """
+    Returns top-k matching users sorted by similarity (desc)
+    (model_version: see GalleryIndex.search)
+
+    Output:
+    [
+      {"user_id": 1, "name": "A", "score": 0.93},
+      {"user_id": 2, "name": "B", "score": 0.82}
+    ]
+    """
+    return gallery.search(embedding, k=k, model_version=model_version)
+
+
+def score_users(embeddings, model_version=None):
+    """
+    Scores of several query embeddings against every user
+    (see GalleryIndex.score_users): (user ids, names, scores (Q, U)).
+    """
+    return gallery.score_users(embeddings, model_version=model_version)
@@ -0,0 +1,187 @@
+# services/face_tracker.py
+# ------------------------------------------------------
+# Per-kiosk face tracking.
+#
+# A kiosk camera sees the same person for many consecutive frames.
+# Detections are associated with the previous frame's tracks by IoU of
+# the SCRFD boxes; once a track was recognized, later frames of it may
+# reuse that identity instead of running alignment, ArcFace and the
+# gallery search again.
+#
+# Box overlap alone does not say it is still the same person (the next
+# one in the queue steps into the same spot), so a match is only reused
+# while
+#   - the box stayed put (IoU with the previous frame >= TRACK_STEADY_IOU),
+#   - the face crop still looks the same: a small normalized grayscale
+#     patch, compared by correlation (>= TRACK_APPEARANCE_SIM),
+#   - the face quality did not improve by TRACK_QUALITY_GAIN,
+#   - the gallery did not change since the track was recognized.
+# Every TRACK_VERIFY_EVERY reuses the face is embedded again and compared
+# with the track's embedding (>= TRACK_SAME_FACE); a different face drops
+# the identity and goes through the full gallery search.
+#
+# Tracking needs a stable id per kiosk (?kiosk= / X-Kiosk-Id, see
+# api/user_api.py); requests without one are never tracked.
+# A track not seen for TRACK_TTL seconds is dropped. Trackers are per
+# process, kept in a bounded TTL cache.
+# ------------------------------------------------------
+
+import os
+import time
+import itertools
+import threading
+
+import cv2
+import numpy as np
+
+from utils.ttl_cache import TTLCache
+
+TRACK_IOU = float(os.environ.get("TRACK_IOU", 0.4))
+TRACK_STEADY_IOU = float(os.environ.get("TRACK_STEADY_IOU", 0.6))
+TRACK_TTL = float(os.environ.get("TRACK_TTL", 2.0))                 # seconds unseen
+TRACK_QUALITY_GAIN = float(os.environ.get("TRACK_QUALITY_GAIN", 1.15))
+TRACK_APPEARANCE_SIM = float(os.environ.get("TRACK_APPEARANCE_SIM", 0.85))
+TRACK_VERIFY_EVERY = int(os.environ.get("TRACK_VERIFY_EVERY", 5))
+TRACK_SAME_FACE = float(os.environ.get("TRACK_SAME_FACE", 0.75))
+TRACKER_DEVICES = int(os.environ.get("TRACKER_DEVICES", 256))
+
+APPEARANCE_SIZE = 24
+
+_track_ids = itertools.count(1)
+
+
+def box_iou(a, b):
+    """IoU of two (x, y, w, h) boxes."""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = min(ax + aw, bx + bw) - max(ax, bx)
+    ih = min(ay + ah, by + bh) - max(ay, by)
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def face_quality(face, factor=1.0):
+    """Detector confidence x face width in full-resolution pixels."""
+    return face["score"] * face["box"][2] * factor
+
+
+def appearance(img, box):
+    """
+    Zero-mean, unit-norm grayscale patch of the face box (cheap look-alike
+    check between frames), or None when the box is off the image.
+    """
+    x, y, w, h = (int(round(v)) for v in box)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, img.shape[1]), min(y + h, img.shape[0])
+    if x1 - x0 < 4 or y1 - y0 < 4:
+        return None
+    crop = cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+    patch = cv2.resize(crop, (APPEARANCE_SIZE, APPEARANCE_SIZE),
+                       interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    patch -= patch.mean()
+    norm = np.linalg.norm(patch)
+    return patch / norm if norm > 0 else None
+
+
+class Track:
+    def __init__(self, box, quality, now):
+        self.id = next(_track_ids)
+        self.box = box
+        self.iou = 0.0                  # overlap with the previous frame's box
+        self.quality = quality          # quality of the frame last embedded
+        self.last_seen = now
+        self.hits = 1
+        self.reuses = 0
+
+        # set by remember() once the track was recognized
+        self.match = None               # {"user_id", "name", "score"}
+        self.emb = None
+        self.patch = None
+        self.gallery_version = None
+
+    def can_reuse(self, quality, gallery_version, patch):
+        """True when this frame may reuse the track's identity."""
+        if self.match is None or self.gallery_version != gallery_version:
+            return False
+        if self.iou < TRACK_STEADY_IOU:
+            return False                # box jumped: maybe someone else
+        if patch is None or self.patch is None or float(patch @ self.patch) < TRACK_APPEARANCE_SIM:
+            return False
+        return quality <= self.quality * TRACK_QUALITY_GAIN
+
+    def needs_verification(self):
+        return self.reuses >= TRACK_VERIFY_EVERY
+
+    def same_face(self, emb):
+        """Embedding of a new frame against the one the match came from."""
+        return self.emb is not None and float(np.dot(emb, self.emb)) >= TRACK_SAME_FACE
+
+    def remember(self, match, emb, quality, gallery_version, patch):
+        """Identity after a (re-)embedding; match=None forgets it."""
+        self.match = match
+        self.emb = emb
+        self.quality = quality
+        self.gallery_version = gallery_version
+        self.patch = patch
+        self.reuses = 0
+
+
+class DeviceTracker:
+    def __init__(self):
+        self.tracks = []
+        self.lock = threading.Lock()
+
+    def observe(self, boxes, now=None):
+        """
+        Associate this frame's boxes (full-resolution x, y, w, h) with
+        live tracks, greedily by IoU. Returns one Track per box; boxes
+        without a match start new tracks.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.tracks = [t for t in self.tracks if now - t.last_seen <= TRACK_TTL]
+
+            pairs = sorted(
+                ((box_iou(t.box, b), ti, bi)
+                 for ti, t in enumerate(self.tracks)
+                 for bi, b in enumerate(boxes)),
+                reverse=True,
+            )
+            assigned = [None] * len(boxes)
+            used = set()
+            for iou, ti, bi in pairs:
+                if iou < TRACK_IOU:
+                    break
+                if ti in used or assigned[bi] is not None:
+                    continue
+                used.add(ti)
+                track = self.tracks[ti]
+                track.iou = iou
+                track.box = boxes[bi]
+                track.last_seen = now
+                track.hits += 1
+                assigned[bi] = track
+
+            for bi, box in enumerate(boxes):
+                if assigned[bi] is None:
+                    # quality 0: the first frame of a track is always embedded
+                    assigned[bi] = Track(box, 0.0, now)
+                    self.tracks.append(assigned[bi])
+            return assigned
+
+
+_trackers = TTLCache(maxsize=TRACKER_DEVICES, ttl=max(TRACK_TTL * 30, 60))
+_trackers_lock = threading.Lock()
+
+
+def tracker_for(kiosk_id):
+    tracker = _trackers.get(kiosk_id)
+    if tracker is None:
+        with _trackers_lock:
+            tracker = _trackers.get(kiosk_id)
+            if tracker is None:
+                tracker = DeviceTracker()
+                _trackers.set(kiosk_id, tracker)
+    return tracker
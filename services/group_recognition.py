@@ -0,0 +1,95 @@
+# services/group_recognition.py
+# ------------------------------------------------------
+# Group / classroom capture: match every face of one frame at once.
+#
+# All face embeddings are scored against the gallery in one matrix
+# product (GalleryIndex.score_users). Faces are then assigned to users
+# one-to-one, greedily from the highest (face, user) score down, using
+# only pairs that pass reject_threshold, so two faces can never claim the
+# same user and a weak pair never decides who wins a strong one. An
+# assigned face must still beat its best other user by at least margin,
+# as in /api/recognize. A face whose best user went to a face scoring
+# higher for that user is reported as claimed by another face.
+# ------------------------------------------------------
+
+import os
+import numpy as np
+
+from services.embedding_service import score_users
+
+GROUP_MIN_FACE = int(os.environ.get("GROUP_MIN_FACE", 40))          # px, full resolution
+GROUP_MIN_DET_SCORE = float(os.environ.get("GROUP_MIN_DET_SCORE", 0.5))
+GROUP_MAX_FACES = int(os.environ.get("GROUP_MAX_FACES", 100))
+
+
+def assign_faces(scores, reject_threshold):
+    """
+    One-to-one assignment, greedily in descending score order over the
+    (face, user) pairs that pass reject_threshold: the strongest pair
+    always wins, and pairs below the threshold never influence who gets
+    a user. Returns the user column of every face row, -1 when unassigned.
+    """
+    assigned = np.full(scores.shape[0], -1, dtype=np.int64)
+    faces, users = np.nonzero(scores >= reject_threshold)
+    order = np.argsort(-scores[faces, users], kind="stable")
+
+    taken = set()
+    for i in order:
+        q, u = faces[i], users[i]
+        if assigned[q] >= 0 or u in taken:
+            continue
+        assigned[q] = u
+        taken.add(u)
+    return assigned
+
+
+def match_faces(embeddings, model_version, reject_threshold, margin):
+    """
+    embeddings: (Q, D) for the faces of one frame.
+
+    Returns one dict per face:
+      {"user_id", "name", "score"} on a match, else
+      {"reason", "score"[, "borderline"]}
+    """
+    user_ids, names, scores = score_users(embeddings, model_version=model_version)
+    n_faces = len(embeddings)
+    if len(user_ids) == 0:
+        return [{"reason": "No enrolled users", "score": 0} for _ in range(n_faces)]
+
+    assigned = assign_faces(scores, reject_threshold)
+
+    results = []
+    for q in range(n_faces):
+        row = scores[q]
+        col = assigned[q]
+        best = int(np.argmax(row))
+
+        if best != col and row[best] >= reject_threshold:
+            # its best user went to a face that scored higher for that user
+            results.append({
+                "reason": "Matched user already claimed by another face",
+                "score": float(row[best]),
+                "borderline": True
+            })
+            continue
+        if col < 0:
+            results.append({"reason": "Unknown user", "score": float(row[best])})
+            continue
+
+        score = float(row[col])
+        others = np.delete(row, col)
+        second = float(others.max()) if len(others) else -1.0
+
+        if score - second < margin:
+            results.append({
+                "reason": "Face too similar to another user",
+                "score": score,
+                "borderline": True
+            })
+        else:
+            results.append({
+                "user_id": int(user_ids[col]),
+                "name": names[col],
+                "score": score
+            })
+    return results
@@ -0,0 +1,300 @@
+# services/job_queue.py
+# ------------------------------------------------------
+# Persistent background job queue (SQLite table `jobs`).
+#
+# Slow admin work (approving enrollments, re-embedding) is enqueued from
+# the HTTP request and drained by a small pool of worker threads, either
+# inside every app process (start_workers, called from app.py) or in a
+# separate process:
+#
+#     python -m services.job_queue --workers 2
+#
+# Claiming a job is one short IMMEDIATE transaction, so any number of
+# workers across processes can share the queue. Handlers report progress
+# through a callback; the admin dashboard polls /api/admin/jobs/<id>.
+# Transient failures (TransientJobError, OSError — e.g. Windows file
+# locks like the ones safe_rmtree works around) are retried with backoff.
+#
+# A running job holds a lease kept alive by a heartbeat thread. A job whose
+# lease expired (its worker process died) is requeued while it has
+# attempts left and marked failed after max_attempts, so a job that kills
+# its worker every time cannot loop forever.
+# ------------------------------------------------------
+
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+
+from database.db import db_conn
+
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", 2.0))     # seconds, x attempt
+POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1.0))  # seconds
+# a running job whose heartbeat is older than this is considered abandoned
+LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 600))
+# a running job's heartbeat is refreshed this often, independent of progress
+HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", LEASE_SECONDS / 4))
+
+
+class JobError(Exception):
+    """Permanent failure: the job is marked failed, with optional details."""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or {}
+
+
+class TransientJobError(Exception):
+    """Failure worth retrying (the job goes back to the queue)."""
+
+
+_handlers = {}
+_wakeup = threading.Event()
+
+
+def register(kind):
+    """Decorator: register fn(payload, progress) as the handler for kind."""
+    def deco(fn):
+        _handlers[kind] = fn
+        return fn
+    return deco
+
+
+# --------------------------------------------------
+# Queue API
+# --------------------------------------------------
+def _row_to_dict(row):
+    job = dict(row)
+    for key in ("payload", "result"):
+        if job.get(key):
+            job[key] = json.loads(job[key])
+    return job
+
+
+def enqueue(kind, payload=None, max_attempts=MAX_ATTEMPTS):
+    conn = db_conn()
+    cur = conn.cursor()
+    now = time.time()
+    cur.execute("""
+        INSERT INTO jobs (kind, payload, status, max_attempts, run_after, created_at, updated_at)
+        VALUES (?, ?, 'queued', ?, ?, ?, ?)
+    """, (kind, json.dumps(payload or {}), max_attempts, now, now, now))
+    job_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id):
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM jobs WHERE id=?", (job_id,))
+    row = cur.fetchone()
+    conn.close()
+    return _row_to_dict(row) if row else None
+
+
+def list_jobs(limit=50, status=None):
+    conn = db_conn()
+    cur = conn.cursor()
+    if status:
+        cur.execute("SELECT * FROM jobs WHERE status=? ORDER BY id DESC LIMIT ?", (status, limit))
+    else:
+        cur.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+    rows = [_row_to_dict(r) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+
+def find_active(kind, key, value):
+    """Queued/running job of kind whose payload[key] == value, or None."""
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT * FROM jobs
+        WHERE kind=? AND status IN ('queued', 'running')
+          AND json_extract(payload, '$.' || ?) = ?
+        ORDER BY id LIMIT 1
+    """, (kind, key, value))
+    row = cur.fetchone()
+    conn.close()
+    return _row_to_dict(row) if row else None
+
+
+def _claim(worker_id):
+    """Atomically move the oldest runnable job to running. Returns dict or None."""
+    conn = db_conn()
+    cur = conn.cursor()
+    now = time.time()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        # abandoned jobs (worker died mid-run) become runnable again,
+        # unless they already used up their attempts
+        cur.execute("""
+            UPDATE jobs SET status='failed', finished_at=?, updated_at=?,
+                error='lease expired (worker died) after ' || attempts || ' attempts'
+            WHERE status='running' AND heartbeat_at < ? AND attempts >= max_attempts
+        """, (now, now, now - LEASE_SECONDS))
+        cur.execute("""
+            UPDATE jobs SET status='queued', updated_at=?
+            WHERE status='running' AND heartbeat_at < ?
+        """, (now, now - LEASE_SECONDS))
+        cur.execute("""
+            SELECT id FROM jobs
+            WHERE status='queued' AND run_after <= ?
+            ORDER BY id LIMIT 1
+        """, (now,))
+        row = cur.fetchone()
+        if not row:
+            conn.commit()
+            return None
+        cur.execute("""
+            UPDATE jobs
+            SET status='running', attempts=attempts+1, worker=?,
+                started_at=?, heartbeat_at=?, updated_at=?
+            WHERE id=?
+        """, (worker_id, now, now, now, row["id"]))
+        cur.execute("SELECT * FROM jobs WHERE id=?", (row["id"],))
+        job = _row_to_dict(cur.fetchone())
+        conn.commit()
+        return job
+    finally:
+        conn.close()
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    cols = ", ".join(f"{k}=?" for k in fields)
+    conn = db_conn()
+    conn.execute(f"UPDATE jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def _progress_callback(job_id):
+    def progress(done, total=None, message=None):
+        fields = {"progress": int(done), "heartbeat_at": time.time()}
+        if total is not None:
+            fields["total"] = int(total)
+        if message is not None:
+            fields["message"] = str(message)
+        _update(job_id, **fields)
+    return progress
+
+
+def _heartbeat(job, stop):
+    """Keep the lease of a running job alive until stop is set."""
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            conn = db_conn()
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at=? WHERE id=? AND status='running' AND worker=?",
+                (time.time(), job["id"], job["worker"])
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"Job {job['id']} heartbeat failed:", e)
+
+
+def run_job(job):
+    """Run one claimed job and record its outcome."""
+    handler = _handlers.get(job["kind"])
+    if handler is None:
+        _update(job["id"], status="failed", error=f"no handler for {job['kind']}",
+                finished_at=time.time())
+        return
+
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job, stop),
+                     name=f"job-heartbeat-{job['id']}", daemon=True).start()
+    try:
+        _run_handler(job, handler)
+    finally:
+        stop.set()
+
+
+def _run_handler(job, handler):
+    try:
+        result = handler(job["payload"], _progress_callback(job["id"]))
+    except JobError as e:
+        _update(job["id"], status="failed", error=str(e),
+                result=json.dumps(e.details), finished_at=time.time())
+    except (TransientJobError, OSError) as e:
+        if job["attempts"] < job["max_attempts"]:
+            print(f"Job {job['id']} failed (attempt {job['attempts']}), retrying:", e)
+            _update(job["id"], status="queued", error=str(e),
+                    run_after=time.time() + RETRY_DELAY * job["attempts"])
+            _wakeup.set()
+        else:
+            _update(job["id"], status="failed", error=str(e), finished_at=time.time())
+    except Exception as e:
+        traceback.print_exc()
+        _update(job["id"], status="failed", error=f"{type(e).__name__}: {e}",
+                finished_at=time.time())
+    else:
+        _update(job["id"], status="done", error=None,
+                result=json.dumps(result or {}), finished_at=time.time())
+
+
+# --------------------------------------------------
+# Worker pool
+# --------------------------------------------------
+_started = False
+_start_lock = threading.Lock()
+
+
+def _worker_loop(worker_id):
+    while True:
+        try:
+            job = _claim(worker_id)
+        except Exception as e:
+            print("Job queue error:", e)
+            job = None
+        if job is None:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        run_job(job)
+
+
+def start_workers(n=1):
+    """Start n daemon worker threads in this process (once)."""
+    global _started
+    with _start_lock:
+        if _started or n <= 0:
+            return
+        _started = True
+
+    # importing the handlers module registers them
+    import services.jobs  # noqa: F401
+
+    prefix = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    for i in range(n):
+        t = threading.Thread(target=_worker_loop, args=(f"{prefix}-{i}",),
+                             name=f"job-worker-{i}", daemon=True)
+        t.start()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m services.job_queue")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    from database.db import ensure_tables
+    ensure_tables()
+
+    start_workers(args.workers)
+    print(f"Job workers running: {args.workers}")
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
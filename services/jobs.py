@@ -0,0 +1,56 @@
+# services/jobs.py
+# ------------------------------------------------------
+# Background job handlers (registered with services/job_queue.py)
+# ------------------------------------------------------
+
+from services.job_queue import register, JobError
+
+
+@register("approve")
+def approve_job(payload, progress):
+    """Approve one pending enrollment: {"pending_id": int}"""
+    from ml.processor import process_pending_approve
+    from services.embedding_service import gallery
+
+    pid = payload["pending_id"]
+    ok, result = process_pending_approve(pid, progress)
+    if not ok:
+        raise JobError(result["error"], dict(result, pending_id=pid))
+
+    # this worker's gallery now; other processes follow the change-feed
+    gallery.sync()
+    return dict(result, status="approved", pending_id=pid)
+
+
+@register("approve_bulk")
+def approve_bulk_job(payload, progress):
+    """Approve many pending enrollments: {"pending_ids": [int, ...] | "all"}"""
+    from ml.processor import process_pending_bulk
+    from services.embedding_service import gallery
+
+    ids = payload.get("pending_ids", "all")
+    result = process_pending_bulk(None if ids == "all" else ids, progress)
+    gallery.sync()
+    return dict(result, status="approved")
+
+
+@register("reembed_all")
+def reembed_all_job(payload, progress):
+    """Recompute every user's templates (active model) from storage/dataset."""
+    from ml.processor import reembed_users
+    from services.embedding_service import gallery
+
+    result = reembed_users(progress=progress)
+    gallery.sync()
+    return dict(result, status="reembedded")
+
+
+@register("migrate_model")
+def migrate_model_job(payload, progress):
+    """Online upgrade to another embedding model: {"model": "file.onnx", "force": bool}"""
+    from services.model_version import migrate_model
+    from services.embedding_service import gallery
+
+    result = migrate_model(payload["model"], progress, force=payload.get("force", False))
+    gallery.sync()
+    return result
@@ -0,0 +1,232 @@
+# services/model_version.py
+# ------------------------------------------------------
+# Which embedding model the gallery is built from, and online upgrades.
+#
+# Every user_embeddings row carries the model_version that produced it
+# (ml.embeddings.model_version: file name + content hash + preprocessing
+# signature). The settings table names the active model; the gallery and
+# /api/recognize only ever use that one, so vectors of different models
+# are never compared.
+#
+# Upgrade without downtime (job "migrate_model", or the CLI below):
+#   1. place the new model under ml/models/
+#   2. re-embed every user from storage/dataset with it — new rows are
+#      written next to the old ones while the old model keeps serving
+#   3. switch: under the DB write lock, embed users approved in the
+#      meantime, then flip the settings row; every worker's gallery
+#      reloads on its next request
+# Old rows stay until pruned, so an aborted upgrade never touches the
+# templates that are serving.
+#
+# Command line:
+#   python -m services.model_version status
+#   python -m services.model_version migrate arcface_r100.onnx [--force]
+#   python -m services.model_version prune
+# ------------------------------------------------------
+
+import time
+
+from database.db import db_conn
+
+ACTIVE_MODEL_KEY = "embedding_model"
+ACTIVE_VERSION_KEY = "embedding_model_version"
+
+# catch-up passes before giving up on a moving target
+SWITCH_ATTEMPTS = 5
+
+
+# --------------------------------------------------
+# Settings
+# --------------------------------------------------
+def get_setting(cur, key, default=None):
+    cur.execute("SELECT value FROM settings WHERE key=?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else default
+
+
+def set_setting(cur, key, value):
+    cur.execute("""
+        INSERT INTO settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+    """, (key, value))
+
+
+def active_model():
+    """
+    (model file name, model version) serving recognition.
+    On first use the default model (EMBEDDING_MODEL) becomes active and
+    claims the templates written before versioning.
+    """
+    conn = db_conn()
+    cur = conn.cursor()
+    name = get_setting(cur, ACTIVE_MODEL_KEY)
+    version = get_setting(cur, ACTIVE_VERSION_KEY)
+    conn.close()
+    if version is not None:
+        return name, version
+    return _bootstrap()
+
+
+def _bootstrap():
+    from ml.embeddings import model_version
+    from ml.registry import DEFAULT_EMBEDDING_MODEL
+
+    version = model_version(DEFAULT_EMBEDDING_MODEL)
+
+    conn = db_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        current = get_setting(cur, ACTIVE_VERSION_KEY)
+        if current is not None:          # another worker was first
+            name = get_setting(cur, ACTIVE_MODEL_KEY)
+            conn.commit()
+            return name, current
+        cur.execute(
+            "UPDATE user_embeddings SET model_version=? WHERE model_version IS NULL",
+            (version,)
+        )
+        set_setting(cur, ACTIVE_MODEL_KEY, DEFAULT_EMBEDDING_MODEL)
+        set_setting(cur, ACTIVE_VERSION_KEY, version)
+        conn.commit()
+        print(f"Active embedding model: {version}")
+        return DEFAULT_EMBEDDING_MODEL, version
+    finally:
+        conn.close()
+
+
+def version_counts():
+    """{model_version: (users, templates)} over the stored templates."""
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT model_version, COUNT(DISTINCT user_id), COUNT(*)
+        FROM user_embeddings GROUP BY model_version
+    """)
+    out = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+    conn.close()
+    return out
+
+
+# --------------------------------------------------
+# Migration
+# --------------------------------------------------
+def _users_without(cur, version, exclude):
+    cur.execute("""
+        SELECT u.id FROM users u
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_embeddings e
+            WHERE e.user_id = u.id AND e.model_version = ?
+        )
+    """, (version,))
+    return [r[0] for r in cur.fetchall() if r[0] not in exclude]
+
+
+def migrate_model(model_name, progress=None, force=False):
+    """
+    Re-embed every user with model_name next to the active templates,
+    then make it the active model. Users that cannot be re-embedded
+    (no images / too few good faces) block the switch unless force=True,
+    in which case they drop out of recognition until re-enrolled.
+    """
+    from ml.registry import get_embedder
+    from ml.processor import reembed_users
+    from services.job_queue import JobError
+
+    model = get_embedder(model_name)
+    _, active = active_model()
+    if model.version == active:
+        return {"status": "active", "model_version": model.version}
+
+    t0 = time.perf_counter()
+
+    # 1️⃣ bulk pass: the old model keeps serving meanwhile
+    report = reembed_users(progress=progress, model=model)
+    skipped = {s["user_id"]: s for s in report["skipped"]}
+    images = report["images"]
+
+    # 2️⃣ switch under the write lock, catching up on users approved meanwhile
+    for _ in range(SWITCH_ATTEMPTS):
+        conn = db_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            missing = _users_without(cur, model.version, skipped)
+            if missing:
+                conn.rollback()
+            else:
+                if skipped and not force:
+                    conn.rollback()
+                    raise JobError(
+                        f"{len(skipped)} users could not be re-embedded (use force to switch anyway)",
+                        {"skipped": list(skipped.values()), "model_version": model.version}
+                    )
+                set_setting(cur, ACTIVE_MODEL_KEY, model_name)
+                set_setting(cur, ACTIVE_VERSION_KEY, model.version)
+                conn.commit()
+                break
+        finally:
+            conn.close()
+
+        extra = reembed_users(missing, model=model)
+        skipped.update({s["user_id"]: s for s in extra["skipped"]})
+        images += extra["images"]
+    else:
+        raise JobError("gallery kept changing, switchover not done", {"model_version": model.version})
+
+    seconds = time.perf_counter() - t0
+    print(f"✅ Switched embedding model: {active} -> {model.version} "
+          f"({images} images in {seconds:.1f}s)")
+    return {
+        "status": "switched",
+        "previous_version": active,
+        "model_version": model.version,
+        "images": images,
+        "seconds": round(seconds, 2),
+        "images_per_sec": round(images / max(seconds, 1e-9), 2),
+        "skipped": list(skipped.values()),
+    }
+
+
+def prune_versions():
+    """Delete the templates of every inactive model version."""
+    _, active = active_model()
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM user_embeddings WHERE model_version IS NOT ?", (active,))
+    n = cur.rowcount
+    conn.commit()
+    conn.close()
+    return n
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m services.model_version")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status", help="active model and stored template versions")
+    mig = sub.add_parser("migrate", help="re-embed everything with a model and switch to it")
+    mig.add_argument("model", help="model file under ml/models/")
+    mig.add_argument("--force", action="store_true", help="switch even if some users fail")
+    sub.add_parser("prune", help="delete templates of inactive model versions")
+    args = parser.parse_args(argv)
+
+    from database.db import ensure_tables
+    ensure_tables()
+
+    if args.cmd == "status":
+        name, active = active_model()
+        print(f"active: {name} ({active})")
+        for version, (users, templates) in version_counts().items():
+            mark = "*" if version == active else " "
+            print(f"{mark} {version}: {users} users, {templates} templates")
+    elif args.cmd == "migrate":
+        result = migrate_model(args.model, force=args.force)
+        print(result)
+    else:
+        print(f"Deleted {prune_versions()} inactive templates")
+
+
+if __name__ == "__main__":
+    main()
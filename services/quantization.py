@@ -0,0 +1,244 @@
+# services/quantization.py
+# ------------------------------------------------------
+# Compact storage of gallery templates (in memory and in the DB).
+#
+#   GALLERY_DTYPE=float32   2 KB / 512-d template (default, exact)
+#   GALLERY_DTYPE=float16   1 KB / template
+#   GALLERY_DTYPE=int8      ~0.5 KB / template (per-vector scale)
+#
+# The float32 user_embeddings.embedding column stays the source of truth;
+# a quantized copy lives in embedding_q / embedding_q_dtype so workers load
+# (and keep) only the small blobs. Quantized scores only pick candidates:
+# the gallery re-scores the top users with the exact float32 vectors, so
+# REJECT_THRESHOLD / TOP2_MARGIN decisions do not drift.
+#
+# Command line:
+#   python -m services.quantization migrate [--dtype int8]
+#       fill embedding_q for existing rows
+# ------------------------------------------------------
+
+import os
+import numpy as np
+
+GALLERY_DTYPE = os.environ.get("GALLERY_DTYPE", "float32").lower()
+
+# users re-scored exactly after a quantized search
+RESCORE_CANDIDATES = int(os.environ.get("RESCORE_CANDIDATES", 8))
+
+# rows dequantized per block while scoring (bounds temporary memory)
+_BLOCK = 8192
+
+
+# --------------------------------------------------
+# Blob encoding
+# --------------------------------------------------
+def encode(vec, dtype):
+    """Quantized blob for one float32 vector."""
+    vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+    if dtype == "float16":
+        return vec.astype("<f2").tobytes()
+    if dtype == "int8":
+        scale = np.float32(np.abs(vec).max() / 127.0 or 1.0)
+        q = np.clip(np.round(vec / scale), -127, 127).astype(np.int8)
+        return scale.astype("<f4").tobytes() + q.tobytes()
+    return vec.astype("<f4").tobytes()
+
+
+def _unit(vec):
+    return vec / (np.linalg.norm(vec) + 1e-6)
+
+
+def quantized_columns(vec, dtype=None):
+    """(embedding_q, embedding_q_dtype) values to store with a new template."""
+    dtype = dtype or GALLERY_DTYPE
+    if dtype == "float32":
+        return None, None
+    return encode(_unit(np.asarray(vec, dtype=np.float32)), dtype), dtype
+
+
+# --------------------------------------------------
+# Template stores: one per dtype, same interface
+#   len(store), store.shape, store @ q, store[rows] (float32),
+#   np.asarray(store), store.select(mask), store.concat(other)
+# --------------------------------------------------
+class Float32Store:
+    dtype = "float32"
+    exact = True
+
+    def __init__(self, data):
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+
+    @classmethod
+    def from_float32(cls, mat):
+        return cls(mat)
+
+    @classmethod
+    def from_blobs(cls, blobs, dim):
+        return cls(np.frombuffer(b"".join(blobs), dtype="<f4").reshape(-1, dim))
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __matmul__(self, q):
+        return self.data @ q
+
+    def __getitem__(self, rows):
+        return self.data[rows]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data if dtype is None else self.data.astype(dtype)
+
+    def select(self, mask):
+        return type(self)(self.data[mask])
+
+    def concat(self, other):
+        return type(self)(np.vstack([self.data, other.data]))
+
+
+class Float16Store(Float32Store):
+    dtype = "float16"
+    exact = False
+
+    def __init__(self, data):
+        self.data = np.ascontiguousarray(data, dtype=np.float16)
+
+    @classmethod
+    def from_float32(cls, mat):
+        return cls(np.asarray(mat, dtype=np.float32).astype(np.float16))
+
+    @classmethod
+    def from_blobs(cls, blobs, dim):
+        return cls(np.frombuffer(b"".join(blobs), dtype="<f2").reshape(-1, dim))
+
+    def __matmul__(self, q):
+        # q: one query (D,) or several as columns (D, Q)
+        out = np.empty((len(self.data),) + q.shape[1:], dtype=np.float32)
+        for i in range(0, len(self.data), _BLOCK):
+            out[i:i + _BLOCK] = self.data[i:i + _BLOCK].astype(np.float32) @ q
+        return out
+
+    def __getitem__(self, rows):
+        return self.data[rows].astype(np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data.astype(dtype or np.float32)
+
+
+class Int8Store:
+    dtype = "int8"
+    exact = False
+
+    def __init__(self, data, scales):
+        self.data = np.ascontiguousarray(data, dtype=np.int8)
+        self.scales = np.ascontiguousarray(scales, dtype=np.float32)
+
+    @classmethod
+    def from_float32(cls, mat):
+        mat = np.asarray(mat, dtype=np.float32)
+        if mat.size == 0:
+            return cls(np.zeros(mat.shape, dtype=np.int8), np.zeros(len(mat), dtype=np.float32))
+        scales = (np.abs(mat).max(axis=1) / 127.0).astype(np.float32)
+        scales[scales == 0] = 1.0
+        data = np.clip(np.round(mat / scales[:, None]), -127, 127).astype(np.int8)
+        return cls(data, scales)
+
+    @classmethod
+    def from_blobs(cls, blobs, dim):
+        raw = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(-1, 4 + dim)
+        scales = raw[:, :4].copy().view("<f4").reshape(-1)
+        return cls(raw[:, 4:].view(np.int8), scales)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.scales.nbytes
+
+    def __matmul__(self, q):
+        out = np.empty((len(self.data),) + q.shape[1:], dtype=np.float32)
+        for i in range(0, len(self.data), _BLOCK):
+            out[i:i + _BLOCK] = self.data[i:i + _BLOCK].astype(np.float32) @ q
+        return out * (self.scales if q.ndim == 1 else self.scales[:, None])
+
+    def __getitem__(self, rows):
+        return self.data[rows].astype(np.float32) * self.scales[rows][..., None]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.data.astype(np.float32) * self.scales[:, None]
+        return out if dtype is None else out.astype(dtype)
+
+    def select(self, mask):
+        return Int8Store(self.data[mask], self.scales[mask])
+
+    def concat(self, other):
+        return Int8Store(np.vstack([self.data, other.data]), np.concatenate([self.scales, other.scales]))
+
+
+STORES = {"float32": Float32Store, "float16": Float16Store, "int8": Int8Store}
+
+
+def store_class(dtype=None):
+    return STORES.get(dtype or GALLERY_DTYPE, Float32Store)
+
+
+# --------------------------------------------------
+# Migration CLI
+# --------------------------------------------------
+def migrate(dtype, batch=1000):
+    """Write quantized copies of every template not yet stored as dtype."""
+    from database.db import db_conn
+
+    conn = db_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, embedding FROM user_embeddings
+        WHERE embedding_q_dtype IS NOT ?
+    """, (dtype,))
+    rows = cur.fetchall()
+
+    done = 0
+    for i in range(0, len(rows), batch):
+        chunk = rows[i:i + batch]
+        cur.executemany(
+            "UPDATE user_embeddings SET embedding_q=?, embedding_q_dtype=? WHERE id=?",
+            [(encode(_unit(np.frombuffer(blob, dtype=np.float32)), dtype), dtype, rid) for rid, blob in chunk]
+        )
+        conn.commit()
+        done += len(chunk)
+        print(f"{done}/{len(rows)} templates converted to {dtype}")
+
+    conn.close()
+    return done
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m services.quantization")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    mig = sub.add_parser("migrate", help="store quantized copies of existing templates")
+    mig.add_argument("--dtype", choices=["float16", "int8"],
+                     default=GALLERY_DTYPE if GALLERY_DTYPE != "float32" else "int8")
+    args = parser.parse_args(argv)
+
+    from database.db import ensure_tables
+    ensure_tables()
+
+    migrate(args.dtype)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# services/recognition_session.py
+# ------------------------------------------------------
+# Multi-frame recognition: a kiosk opens a session and streams small
+# frames; each frame's embedding is scored on its own (a vote) and added
+# to a running mean embedding. The session decides as soon as
+#   - one frame is a strong, unambiguous match (STRONG_ACCEPT_THRESHOLD), or
+#   - FRAME_VOTES_REQUIRED frames voted for the same user and the mean
+#     embedding agrees with them,
+# and gives up after SESSION_MAX_FRAMES frames.
+#
+# Session state lives on the server, in a bounded per-process TTL cache;
+# the client only holds an opaque random token used to look it up. Frame
+# counts and votes can therefore not be reset or forked by replaying an
+# older request, a decided session is removed at once, and one that
+# stops sending frames expires after RECOGNITION_SESSION_TTL seconds.
+# A frame that reaches a worker process without the session gets a 404,
+# and the kiosk falls back to a single-frame /api/recognize.
+# ------------------------------------------------------
+
+import os
+import uuid
+import secrets
+import threading
+from collections import Counter
+
+import numpy as np
+
+from utils.ttl_cache import TTLCache
+
+FRAME_VOTES_REQUIRED = int(os.environ.get("FRAME_VOTES_REQUIRED", 3))
+SESSION_MAX_FRAMES = int(os.environ.get("SESSION_MAX_FRAMES", 15))
+SESSION_TTL = float(os.environ.get("RECOGNITION_SESSION_TTL", 30))    # seconds idle
+SESSION_MAX = int(os.environ.get("RECOGNITION_SESSION_MAX", 1000))
+
+
+class RecognitionSession:
+    def __init__(self, device="camera"):
+        self.id = uuid.uuid4().hex
+        self.token = secrets.token_urlsafe(24)      # lookup key, never derived from state
+        self.device = device
+        self.frames = 0
+        self.faces = 0
+        self.votes = Counter()
+        self.emb_sum = None
+        self.model_version = None
+        self.closed = False
+        self.lock = threading.Lock()                # one frame at a time
+
+    def add_embedding(self, emb, model_version):
+        """Running sum of the frame embeddings (restarted on a model switch)."""
+        if self.model_version != model_version or self.emb_sum is None:
+            self.emb_sum = np.zeros_like(emb, dtype=np.float32)
+            self.votes.clear()
+            self.model_version = model_version
+        self.emb_sum += emb
+        self.faces += 1
+
+    def mean_embedding(self):
+        return self.emb_sum / (np.linalg.norm(self.emb_sum) + 1e-6)
+
+    def summary(self):
+        return {
+            "session_id": self.id,
+            "frames": self.frames,
+            "faces": self.faces,
+            "votes": {str(k): v for k, v in self.votes.items()},
+        }
+
+
+_sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
+
+
+def create_session(device="camera"):
+    session = RecognitionSession(device)
+    _sessions.set(session.token, session)
+    return session
+
+
+def get_session(token):
+    """The live session for token, None when unknown, expired or decided."""
+    if not token:
+        return None
+    return _sessions.get(token)
+
+
+def close_session(session):
+    """A decided session: later frames with its token get None / 404."""
+    session.closed = True
+    _sessions.pop(session.token)
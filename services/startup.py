@@ -0,0 +1,97 @@
+# services/startup.py
+# ------------------------------------------------------
+# Process startup in two phases.
+#
+#   prepare()       once, before workers fork (gunicorn preload_app: in
+#                   the master, see gunicorn.conf.py)
+#                   - verify model files against ml/models.json (stat /
+#                     hash-cache; downloads missing ones unless
+#                     MODEL_AUTO_DOWNLOAD=0, see ml/download_models.py)
+#                   - create / migrate tables
+#                   - load the embedding gallery; its numpy arrays are then
+#                     shared copy-on-write by every forked worker
+#
+#   start_worker()  in every serving process (post_fork hook, or the first
+#                   request when run without gunicorn.conf.py)
+#                   - builds the ONNX sessions in a background thread and runs
+#                     one dummy inference each, so the first real request
+#                     does not pay for graph optimization / arena allocation
+#                   - starts the background job workers
+#
+# ONNX Runtime sessions own thread pools, which do not survive fork(), so
+# they are created per worker and never in the master.
+#
+# /readyz reports ready only once this process is warm.
+# ------------------------------------------------------
+
+import os
+import time
+import threading
+
+import numpy as np
+
+_lock = threading.Lock()
+_ready = threading.Event()
+_worker_pid = None
+_status = {"stage": "cold", "error": None, "warmup_seconds": None}
+
+
+def prepare():
+    """Shared, fork-safe startup work (no ONNX sessions, no threads)."""
+    from ml.download_models import verify_models
+    from database.db import ensure_tables
+    from services.embedding_service import load_gallery
+
+    print("🚀 Preparing app: models, database, gallery...")
+    verify_models()
+    ensure_tables()
+    load_gallery()
+    print("✅ Prepared")
+
+
+def warmup():
+    """Build this process's models and run one inference through each."""
+    from ml.registry import get_detector
+    from services.embedding_service import active_embedder
+
+    t0 = time.perf_counter()
+    try:
+        _status["stage"] = "loading models"
+        detector = get_detector()
+        embedder = active_embedder()
+
+        _status["stage"] = "warming up"
+        size = detector.input_size
+        detector.detect(np.zeros((size, size, 3), dtype=np.uint8))
+        embedder.get_embeddings([np.zeros((112, 112, 3), dtype=np.uint8)])
+
+        _status["stage"] = "ready"
+        _status["warmup_seconds"] = round(time.perf_counter() - t0, 2)
+        _ready.set()
+        print(f"🔥 Worker {os.getpid()} warm in {_status['warmup_seconds']}s")
+    except Exception as e:
+        _status["stage"] = "failed"
+        _status["error"] = f"{type(e).__name__}: {e}"
+        print("Warmup failed:", e)
+
+
+def start_worker():
+    """Per-process startup; cheap no-op after the first call in a process."""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_pid = os.getpid()
+
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+    from services.job_queue import start_workers
+    # JOB_WORKERS=0 when the queue is drained by `python -m services.job_queue`
+    start_workers(int(os.environ.get("JOB_WORKERS", 1)))
+
+
+def readiness():
+    """(ready, details)"""
+    return _ready.is_set(), dict(_status, pid=os.getpid())
@@ -0,0 +1,300 @@
+# services/vector_index.py
+# ------------------------------------------------------
+# Search backends behind the in-memory gallery (services/embedding_service.py)
+#
+#   exact : brute-force cosine over every template (default)
+#   ivf   : inverted-file index — k-means centroids over the templates,
+#           a query only scores the templates of its nprobe nearest lists
+#
+# Both return one score per user (best template), so the REJECT_THRESHOLD /
+# TOP2_MARGIN logic in /api/recognize works the same on either.
+#
+# Config (environment):
+#   GALLERY_INDEX      exact | ivf                         (default: exact)
+#   IVF_NLIST          number of lists (default: ~4*sqrt(templates))
+#   IVF_NPROBE         lists scanned per query — recall/latency knob (default: 8)
+#   IVF_MIN_TEMPLATES  below this the exact backend is used anyway (default: 5000)
+#   GALLERY_INDEX_DIR  where trained IVF centroids are stored
+#
+# Command line:
+#   python -m services.vector_index build            train + persist IVF
+#   python -m services.vector_index eval [options]   recall vs exact
+# ------------------------------------------------------
+
+import os
+import time
+import hashlib
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+
+INDEX_KIND = os.environ.get("GALLERY_INDEX", "exact").lower()
+IVF_NLIST = int(os.environ.get("IVF_NLIST", 0))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 8))
+IVF_MIN_TEMPLATES = int(os.environ.get("IVF_MIN_TEMPLATES", 5000))
+INDEX_DIR = Path(os.environ.get("GALLERY_INDEX_DIR", BASE_DIR / "storage" / "index"))
+
+# k-means is trained on at most this many templates
+IVF_TRAIN_SAMPLE = 50_000
+
+
+def _row_user_starts(starts, n_rows):
+    """For every template row, the first row of its user."""
+    counts = np.diff(np.r_[starts, n_rows])
+    return np.repeat(starts, counts)
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class ExactIndex:
+    """Brute force: one matrix-vector product + segment-max."""
+
+    kind = "exact"
+
+    def __init__(self, matrix, ids, starts):
+        self.matrix = matrix
+        self.starts = starts
+
+    def top_k(self, query, k):
+        """
+        Returns (first template row of each hit user, score), best first.
+        """
+        if len(self.starts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = np.maximum.reduceat(self.matrix @ query, self.starts)
+        top = _top_k(scores, k)
+        return self.starts[top], scores[top]
+
+
+class IVFIndex:
+    """
+    Inverted-file index over the template rows. Centroids are trained once
+    (and persisted); after adding or removing users only the new rows are
+    assigned to lists (see build_index(kept=...)).
+    """
+
+    kind = "ivf"
+
+    def __init__(self, matrix, ids, starts, centroids, nprobe=IVF_NPROBE, assign=None):
+        self.matrix = matrix
+        self.starts = starts
+        self.centroids = centroids
+        self.nprobe = max(1, min(int(nprobe), len(centroids)))
+        self.row_user = _row_user_starts(starts, len(matrix))
+
+        if assign is None:
+            assign = _assign(matrix, centroids)
+        self.assign = assign
+
+        # lists as one sorted permutation + offsets
+        self.order = np.argsort(assign, kind="stable")
+        self.offsets = np.searchsorted(assign[self.order], np.arange(len(centroids) + 1))
+
+    def top_k(self, query, k, nprobe=None):
+        nprobe = self.nprobe if nprobe is None else max(1, min(int(nprobe), len(self.centroids)))
+        probe = _top_k(self.centroids @ query, nprobe)
+        rows = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probe])
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = self.matrix[rows] @ query
+
+        # best template per candidate user
+        users, inv = np.unique(self.row_user[rows], return_inverse=True)
+        best = np.full(len(users), -np.inf, dtype=np.float32)
+        np.maximum.at(best, inv, scores)
+
+        top = _top_k(best, k)
+        return users[top], best[top]
+
+
+# --------------------------------------------------
+# Training / persistence
+# --------------------------------------------------
+def _assign(matrix, centroids, chunk=65536):
+    out = np.empty(len(matrix), dtype=np.int64)
+    for i in range(0, len(matrix), chunk):
+        out[i:i + chunk] = np.argmax(matrix[i:i + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def default_nlist(n_rows):
+    return IVF_NLIST or max(1, int(4 * np.sqrt(n_rows)))
+
+
+def train_centroids(matrix, nlist, seed=0):
+    from sklearn.cluster import MiniBatchKMeans
+
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(matrix)
+    if len(matrix) > IVF_TRAIN_SAMPLE:
+        sample = matrix[rng.choice(len(matrix), IVF_TRAIN_SAMPLE, replace=False)]
+    nlist = max(1, min(nlist, len(sample)))
+
+    km = MiniBatchKMeans(n_clusters=nlist, batch_size=4096, n_init=1, random_state=seed)
+    km.fit(sample)
+    centroids = km.cluster_centers_.astype(np.float32)
+    return centroids / (np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-6)
+
+
+def _fingerprint(ids):
+    return hashlib.sha1(np.ascontiguousarray(ids).tobytes()).hexdigest()
+
+
+def _index_path(tag):
+    return INDEX_DIR / f"ivf_{tag}.npz"
+
+
+def index_tag(model_version):
+    """Centroids are trained per embedding model version."""
+    if not model_version:
+        return "default"
+    return hashlib.sha1(model_version.encode()).hexdigest()[:12]
+
+
+def save_ivf(index, ids, tag="default"):
+    INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    path = _index_path(tag)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(
+        tmp,
+        centroids=index.centroids,
+        assign=index.assign,
+        fingerprint=np.asarray(_fingerprint(ids)),
+        trained_rows=np.asarray(len(ids)),
+    )
+    os.replace(tmp, path)
+
+
+def load_ivf(tag="default"):
+    """Returns the saved npz contents as a dict, or None."""
+    path = _index_path(tag)
+    if not path.exists():
+        return None
+    try:
+        with np.load(path) as data:
+            return {k: data[k] for k in data.files}
+    except Exception as e:
+        print("Could not read IVF index:", e)
+        return None
+
+
+def build_index(matrix, ids, starts, previous=None, retrain=False, tag="default", kept=None):
+    """
+    Index for the given gallery arrays, following GALLERY_INDEX.
+    previous: the index being replaced (its centroids are reused).
+    kept: boolean mask over previous's rows when matrix is those rows (in
+          order) followed by new rows; the kept rows keep their list
+          assignment and only the new rows are assigned.
+    """
+    if INDEX_KIND != "ivf" or len(matrix) < IVF_MIN_TEMPLATES:
+        return ExactIndex(matrix, ids, starts)
+
+    if not retrain and isinstance(previous, IVFIndex) and previous.centroids.shape[1] == matrix.shape[1]:
+        assign = None
+        if kept is not None and len(kept) == len(previous.assign):
+            old = previous.assign[kept]
+            new_rows = matrix[len(old):] if len(matrix) > len(old) else None
+            assign = old if new_rows is None else np.concatenate(
+                [old, _assign(new_rows, previous.centroids)])
+        return IVFIndex(matrix, ids, starts, previous.centroids, assign=assign)
+
+    saved = None if retrain else load_ivf(tag)
+    if saved is not None and saved["centroids"].shape[1] == matrix.shape[1] \
+            and len(matrix) <= 2 * int(saved["trained_rows"]):
+        assign = saved["assign"] if str(saved["fingerprint"]) == _fingerprint(ids) else None
+        return IVFIndex(matrix, ids, starts, saved["centroids"], assign=assign)
+
+    # no usable centroids (or the gallery doubled since training): train
+    index = IVFIndex(matrix, ids, starts, train_centroids(matrix, default_nlist(len(matrix))))
+    try:
+        save_ivf(index, ids, tag)
+    except OSError as e:
+        print("Could not save IVF index:", e)
+    return index
+
+
+# --------------------------------------------------
+# CLI: build / eval
+# --------------------------------------------------
+def evaluate(matrix, ids, starts, n_queries=500, k=2, noise=0.05, nprobes=(1, 2, 4, 8, 16, 32), seed=0):
+    """
+    recall@k of IVF against exact search. Queries are gallery templates
+    plus Gaussian noise (re-normalized), like a fresh capture of an
+    enrolled face.
+    """
+    rng = np.random.default_rng(seed)
+    pick = rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)
+    queries = matrix[pick] + rng.normal(scale=noise, size=(len(pick), matrix.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-6
+
+    exact = ExactIndex(matrix, ids, starts)
+    t0 = time.perf_counter()
+    truth = [set(exact.top_k(q, k)[0].tolist()) for q in queries]
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+
+    t0 = time.perf_counter()
+    centroids = train_centroids(matrix, default_nlist(len(matrix)))
+    train_s = time.perf_counter() - t0
+    ivf = IVFIndex(matrix, ids, starts, centroids)
+
+    print(f"templates={len(matrix)} users={len(starts)} nlist={len(centroids)} "
+          f"train={train_s:.1f}s queries={len(queries)} k={k}")
+    print(f"exact          {exact_ms:8.3f} ms/query")
+    for nprobe in nprobes:
+        if nprobe > len(centroids):
+            break
+        t0 = time.perf_counter()
+        hits = 0
+        for q, want in zip(queries, truth):
+            got = set(ivf.top_k(q, k, nprobe=nprobe)[0].tolist())
+            hits += len(got & want)
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        recall = hits / max(1, sum(len(t) for t in truth))
+        print(f"ivf nprobe={nprobe:<4} {ms:8.3f} ms/query  recall@{k}={recall:.4f}")
+
+
+def main(argv=None):
+    import argparse
+    from services.embedding_service import gallery
+
+    parser = argparse.ArgumentParser(prog="python -m services.vector_index")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("build", help="train IVF centroids on the gallery and save them")
+    ev = sub.add_parser("eval", help="recall / latency of IVF vs exact on the gallery")
+    ev.add_argument("--queries", type=int, default=500)
+    ev.add_argument("--k", type=int, default=2)
+    ev.add_argument("--noise", type=float, default=0.05)
+    ev.add_argument("--nprobe", type=int, nargs="*", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args(argv)
+
+    from database.db import ensure_tables
+    ensure_tables()
+
+    gallery.load()
+    matrix, ids, _, starts = gallery.arrays()
+    if len(matrix) == 0:
+        print("Gallery is empty")
+        return
+
+    if args.cmd == "build":
+        tag = index_tag(gallery.model_version)
+        index = IVFIndex(matrix, ids, starts, train_centroids(matrix, default_nlist(len(matrix))))
+        save_ivf(index, ids, tag)
+        print(f"Saved IVF index ({len(index.centroids)} lists, {len(matrix)} templates) to {_index_path(tag)}")
+    else:
+        evaluate(matrix, ids, starts, args.queries, args.k, args.noise, tuple(args.nprobe))
+
+
+if __name__ == "__main__":
+    main()
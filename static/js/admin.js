@@ -74,15 +74,33 @@ async function loadPendingTo(containerId = 'pendingList') {
     }
 }
 
+// Approval runs as a background job: poll it until it finishes
+async function waitForJob(jobId, intervalMs = 1000) {
+    while (true) {
+        const job = await getJson(`/api/admin/jobs/${jobId}`);
+        if (job.status === 'done' || job.status === 'failed') return job;
+        await new Promise(r => setTimeout(r, intervalMs));
+    }
+}
+
 async function adminApprove(id) {
     try {
         const res = await postJson('/api/admin/approve', { pending_id: id });
-        if (res.status === 'approved') {
-            alert(`Approved: User ID ${res.user_id}`);
-        } else if (res.error) {
+        if (res.error) {
             alert(`Error: ${res.error}`);
-        } else {
+            return;
+        }
+        if (res.status !== 'queued') {
             alert('Approval failed');
+            return;
+        }
+
+        const job = await waitForJob(res.job_id);
+        if (job.status === 'done') {
+            alert(`Approved: User ID ${job.result.user_id}`);
+        } else {
+            const msg = (job.result && job.result.message) || job.error || 'Approval failed';
+            alert(`Error: ${msg}`);
         }
     } catch (e) {
         console.error(e);
@@ -93,6 +111,50 @@ async function adminApprove(id) {
     }
 }
 
+// Bulk jobs report images/sec in their result
+async function adminApproveAll() {
+    if (!confirm('Approve every pending enrollment?')) return;
+    try {
+        const res = await postJson('/api/admin/approve_bulk', { pending_ids: 'all' });
+        if (res.error) {
+            alert(`Error: ${res.error}`);
+            return;
+        }
+        const job = await waitForJob(res.job_id, 2000);
+        if (job.status === 'done') {
+            const r = job.result;
+            alert(`Approved ${r.approved.length}, failed ${r.failed.length} ` +
+                  `(${r.images} images, ${r.images_per_sec} images/s)`);
+        } else {
+            alert(`Error: ${job.error || 'Bulk approval failed'}`);
+        }
+    } catch (e) {
+        console.error(e);
+        alert('Bulk approval request failed');
+    } finally {
+        if (typeof loadPendingTo === 'function') loadPendingTo();
+        if (typeof loadUsers === 'function') loadUsers();
+    }
+}
+
+async function adminReembedAll() {
+    if (!confirm('Recompute embeddings for every user?')) return;
+    try {
+        const res = await postJson('/api/admin/reembed_all', {});
+        const job = await waitForJob(res.job_id, 2000);
+        if (job.status === 'done') {
+            const r = job.result;
+            alert(`Re-embedded ${r.updated} users, skipped ${r.skipped.length} ` +
+                  `(${r.images} images, ${r.images_per_sec} images/s)`);
+        } else {
+            alert(`Error: ${job.error || 'Re-embedding failed'}`);
+        }
+    } catch (e) {
+        console.error(e);
+        alert('Re-embed request failed');
+    }
+}
+
 async function adminReject(id) {
     try {
         await postJson('/api/admin/reject', { pending_id: id });
@@ -6,6 +6,21 @@ const resultTitle = document.getElementById("resultTitle");
 const resultDetails = document.getElementById("resultDetails");
 const resultIcon = document.getElementById("resultIcon");
 
+/* -------------------------
+   KIOSK ID
+   stable per browser; the server tracks faces per kiosk
+------------------------- */
+function kioskId() {
+    let id = localStorage.getItem("kioskId");
+    if (!id) {
+        id = (crypto.randomUUID ? crypto.randomUUID() : String(Math.random()).slice(2));
+        localStorage.setItem("kioskId", id);
+    }
+    return id;
+}
+
+const KIOSK_ID = kioskId();
+
 /* -------------------------
    CAMERA SETUP
 ------------------------- */
@@ -30,17 +45,77 @@ async function startCamera() {
 startCamera();
 
 /* -------------------------
-   CAPTURE FRAME
+   CAPTURE FRAME (binary JPEG blob, no base64)
 ------------------------- */
-function captureFrame() {
+function captureFrame(maxWidth) {
     const canvas = document.createElement("canvas");
-    canvas.width = video.videoWidth || 480;
-    canvas.height = video.videoHeight || 360;
+    const width = video.videoWidth || 480;
+    const height = video.videoHeight || 360;
+    const scale = maxWidth ? Math.min(1, maxWidth / width) : 1;
+    canvas.width = Math.round(width * scale);
+    canvas.height = Math.round(height * scale);
 
     const ctx = canvas.getContext("2d");
     ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-    return canvas.toDataURL("image/jpeg", 0.9);
+    return new Promise((resolve, reject) => {
+        canvas.toBlob(
+            blob => blob ? resolve(blob) : reject(new Error("Frame capture failed")),
+            "image/jpeg",
+            0.9
+        );
+    });
+}
+
+/* -------------------------
+   RECOGNITION SESSION
+   streams small frames until the server decides
+   (falls back to a single full frame)
+------------------------- */
+const SESSION_FRAME_WIDTH = 320;
+const SESSION_FRAME_GAP_MS = 80;
+
+async function recognizeSingleFrame() {
+    const image = await captureFrame();
+
+    // raw JPEG body; device matches backend
+    const res = await fetch(`/api/recognize?device=camera&kiosk=${encodeURIComponent(KIOSK_ID)}`, {
+        method: "POST",
+        headers: { "Content-Type": "image/jpeg" },
+        body: image
+    });
+    return res.json();
+}
+
+async function recognizeSession() {
+    const open = await fetch("/api/recognize/session", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ device: "camera" })
+    });
+    if (!open.ok) return recognizeSingleFrame();
+
+    const session = await open.json();
+    const token = session.session_token;
+
+    for (let i = 0; i < session.max_frames; i++) {
+        const frame = await captureFrame(SESSION_FRAME_WIDTH);
+        const res = await fetch("/api/recognize/session/frame", {
+            method: "POST",
+            headers: { "Content-Type": "image/jpeg", "X-Session-Token": token },
+            body: frame
+        });
+
+        // session expired / held by another worker: one full frame instead
+        if (res.status === 404) return recognizeSingleFrame();
+
+        const data = await res.json();
+        if (!res.ok || data.status !== "pending") return data;
+
+        markBtn.innerText = `Processing... (${data.frames}/${session.max_frames})`;
+        await new Promise(r => setTimeout(r, SESSION_FRAME_GAP_MS));
+    }
+    return recognizeSingleFrame();
 }
 
 /* -------------------------
@@ -52,18 +127,7 @@ markBtn.onclick = async () => {
     resultBox.classList.add("hidden");
 
     try {
-        const image = captureFrame();
-
-        const res = await fetch("/api/recognize", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                image,
-                device: "camera"   // matches backend
-            })
-        });
-
-        const data = await res.json();
+        const data = await recognizeSession();
 
         resultBox.classList.remove("hidden", "success", "error");
 
@@ -0,0 +1,58 @@
+# tests/conftest.py
+# ------------------------------------------------------
+# Shared fixtures: every test that touches SQLite gets its own database
+# file (database/db.py pointed at tmp_path, fresh pool, tables created);
+# gallery tests also get an active model and helpers to enroll users.
+# ------------------------------------------------------
+
+import numpy as np
+import pytest
+
+import database.db as db
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    db.close_all()
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "attendance.db")
+    monkeypatch.setattr(db, "_tables_ready", False)
+    db.ensure_tables()
+    yield db
+    db.close_all()
+
+
+MODEL_VERSION = "arcface.onnx:test:112-rgb-nhwc-m127.5s128"
+
+
+@pytest.fixture
+def gallery_db(fresh_db):
+    """fresh_db with an active embedding model recorded (no model files needed)."""
+    from services.model_version import ACTIVE_MODEL_KEY, ACTIVE_VERSION_KEY
+
+    conn = fresh_db.db_conn()
+    conn.execute("INSERT INTO settings (key, value) VALUES (?, 'arcface.onnx'), (?, ?)",
+                 (ACTIVE_MODEL_KEY, ACTIVE_VERSION_KEY, MODEL_VERSION))
+    conn.commit()
+    conn.close()
+    return fresh_db
+
+
+def add_user(db, user_id, name, templates, dtype=None):
+    """Insert a user and its float32 templates (plus quantized copies as dtype)."""
+    from services.quantization import quantized_columns
+
+    conn = db.db_conn()
+    conn.execute("INSERT INTO users (id, name, folder) VALUES (?, ?, '')", (user_id, name))
+    conn.executemany(
+        "INSERT INTO user_embeddings (user_id, embedding, embedding_q, embedding_q_dtype, model_version) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(user_id, np.asarray(t, dtype=np.float32).tobytes(), *quantized_columns(t, dtype or "float32"),
+          MODEL_VERSION) for t in templates]
+    )
+    conn.commit()
+    conn.close()
+
+
+def unit_rows(n, dim=512, seed=0):
+    rows = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
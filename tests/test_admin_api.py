@@ -0,0 +1,97 @@
+# tests/test_admin_api.py
+# ------------------------------------------------------
+# Admin endpoints on a bare Flask app (no models, no startup): input
+# validation and reuse of jobs already in flight.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+import api.admin_api as admin_api
+from api.admin_api import admin_bp
+
+
+@pytest.fixture
+def client(fresh_db):
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.register_blueprint(admin_bp, url_prefix="/api/admin")
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["is_admin"] = True
+    return client
+
+
+def test_approve_bulk_reuses_job_in_flight(client):
+    first = client.post("/api/admin/approve_bulk", json={"pending_ids": "all"}).get_json()
+    again = client.post("/api/admin/approve_bulk", json={}).get_json()
+    assert again["job_id"] == first["job_id"]
+
+    some = client.post("/api/admin/approve_bulk", json={"pending_ids": [3, 1, 2]}).get_json()
+    same = client.post("/api/admin/approve_bulk", json={"pending_ids": [1, 2, 3, 3]}).get_json()
+    other = client.post("/api/admin/approve_bulk", json={"pending_ids": [1, 2]}).get_json()
+    assert some["job_id"] == same["job_id"]
+    assert len({first["job_id"], some["job_id"], other["job_id"]}) == 3
+
+
+def test_approve_bulk_enqueues_again_once_finished(client, fresh_db):
+    first = client.post("/api/admin/approve_bulk", json={"pending_ids": "all"}).get_json()
+    conn = fresh_db.db_conn()
+    conn.execute("UPDATE jobs SET status='done' WHERE id=?", (first["job_id"],))
+    conn.commit()
+    conn.close()
+
+    again = client.post("/api/admin/approve_bulk", json={"pending_ids": "all"}).get_json()
+    assert again["job_id"] != first["job_id"]
+
+
+def test_approve_bulk_rejects_bad_ids(client):
+    resp = client.post("/api/admin/approve_bulk", json={"pending_ids": ["x"]})
+    assert resp.status_code == 400
+
+
+@pytest.fixture
+def present_user(fresh_db, monkeypatch):
+    import services.attendance_service as attendance
+
+    monkeypatch.setattr(attendance.writer, "present", attendance.PresenceBitmap())
+    # no gallery / models here; the gallery itself follows the change-feed
+    monkeypatch.setattr(admin_api, "gallery", SimpleNamespace(sync=lambda: None))
+    conn = fresh_db.db_conn()
+    conn.execute("INSERT INTO users (id, name, folder) VALUES (5, 'Ann', '')")
+    conn.commit()
+    conn.close()
+
+    attendance.mark_attendance(5)
+    day = attendance.attendance_now().strftime("%Y-%m-%d")
+    assert attendance.writer.present.contains(5, day)
+    return attendance, day
+
+
+def test_delete_user_accepts_string_id(client, fresh_db, present_user):
+    attendance, day = present_user
+    resp = client.post("/api/admin/delete_user", json={"id": "5"})
+    assert resp.status_code == 200 and resp.get_json()["user_id"] == 5
+
+    conn = fresh_db.db_conn()
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+    conn.close()
+    assert not attendance.writer.present.contains(5, day)
+
+
+@pytest.mark.parametrize("bad", ["x", [5], {"id": 5}, "1.5"])
+def test_delete_user_rejects_bad_id_before_deleting(client, fresh_db, present_user, bad):
+    resp = client.post("/api/admin/delete_user", json={"id": bad})
+    assert resp.status_code == 400
+
+    conn = fresh_db.db_conn()
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 1
+    conn.close()
+
+
+def test_delete_user_requires_id(client):
+    assert client.post("/api/admin/delete_user", json={}).status_code == 400
@@ -0,0 +1,172 @@
+# tests/test_attendance.py
+# ------------------------------------------------------
+# Batched attendance writer: one row per user and day however many
+# requests race, one transaction for many callers, and definite results
+# for every caller. The per-day presence bitmap answers repeat scans
+# without the database.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import threading
+from datetime import datetime
+
+import pytest
+
+import services.attendance_service as attendance
+
+
+@pytest.fixture
+def writer(fresh_db, monkeypatch):
+    w = attendance.AttendanceWriter()
+    monkeypatch.setattr(attendance, "writer", w)
+    conn = fresh_db.db_conn()
+    conn.executemany("INSERT INTO users (id, name, folder) VALUES (?, ?, '')",
+                     [(i, f"user{i}") for i in range(1, 11)])
+    conn.commit()
+    conn.close()
+    return w
+
+
+def _rows(db):
+    conn = db.db_conn()
+    rows = conn.execute("SELECT user_id, COUNT(*) FROM attendance GROUP BY user_id ORDER BY user_id").fetchall()
+    conn.close()
+    return {r[0]: r[1] for r in rows}
+
+
+def test_first_mark_then_already_marked(writer, fresh_db):
+    assert attendance.mark_attendance(1) == attendance.MARKED
+    assert attendance.mark_attendance(1) == attendance.ALREADY_MARKED
+    assert attendance.mark_attendance(99) == attendance.NOT_FOUND
+    assert _rows(fresh_db) == {1: 1}
+
+
+def test_racing_requests_mark_each_user_once(writer, fresh_db):
+    results = []
+    barrier = threading.Barrier(40)
+
+    def scan(user_id):
+        barrier.wait()
+        results.append((user_id, attendance.mark_attendance(user_id)))
+
+    threads = [threading.Thread(target=scan, args=(1 + i % 10,)) for i in range(40)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert _rows(fresh_db) == {u: 1 for u in range(1, 11)}
+    marked = [u for u, r in results if r == attendance.MARKED]
+    assert sorted(marked) == list(range(1, 11))
+    assert all(r == attendance.ALREADY_MARKED for u, r in results if r != attendance.MARKED)
+
+
+def test_concurrent_callers_share_a_transaction(writer, fresh_db, monkeypatch):
+    monkeypatch.setattr(attendance, "ATTENDANCE_FLUSH_MS", 200)
+    batches = []
+    flush = writer._flush
+    monkeypatch.setattr(writer, "_flush", lambda batch: (batches.append(len(batch)), flush(batch)))
+
+    barrier = threading.Barrier(10)
+
+    def scan(user_id):
+        barrier.wait()
+        attendance.mark_attendance(user_id)
+
+    threads = [threading.Thread(target=scan, args=(u,)) for u in range(1, 11)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sum(batches) == 10 and len(batches) < 10
+    assert _rows(fresh_db) == {u: 1 for u in range(1, 11)}
+
+
+def test_mark_many_in_one_call(writer, fresh_db):
+    attendance.mark_attendance(2)
+    results = attendance.mark_attendance_many([1, 2, 3, 99, 1])
+    assert results == {
+        1: attendance.MARKED,
+        2: attendance.ALREADY_MARKED,
+        3: attendance.MARKED,
+        99: attendance.NOT_FOUND,
+    }
+
+
+def test_unbatched_mode_writes_in_the_caller(writer, fresh_db, monkeypatch):
+    monkeypatch.setattr(attendance, "ATTENDANCE_BATCHING", False)
+    assert attendance.mark_attendance(4) == attendance.MARKED
+    assert attendance.mark_attendance(4) == attendance.ALREADY_MARKED
+    assert writer._queue is None            # no writer thread was started
+
+
+def test_write_errors_reach_the_caller(writer, monkeypatch):
+    def broken(batch):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(writer, "_flush", broken)
+    with pytest.raises(RuntimeError, match="disk full"):
+        attendance.mark_attendance(5)
+
+
+# --------------------------------------------------
+# Presence bitmap
+# --------------------------------------------------
+def _insert(db, user_id, day):
+    conn = db.db_conn()
+    conn.execute("INSERT INTO attendance (user_id, timestamp, device, attendance_date) VALUES (?, ?, 'test', ?)",
+                 (user_id, f"{day} 09:00:00", day))
+    conn.commit()
+    conn.close()
+
+
+def test_bitmap_loads_the_day_from_the_database(writer, fresh_db):
+    today = attendance.attendance_now().strftime("%Y-%m-%d")
+    _insert(fresh_db, 9, today)
+    _insert(fresh_db, 3, "2000-01-01")
+
+    bitmap = attendance.PresenceBitmap()
+    assert bitmap.contains(9, today)
+    assert not bitmap.contains(3, today)
+    assert not bitmap.contains(1000, today)     # past the end of the bitmap
+    assert bitmap.contains(3, "2000-01-01") and not bitmap.contains(9, "2000-01-01")
+
+
+def test_repeat_scan_does_not_touch_the_database(writer, monkeypatch):
+    assert attendance.mark_attendance(6) == attendance.MARKED
+
+    def no_db():
+        raise AssertionError("database used for a known mark")
+
+    monkeypatch.setattr(attendance, "db_conn", no_db)
+    assert attendance.mark_attendance(6) == attendance.ALREADY_MARKED
+
+
+def test_mark_by_another_worker_is_already_marked(writer, fresh_db):
+    today = attendance.attendance_now().strftime("%Y-%m-%d")
+    assert not writer.present.contains(7, today)         # bitmap loaded first
+    _insert(fresh_db, 7, today)
+    assert attendance.mark_attendance(7) == attendance.ALREADY_MARKED
+    assert _rows(fresh_db) == {7: 1}
+
+
+def test_day_rollover_starts_an_empty_day(writer, fresh_db, monkeypatch):
+    assert attendance.mark_attendance(8) == attendance.MARKED
+    monkeypatch.setattr(attendance, "attendance_now", lambda: datetime(2099, 1, 2, 8, 30))
+    assert attendance.mark_attendance(8) == attendance.MARKED
+    assert writer.present.day == "2099-01-02"
+    assert _rows(fresh_db) == {8: 2}
+
+
+def test_forget_drops_a_deleted_user(writer, fresh_db):
+    assert attendance.mark_attendance(2) == attendance.MARKED
+    conn = fresh_db.db_conn()
+    conn.execute("DELETE FROM attendance WHERE user_id=2")
+    conn.commit()
+    conn.close()
+
+    attendance.forget_attendance(2)
+    attendance.forget_attendance(5000)          # never present: no error
+    assert attendance.mark_attendance(2) == attendance.MARKED
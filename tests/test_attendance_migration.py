@@ -0,0 +1,82 @@
+# tests/test_attendance_migration.py
+# ------------------------------------------------------
+# attendance_date migration: a database written before the column
+# existed is backfilled from DATE(timestamp), later same-day duplicates
+# lose their key, and the unique index holds afterwards.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import sqlite3
+
+import pytest
+
+import database.db as db
+
+
+LEGACY_ROWS = [
+    (1, "2024-03-01 09:00:00"),
+    (1, "2024-03-01 12:30:00"),     # duplicate from before the dedup
+    (1, "2024-03-02 09:05:00"),
+    (2, "2024-03-01 08:45:00"),
+]
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    path = tmp_path / "attendance.db"
+    conn = sqlite3.connect(path)
+    conn.execute("""
+    CREATE TABLE attendance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        device TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )""")
+    conn.executemany("INSERT INTO attendance (user_id, timestamp, device) VALUES (?, ?, 'camera')", LEGACY_ROWS)
+    conn.commit()
+    conn.close()
+
+    db.close_all()
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(db, "_tables_ready", False)
+    db.ensure_tables()
+    yield db
+    db.close_all()
+
+
+def test_backfill_keeps_first_mark_of_the_day(legacy_db):
+    conn = legacy_db.db_conn()
+    rows = conn.execute("SELECT user_id, timestamp, attendance_date FROM attendance ORDER BY id").fetchall()
+    conn.close()
+
+    assert [tuple(r) for r in rows] == [
+        (1, "2024-03-01 09:00:00", "2024-03-01"),
+        (1, "2024-03-01 12:30:00", None),
+        (1, "2024-03-02 09:05:00", "2024-03-02"),
+        (2, "2024-03-01 08:45:00", "2024-03-01"),
+    ]
+
+
+def test_unique_index_rejects_a_second_mark(legacy_db):
+    conn = legacy_db.db_conn()
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO attendance (user_id, timestamp, attendance_date) "
+                         "VALUES (2, '2024-03-01 17:00:00', '2024-03-01')")
+        conn.execute("INSERT INTO attendance (user_id, timestamp, attendance_date) "
+                     "VALUES (2, '2024-03-02 08:00:00', '2024-03-02')")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_migration_runs_once(legacy_db, monkeypatch):
+    monkeypatch.setattr(legacy_db, "_tables_ready", False)
+    legacy_db.ensure_tables()
+
+    conn = legacy_db.db_conn()
+    keyed = conn.execute("SELECT COUNT(*) FROM attendance WHERE attendance_date IS NOT NULL").fetchone()[0]
+    conn.close()
+    assert keyed == 3
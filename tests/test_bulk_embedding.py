@@ -0,0 +1,62 @@
+# tests/test_bulk_embedding.py
+# ------------------------------------------------------
+# embed_image_groups with a stub detector / embedder (no ONNX models):
+# embeddings are routed back to their group, and inference errors reach
+# the caller instead of turning into empty groups.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import cv2
+import numpy as np
+import pytest
+
+import ml.registry as registry
+from ml.embeddings import embed_image_groups
+
+# five plausible landmarks on a 200x200 frame
+KPS = [(70, 80), (130, 80), (100, 110), (75, 145), (125, 145)]
+
+
+class _Detector:
+    def detect_batch(self, imgs, conf_threshold=0.45):
+        return [[{"box": (40, 40, 120, 140), "score": 0.9, "kps": KPS}] for _ in imgs]
+
+
+class _Embedder:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.seen = 0
+
+    def get_embeddings(self, faces):
+        if self.fail:
+            raise RuntimeError("onnxruntime: session.run failed")
+        rows = np.zeros((len(faces), 512), dtype=np.float32)
+        for i in range(len(faces)):
+            rows[i, self.seen] = 1.0
+            self.seen += 1
+        return rows
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "get_detector", lambda: _Detector())
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"{i}.jpg"
+        cv2.imwrite(str(path), np.full((200, 200, 3), 40 * i, dtype=np.uint8))
+        paths.append(str(path))
+    return paths
+
+
+def test_embeddings_go_back_to_their_group(images):
+    groups = [images[:2], [], images[2:]]
+    out = embed_image_groups(groups, model=_Embedder())
+    assert [len(g) for g in out] == [2, 0, 3]
+    # one row per image, in image order
+    assert [int(np.argmax(r)) for g in out for r in g] == [0, 1, 2, 3, 4]
+
+
+def test_inference_errors_propagate(images):
+    with pytest.raises(RuntimeError, match="session.run failed"):
+        embed_image_groups([images[:2], images[2:]], model=_Embedder(fail=True))
@@ -0,0 +1,129 @@
+# tests/test_gallery_sync.py
+# ------------------------------------------------------
+# In-memory galleries kept in sync through the gallery_changes feed:
+# two GalleryIndex instances stand in for two gunicorn workers sharing
+# one database.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+
+from conftest import add_user, unit_rows, MODEL_VERSION
+from services.embedding_service import GalleryIndex
+
+
+def _users(gallery):
+    _, ids, names, starts = gallery.arrays()
+    return dict(zip(ids[starts].tolist(), names[starts].tolist()))
+
+
+def _exec(db, sql, *params):
+    conn = db.db_conn()
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def _count_loads(gallery, monkeypatch):
+    calls = []
+    load = gallery.load
+    monkeypatch.setattr(gallery, "load", lambda: (calls.append(1), load())[1])
+    return calls
+
+
+def test_changes_reach_the_other_worker(gallery_db):
+    t = unit_rows(3)
+    add_user(gallery_db, 1, "Ann", t[:1])
+    worker_a, worker_b = GalleryIndex(), GalleryIndex()
+    worker_a.load()
+    worker_b.load()
+
+    # approve (on worker A's side): B sees it on its next search
+    add_user(gallery_db, 2, "Bob", t[1:2])
+    hits = worker_b.search(t[1], k=1, model_version=MODEL_VERSION)
+    assert hits[0]["user_id"] == 2 and hits[0]["score"] > 0.99
+
+    _exec(gallery_db, "UPDATE users SET name='Robert' WHERE id=2")
+    worker_b.sync()
+    assert _users(worker_b) == {1: "Ann", 2: "Robert"}
+
+    _exec(gallery_db, "DELETE FROM user_embeddings WHERE user_id=1")
+    _exec(gallery_db, "DELETE FROM users WHERE id=1")
+    worker_b.sync()
+    worker_a.sync()
+    assert _users(worker_b) == _users(worker_a) == {2: "Robert"}
+
+
+def test_extra_template_keeps_rows_grouped(gallery_db):
+    t = unit_rows(4)
+    add_user(gallery_db, 1, "Ann", t[:1])
+    add_user(gallery_db, 2, "Bob", t[1:2])
+    gallery = GalleryIndex()
+    gallery.load()
+
+    conn = gallery_db.db_conn()
+    conn.execute("INSERT INTO user_embeddings (user_id, embedding, model_version) VALUES (1, ?, ?)",
+                 (t[2].tobytes(), MODEL_VERSION))
+    conn.commit()
+    conn.close()
+    gallery.sync()
+
+    _, ids, _, starts = gallery.arrays()
+    assert sorted(ids.tolist()) == [1, 1, 2]
+    assert len(starts) == 2
+    assert gallery.search(t[2], k=1)[0]["user_id"] == 1
+
+
+def test_no_change_costs_no_reload(gallery_db, monkeypatch):
+    add_user(gallery_db, 1, "Ann", unit_rows(1))
+    gallery = GalleryIndex()
+    gallery.load()
+    version = gallery.version
+
+    loads = _count_loads(gallery, monkeypatch)
+    gallery.sync()
+    assert gallery.version == version and not loads
+
+
+def test_worker_behind_the_pruned_feed_reloads_fully(gallery_db, monkeypatch):
+    monkeypatch.setattr(gallery_db, "GALLERY_CHANGES_KEEP", 3)
+    monkeypatch.setattr(gallery_db, "_tables_ready", False)
+    gallery_db.ensure_tables()                  # recreates the prune trigger
+
+    t = unit_rows(8)
+    add_user(gallery_db, 1, "Ann", t[:1])
+    gallery = GalleryIndex()
+    gallery.load()
+
+    for uid in range(2, 8):
+        add_user(gallery_db, uid, f"user{uid}", t[uid:uid + 1])
+    conn = gallery_db.db_conn()
+    count, oldest, newest = conn.execute("SELECT COUNT(*), MIN(seq), MAX(seq) FROM gallery_changes").fetchone()
+    conn.close()
+    assert count == 3 and oldest > gallery.version + 1
+
+    loads = _count_loads(gallery, monkeypatch)
+    gallery.sync()
+    assert loads and gallery.version == newest
+    assert sorted(_users(gallery)) == list(range(1, 8))
+
+    # caught up: the next change is incremental again
+    loads.clear()
+    _exec(gallery_db, "UPDATE users SET name='Zed' WHERE id=7")
+    gallery.sync()
+    assert not loads and _users(gallery)[7] == "Zed"
+
+
+def test_model_switch_reloads(gallery_db):
+    from services.model_version import ACTIVE_VERSION_KEY
+
+    add_user(gallery_db, 1, "Ann", unit_rows(1))
+    gallery = GalleryIndex()
+    gallery.load()
+    assert len(gallery) == 1
+
+    _exec(gallery_db, "UPDATE settings SET value='other' WHERE key=?", ACTIVE_VERSION_KEY)
+    gallery.sync()
+    assert gallery.model_version == "other" and len(gallery) == 0
+    assert gallery.search(np.ones(512, dtype=np.float32), model_version=MODEL_VERSION) == []
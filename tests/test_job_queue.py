@@ -0,0 +1,205 @@
+# tests/test_job_queue.py
+# ------------------------------------------------------
+# Job queue leases (requeue / fail after max_attempts, heartbeat thread)
+# and approvals: one pending enrollment becomes at most one user, however
+# many jobs race for it.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import time
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import services.job_queue as jq
+
+
+def _job(db, job_id):
+    conn = db.db_conn()
+    row = dict(conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone())
+    conn.close()
+    return row
+
+
+def _expire_lease(db, job_id):
+    conn = db.db_conn()
+    conn.execute("UPDATE jobs SET heartbeat_at=? WHERE id=?", (time.time() - jq.LEASE_SECONDS - 1, job_id))
+    conn.commit()
+    conn.close()
+
+
+def test_claim_marks_running(fresh_db):
+    job_id = jq.enqueue("noop", {"x": 1})
+    job = jq._claim("w1")
+    assert job["id"] == job_id and job["status"] == "running"
+    assert job["attempts"] == 1 and job["worker"] == "w1"
+    assert job["payload"] == {"x": 1}
+    assert jq._claim("w2") is None
+
+
+def test_expired_lease_is_requeued_while_attempts_left(fresh_db):
+    job_id = jq.enqueue("noop", max_attempts=2)
+    jq._claim("w1")
+    _expire_lease(fresh_db, job_id)
+
+    job = jq._claim("w2")
+    assert job["id"] == job_id and job["attempts"] == 2 and job["worker"] == "w2"
+
+
+def test_expired_lease_fails_after_max_attempts(fresh_db):
+    job_id = jq.enqueue("noop", max_attempts=1)
+    jq._claim("w1")
+    _expire_lease(fresh_db, job_id)
+
+    assert jq._claim("w2") is None
+    job = _job(fresh_db, job_id)
+    assert job["status"] == "failed"
+    assert job["error"].startswith("lease expired")
+
+
+def test_live_lease_is_not_stolen(fresh_db):
+    jq.enqueue("noop")
+    jq._claim("w1")
+    assert jq._claim("w2") is None
+
+
+def test_heartbeat_refreshes_lease_without_progress(fresh_db, monkeypatch):
+    monkeypatch.setattr(jq, "HEARTBEAT_SECONDS", 0.05)
+
+    def slow(payload, progress):
+        time.sleep(0.3)
+        return {"ok": True}
+
+    monkeypatch.setitem(jq._handlers, "slow", slow)
+    job_id = jq.enqueue("slow")
+    job = jq._claim("w1")
+    claimed_at = job["heartbeat_at"]
+
+    jq.run_job(job)
+    row = _job(fresh_db, job_id)
+    assert row["status"] == "done"
+    assert row["heartbeat_at"] > claimed_at
+
+
+def test_transient_error_is_retried_then_failed(fresh_db, monkeypatch):
+    def flaky(payload, progress):
+        raise jq.TransientJobError("busy")
+
+    monkeypatch.setitem(jq._handlers, "flaky", flaky)
+    monkeypatch.setattr(jq, "RETRY_DELAY", 0)
+    job_id = jq.enqueue("flaky", max_attempts=2)
+
+    jq.run_job(jq._claim("w1"))
+    assert _job(fresh_db, job_id)["status"] == "queued"
+    jq.run_job(jq._claim("w1"))
+    row = _job(fresh_db, job_id)
+    assert row["status"] == "failed" and row["attempts"] == 2
+
+
+def test_job_error_is_not_retried(fresh_db, monkeypatch):
+    def broken(payload, progress):
+        raise jq.JobError("bad input", {"why": "test"})
+
+    monkeypatch.setitem(jq._handlers, "broken", broken)
+    job_id = jq.enqueue("broken")
+    jq.run_job(jq._claim("w1"))
+    row = _job(fresh_db, job_id)
+    assert row["status"] == "failed" and row["attempts"] == 1 and row["error"] == "bad input"
+
+
+# --------------------------------------------------
+# Approvals
+# --------------------------------------------------
+@pytest.fixture
+def pending(fresh_db, tmp_path, monkeypatch):
+    import ml.processor as processor
+    from services.model_version import ACTIVE_VERSION_KEY
+
+    monkeypatch.setattr(processor, "DATASET_DIR", tmp_path / "dataset")
+    folder = tmp_path / "pending" / "ann"
+    folder.mkdir(parents=True)
+    (folder / "0.jpg").write_bytes(b"jpeg")
+
+    conn = fresh_db.db_conn()
+    conn.execute("INSERT INTO settings (key, value) VALUES (?, 'm:1')", (ACTIVE_VERSION_KEY,))
+    cur = conn.execute("INSERT INTO pending_enrollments (name, temp_folder) VALUES ('Ann', ?)", (str(folder),))
+    pid = cur.lastrowid
+    conn.commit()
+    row = conn.execute("SELECT id, name, temp_folder FROM pending_enrollments WHERE id=?", (pid,)).fetchone()
+    conn.close()
+
+    template = np.random.default_rng(0).standard_normal(512).astype(np.float32)
+    return processor, (row, [str(folder / "0.jpg")], [template / np.linalg.norm(template)])
+
+
+def _users(db):
+    conn = db.db_conn()
+    rows = [tuple(r) for r in conn.execute("SELECT id, name FROM users ORDER BY id")]
+    conn.close()
+    return rows
+
+
+def test_pending_row_is_approved_once(fresh_db, pending):
+    processor, item = pending
+
+    saved, gone = processor._save_approvals([item], "m:1")
+    assert len(saved) == 1 and gone == []
+
+    # a second job for the same pending row (another worker's) that read the
+    # pending images before the first one removed them saves nothing
+    image = item[1][0]
+    Path(image).parent.mkdir(parents=True)
+    Path(image).write_bytes(b"jpeg")
+    saved, gone = processor._save_approvals([item], "m:1")
+    assert saved == [] and gone == [item[0]["id"]]
+
+    assert _users(fresh_db) == [(1, "Ann")]
+    leftovers = [p.name for p in processor.DATASET_DIR.iterdir()]
+    assert leftovers == ["Ann__u1"]
+
+
+def test_racing_approvals_create_one_user(fresh_db, pending):
+    processor, item = pending
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def approve():
+        barrier.wait()
+        try:
+            outcomes.append(processor._save_approvals([item], "m:1"))
+        except OSError as e:            # the winner removed the pending images
+            outcomes.append(e)
+
+    threads = [threading.Thread(target=approve) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert _users(fresh_db) == [(1, "Ann")]
+    assert sum(1 for o in outcomes if isinstance(o, tuple) and o[0]) == 1
+
+
+def test_bulk_chunk_skips_rows_approved_meanwhile(fresh_db, pending, tmp_path):
+    processor, ann = pending
+    folder = tmp_path / "pending" / "bob"
+    folder.mkdir(parents=True)
+    (folder / "0.jpg").write_bytes(b"jpeg")
+    conn = fresh_db.db_conn()
+    cur = conn.execute("INSERT INTO pending_enrollments (name, temp_folder) VALUES ('Bob', ?)", (str(folder),))
+    conn.commit()
+    bob_row = conn.execute("SELECT id, name, temp_folder FROM pending_enrollments WHERE id=?",
+                           (cur.lastrowid,)).fetchone()
+    conn.close()
+    bob = (bob_row, [str(folder / "0.jpg")], ann[2])
+
+    processor._save_approvals([ann], "m:1")          # single approval wins Ann
+    Path(ann[1][0]).parent.mkdir(parents=True)
+    Path(ann[1][0]).write_bytes(b"jpeg")
+
+    saved, gone = processor._save_approvals([ann, bob], "m:1")
+    assert [r["name"] for r in saved] == ["Bob"] and gone == [ann[0]["id"]]
+    assert _users(fresh_db) == [(1, "Ann"), (2, "Bob")]
@@ -0,0 +1,90 @@
+# tests/test_quantization.py
+# ------------------------------------------------------
+# float16 / int8 template stores, and galleries held in them: quantized
+# scores only shortlist, the returned scores are the exact float32 ones.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+import pytest
+
+import services.embedding_service as embedding_service
+from conftest import add_user, unit_rows, MODEL_VERSION
+from services.quantization import STORES, encode, migrate
+from services.embedding_service import GalleryIndex
+
+
+@pytest.mark.parametrize("dtype, atol", [("float32", 0), ("float16", 1e-3), ("int8", 1e-2)])
+def test_blob_round_trip(dtype, atol):
+    mat = unit_rows(6, dim=32)
+    store = STORES[dtype].from_blobs([encode(v, dtype) for v in mat], 32)
+    np.testing.assert_allclose(np.asarray(store), mat, atol=atol)
+    np.testing.assert_allclose(store[[1, 4]], mat[[1, 4]], atol=atol)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_store_scores_close_to_float32(dtype):
+    mat = unit_rows(50, dim=64)
+    queries = unit_rows(3, dim=64, seed=1)
+    store = STORES[dtype].from_float32(mat)
+    assert not store.exact and store.nbytes < mat.nbytes
+
+    np.testing.assert_allclose(store @ queries[0], mat @ queries[0], atol=2e-2)
+    np.testing.assert_allclose(store @ queries.T, mat @ queries.T, atol=2e-2)
+
+    keep = np.arange(50) % 3 != 0
+    both = store.select(keep).concat(STORES[dtype].from_float32(mat[:2]))
+    np.testing.assert_allclose(np.asarray(both), np.vstack([mat[keep], mat[:2]]), atol=2e-2)
+
+
+def _galleries(gallery_db, monkeypatch, dtype, stored_dtype):
+    t = unit_rows(30, seed=5)
+    for uid in range(1, 16):
+        add_user(gallery_db, uid, f"user{uid}", t[2 * uid - 2:2 * uid], dtype=stored_dtype)
+
+    exact = GalleryIndex()
+    exact.load()
+    monkeypatch.setattr(embedding_service, "GALLERY_DTYPE", dtype)
+    quantized = GalleryIndex()
+    quantized.load()
+    return exact, quantized, t
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+@pytest.mark.parametrize("migrated", [True, False])
+def test_quantized_gallery_returns_exact_scores(gallery_db, monkeypatch, dtype, migrated):
+    exact, quantized, t = _galleries(gallery_db, monkeypatch, dtype, dtype if migrated else None)
+    assert quantized.arrays()[0].dtype == dtype
+
+    rng = np.random.default_rng(6)
+    for q in t[::3] + 0.05 * rng.standard_normal((10, 512)).astype(np.float32):
+        got = quantized.search(q, k=2, model_version=MODEL_VERSION)
+        want = exact.search(q, k=2, model_version=MODEL_VERSION)
+        assert [h["user_id"] for h in got] == [h["user_id"] for h in want]
+        np.testing.assert_allclose([h["score"] for h in got], [h["score"] for h in want], rtol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_score_users_rescores_top_users(gallery_db, monkeypatch, dtype):
+    exact, quantized, t = _galleries(gallery_db, monkeypatch, dtype, dtype)
+    queries = t[[0, 7, 20]]
+
+    ids, _, got = quantized.score_users(queries, model_version=MODEL_VERSION)
+    exact_ids, _, want = exact.score_users(queries, model_version=MODEL_VERSION)
+    assert ids.tolist() == exact_ids.tolist()
+    for q in range(len(queries)):
+        best = int(np.argmax(want[q]))
+        assert int(np.argmax(got[q])) == best
+        assert got[q, best] == pytest.approx(want[q, best], rel=1e-5)
+
+
+def test_migrate_fills_quantized_copies(gallery_db):
+    add_user(gallery_db, 1, "Ann", unit_rows(3))
+    assert migrate("int8") == 3
+    assert migrate("int8") == 0
+
+    conn = gallery_db.db_conn()
+    rows = conn.execute("SELECT embedding_q_dtype, LENGTH(embedding_q) FROM user_embeddings").fetchall()
+    conn.close()
+    assert [tuple(r) for r in rows] == [("int8", 4 + 512)] * 3
@@ -0,0 +1,88 @@
+# tests/test_recognition_session.py
+# ------------------------------------------------------
+# Multi-frame recognition sessions on a bare Flask app: state stays on
+# the server, the token is only a lookup key, and a decided session is
+# gone. Detection / embedding / gallery search are stubbed.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+import pytest
+from flask import Flask
+
+import api.user_api as user_api
+from services.recognition_session import FRAME_VOTES_REQUIRED, SESSION_MAX_FRAMES
+
+
+class _Embedder:
+    version = "m:1"
+
+
+@pytest.fixture
+def kiosk(monkeypatch):
+    scores = {"best": 0.85}
+    emb = np.ones(512, dtype=np.float32) / np.sqrt(512)
+
+    monkeypatch.setattr(user_api, "_frame_embedding", lambda data: (emb, _Embedder(), None, 200))
+    monkeypatch.setattr(user_api, "find_top_k_users", lambda e, k=2, model_version=None: [
+        {"user_id": 1, "name": "Ann", "score": scores["best"]},
+        {"user_id": 2, "name": "Bob", "score": 0.3},
+    ])
+    monkeypatch.setattr(user_api, "mark_attendance", lambda user_id, device: {"status": "marked"})
+
+    app = Flask(__name__)
+    app.register_blueprint(user_api.user_bp, url_prefix="/api")
+    return app.test_client(), scores
+
+
+def _open(client):
+    resp = client.post("/api/recognize/session", json={"device": "camera"})
+    assert resp.status_code == 201
+    return resp.get_json()["session_token"]
+
+
+def _frame(client, token):
+    return client.post("/api/recognize/session/frame", data=b"jpeg",
+                       headers={"Content-Type": "image/jpeg", "X-Session-Token": token})
+
+
+def test_votes_accept_and_close_the_session(kiosk):
+    client, _ = kiosk
+    token = _open(client)
+
+    for i in range(1, FRAME_VOTES_REQUIRED):
+        data = _frame(client, token).get_json()
+        assert data["status"] == "pending" and data["frames"] == i
+
+    data = _frame(client, token).get_json()
+    assert data["status"] == "accepted" and data["user_id"] == 1
+
+    # a decided session cannot be replayed
+    assert _frame(client, token).status_code == 404
+
+
+def test_resending_a_token_does_not_reset_the_session(kiosk):
+    client, scores = kiosk
+    scores["best"] = 0.5                    # never a match: frames only count up
+    token = _open(client)
+
+    frames = [_frame(client, token).get_json() for _ in range(SESSION_MAX_FRAMES)]
+    assert [f["frames"] for f in frames] == list(range(1, SESSION_MAX_FRAMES + 1))
+    assert frames[-1]["status"] == "rejected"
+    assert _frame(client, token).status_code == 404
+
+
+def test_unknown_token_is_404(kiosk):
+    client, _ = kiosk
+    assert _frame(client, "forged").status_code == 404
+    assert client.post("/api/recognize/session/frame", data=b"jpeg",
+                       headers={"Content-Type": "image/jpeg"}).status_code == 404
+
+
+def test_sessions_are_independent(kiosk):
+    client, _ = kiosk
+    a, b = _open(client), _open(client)
+    assert a != b
+    _frame(client, a)
+    assert _frame(client, b).get_json()["frames"] == 1
@@ -0,0 +1,153 @@
+# tests/test_scrfd_decode.py
+# ------------------------------------------------------
+# Parity of the vectorized SCRFD decoder with the original per-anchor
+# loop decoder, kept here as the reference. Runs on seeded random stride
+# outputs, so no ONNX model is needed.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+import pytest
+
+from ml.scrfd_detector import SCRFDDetector, nms_boxes
+
+STRIDES = [8, 16, 32]
+
+
+def reference_decode(scores_list, boxes_list, kps_list, input_size, w0, h0, conf_threshold):
+    """The original loop decoder (stretched input), one dict per proposal."""
+    proposals = []
+    for idx, stride in enumerate(STRIDES):
+        fm_w = input_size // stride
+        scores_flat = np.asarray(scores_list[idx]).reshape(-1)
+        bboxes_flat = np.asarray(boxes_list[idx]).reshape(-1, 4)
+        kpss_flat = np.asarray(kps_list[idx]).reshape(-1, 10)
+
+        for i in range(min(len(scores_flat), fm_w * fm_w)):
+            score = float(scores_flat[i])
+            if score < conf_threshold:
+                continue
+
+            cx = (i % fm_w + 0.5) * stride
+            cy = (i // fm_w + 0.5) * stride
+
+            bbox = bboxes_flat[i]
+            if np.max(np.abs(bbox)) > 1.01:
+                w = float(np.exp(bbox[2])) * stride
+                h = float(np.exp(bbox[3])) * stride
+                x1_model = cx + float(bbox[0]) * stride - w * 0.5
+                y1_model = cy + float(bbox[1]) * stride - h * 0.5
+            else:
+                x1_model = float(bbox[0]) * input_size
+                y1_model = float(bbox[1]) * input_size
+                w = float(bbox[2]) * input_size - x1_model
+                h = float(bbox[3]) * input_size - y1_model
+
+            sx = w0 / input_size
+            sy = h0 / input_size
+            x1 = int(max(0, min(w0 - 1, round(x1_model * sx))))
+            y1 = int(max(0, min(h0 - 1, round(y1_model * sy))))
+            x2 = min(w0 - 1, x1 + int(max(1, round(w * sx))))
+            y2 = min(h0 - 1, y1 + int(max(1, round(h * sy))))
+
+            kps_raw = kpss_flat[i]
+            kps_pts = []
+            if np.max(np.abs(kps_raw)) > 1.01:
+                fx, fy = sx, sy
+            else:
+                fx, fy = w0, h0
+            for j in range(0, 10, 2):
+                px = int(max(0, min(w0 - 1, round(float(kps_raw[j]) * fx))))
+                py = int(max(0, min(h0 - 1, round(float(kps_raw[j + 1]) * fy))))
+                kps_pts.append((px, py))
+
+            proposals.append({
+                "box": (x1, y1, x2 - x1, y2 - y1),
+                "score": score,
+                "kps": kps_pts,
+            })
+    return proposals
+
+
+def random_outputs(rng, input_size):
+    """Stride outputs mixing log-space and normalized boxes / landmarks."""
+    scores_list, boxes_list, kps_list = [], [], []
+    for stride in STRIDES:
+        n = (input_size // stride) ** 2
+        scores = rng.random((n, 1)) ** 3
+
+        log_boxes = np.concatenate([rng.uniform(-2, 2, (n, 2)), rng.uniform(1.1, 3.5, (n, 2))], axis=1)
+        xy1 = rng.uniform(-0.1, 0.8, (n, 2))
+        norm_boxes = np.concatenate([xy1, np.minimum(1.0, xy1 + rng.uniform(0.01, 0.3, (n, 2)))], axis=1)
+        boxes = np.where(rng.random((n, 1)) < 0.5, log_boxes, norm_boxes)
+
+        model_kps = rng.uniform(-20, input_size + 20, (n, 10))
+        norm_kps = rng.uniform(0, 1, (n, 10))
+        kps = np.where(rng.random((n, 1)) < 0.5, model_kps, norm_kps)
+
+        scores_list.append(scores.astype(np.float32))
+        boxes_list.append(boxes.astype(np.float32))
+        kps_list.append(kps.astype(np.float32))
+    return scores_list, boxes_list, kps_list
+
+
+def make_detector(input_size):
+    # skip __init__: the decoder only needs the geometry, not the model
+    det = object.__new__(SCRFDDetector)
+    det.input_size = input_size
+    det.strides = list(STRIDES)
+    det._anchor_cache = {}
+    return det
+
+
+def as_dicts(boxes, scores, kpss):
+    return [
+        {
+            "box": (int(b[0]), int(b[1]), int(b[2] - b[0]), int(b[3] - b[1])),
+            "score": float(s),
+            "kps": [(int(x), int(y)) for x, y in k],
+        }
+        for b, s, k in zip(boxes, scores, kpss)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("input_size, w0, h0", [(640, 1280, 720), (640, 480, 640), (320, 800, 600)])
+def test_decode_matches_reference(seed, input_size, w0, h0):
+    rng = np.random.default_rng(seed)
+    outputs = random_outputs(rng, input_size)
+    det = make_detector(input_size)
+
+    ratio = (w0 / input_size, h0 / input_size)
+    got = as_dicts(*det._decode(*outputs, w0, h0, ratio, (w0, h0), 0.45))
+    expected = reference_decode(*outputs, input_size, w0, h0, 0.45)
+
+    assert len(expected) > 0
+    assert got == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_postprocess_keeps_reference_boxes(seed):
+    rng = np.random.default_rng(seed)
+    input_size, w0, h0 = 640, 1280, 720
+    scores_list, boxes_list, kps_list = random_outputs(rng, input_size)
+    det = make_detector(input_size)
+
+    ratio = (w0 / input_size, h0 / input_size)
+    raw = scores_list + boxes_list + kps_list
+    got = det._postprocess(raw, w0, h0, ratio, (w0, h0), 0.45, 0.4)
+
+    proposals = reference_decode(scores_list, boxes_list, kps_list, input_size, w0, h0, 0.45)
+    kept = nms_boxes([(p["box"][0], p["box"][1], p["box"][0] + p["box"][2], p["box"][1] + p["box"][3],
+                       p["score"]) for p in proposals], iou_thresh=0.4)
+
+    assert [(r["box"], r["score"]) for r in got] == \
+        [((x1, y1, x2 - x1, y2 - y1), s) for x1, y1, x2, y2, s in kept]
+
+
+def test_decode_nothing_above_threshold():
+    det = make_detector(640)
+    outputs = random_outputs(np.random.default_rng(0), 640)
+    boxes, scores, kpss = det._decode(*outputs, 640, 480, (1.0, 0.75), (640, 480), 1.5)
+    assert boxes.shape == (0, 4) and scores.shape == (0,) and kpss.shape == (0, 5, 2)
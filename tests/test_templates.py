@@ -0,0 +1,35 @@
+# tests/test_templates.py
+# ------------------------------------------------------
+# Per-user templates: the quality gate and the k-means reduction that
+# every enrollment / re-embed goes through (templates_from_embeddings).
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+
+from ml.embeddings import MIN_VALID_FACES, templates_from_embeddings
+
+
+def _unit_rows(n, seed=0):
+    rows = np.random.default_rng(seed).standard_normal((n, 512)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def test_too_few_faces_is_rejected():
+    assert templates_from_embeddings(_unit_rows(MIN_VALID_FACES - 1)) is None
+    assert templates_from_embeddings(np.zeros((0, 0), dtype=np.float32)) is None
+
+
+def test_small_enrollments_keep_every_embedding():
+    embs = _unit_rows(5)
+    templates = templates_from_embeddings(embs, max_templates=8)
+    assert templates.dtype == np.float32
+    np.testing.assert_array_equal(templates, embs)
+
+
+def test_large_enrollments_reduce_to_unit_centroids():
+    embs = _unit_rows(30)
+    templates = templates_from_embeddings(embs, max_templates=4)
+    assert templates.shape == (4, 512) and templates.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(templates, axis=1), 1.0, atol=1e-4)
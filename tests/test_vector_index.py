@@ -0,0 +1,90 @@
+# tests/test_vector_index.py
+# ------------------------------------------------------
+# Exact / IVF gallery backends: IVF with every list probed equals the
+# exact search, and incremental gallery updates keep the list
+# assignments a full rebuild would give.
+#
+#   python -m pytest -q tests/
+# ------------------------------------------------------
+
+import numpy as np
+import pytest
+
+import services.vector_index as vi
+from conftest import add_user, unit_rows
+from services.embedding_service import GalleryIndex, _segment_starts
+
+
+@pytest.fixture
+def ivf(tmp_path, monkeypatch):
+    monkeypatch.setattr(vi, "INDEX_KIND", "ivf")
+    monkeypatch.setattr(vi, "IVF_MIN_TEMPLATES", 0)
+    monkeypatch.setattr(vi, "INDEX_DIR", tmp_path / "index")
+    return vi
+
+
+def _gallery_arrays(n_users, per_user=2, seed=0):
+    ids = np.repeat(np.arange(1, n_users + 1), per_user).astype(np.int64)
+    matrix = unit_rows(len(ids), dim=64, seed=seed)
+    return matrix, ids, _segment_starts(ids)
+
+
+def test_exact_top_k_is_best_template_per_user():
+    matrix, ids, starts = _gallery_arrays(10)
+    index = vi.ExactIndex(matrix, ids, starts)
+    rows, scores = index.top_k(matrix[5], 3)
+
+    assert ids[rows[0]] == ids[5] and scores[0] == pytest.approx(1.0, abs=1e-5)
+    per_user = np.maximum.reduceat(matrix @ matrix[5], starts)
+    np.testing.assert_allclose(scores, np.sort(per_user)[::-1][:3], rtol=1e-6)
+
+
+def test_ivf_probing_every_list_equals_exact(ivf):
+    matrix, ids, starts = _gallery_arrays(60)
+    index = ivf.build_index(matrix, ids, starts)
+    assert index.kind == "ivf"
+    exact = vi.ExactIndex(matrix, ids, starts)
+
+    for q in unit_rows(20, dim=64, seed=1):
+        rows, scores = index.top_k(q, 5, nprobe=len(index.centroids))
+        exact_rows, exact_scores = exact.top_k(q, 5)
+        assert ids[rows].tolist() == ids[exact_rows].tolist()
+        np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+
+def test_incremental_assign_matches_full_assign(ivf):
+    matrix, ids, starts = _gallery_arrays(60)
+    previous = ivf.build_index(matrix, ids, starts)
+
+    # users 3 and 7 change: kept rows first, then their new rows
+    keep = ~np.isin(ids, [3, 7])
+    new = unit_rows(4, dim=64, seed=2)
+    matrix2 = np.concatenate([matrix[keep], new])
+    ids2 = np.concatenate([ids[keep], [3, 3, 7, 7]])
+    starts2 = _segment_starts(ids2)
+
+    index = ivf.build_index(matrix2, ids2, starts2, previous=previous, kept=keep)
+    np.testing.assert_array_equal(index.assign[:keep.sum()], previous.assign[keep])
+    np.testing.assert_array_equal(index.assign, vi._assign(matrix2, previous.centroids))
+
+
+def test_gallery_update_keeps_ivf_consistent(gallery_db, ivf):
+    t = unit_rows(40, seed=3)
+    for uid in range(1, 21):
+        add_user(gallery_db, uid, f"user{uid}", t[2 * uid - 2:2 * uid])
+    gallery = GalleryIndex()
+    gallery.load()
+    assert gallery.index_kind == "ivf"
+
+    add_user(gallery_db, 21, "new", unit_rows(2, seed=4))
+    conn = gallery_db.db_conn()
+    conn.execute("DELETE FROM user_embeddings WHERE user_id=5")
+    conn.commit()
+    conn.close()
+    gallery.sync()
+
+    index = gallery._state[4]
+    matrix = np.asarray(gallery.arrays()[0])
+    np.testing.assert_array_equal(index.assign, vi._assign(matrix, index.centroids))
+    assert 5 not in gallery.arrays()[1]
+    assert gallery.search(unit_rows(2, seed=4)[0], k=1)[0]["user_id"] == 21
@@ -1,22 +1,91 @@
 # utils/encoding.py
-# Base64 helpers for incoming images (used by enroll & recognize endpoints).
+# Image decoding helpers for incoming images (used by enroll & recognize endpoints).
+# Accepts base64 / data URLs (JSON clients) and raw encoded bytes (binary uploads).
 
 
 import base64
 import numpy as np
 import cv2
 
-def b64_to_cv2(img_b64: str):
+def b64_to_bytes(img_b64: str):
     """
-    Accepts dataurl or raw base64. Returns BGR cv2 image or None.
+    Accepts dataurl or raw base64. Returns decoded bytes or None.
     """
     if not img_b64:
         return None
     header, body = (img_b64.split(",", 1) + [""])[:2]
     try:
-        data = base64.b64decode(body or header)
+        return base64.b64decode(body or header)
     except Exception:
         return None
+
+def bytes_to_cv2(data):
+    """
+    Decodes encoded image bytes (JPEG/PNG/...) without copying them.
+    Returns BGR cv2 image or None.
+    """
+    if not data:
+        return None
     nparr = np.frombuffer(data, dtype=np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return img
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+# JPEG start-of-frame markers (baseline, progressive, ...) carry the size
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_REDUCED_FLAGS = {4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2}
+
+def jpeg_size(data):
+    """
+    Reads (width, height) from the JPEG header without decoding.
+    Returns None for non-JPEG or truncated data.
+    """
+    if not data or data[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:          # fill byte
+            i += 1
+            continue
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = int.from_bytes(data[i + 2:i + 4], "big")
+        if marker in _SOF_MARKERS:
+            h = int.from_bytes(data[i + 5:i + 7], "big")
+            w = int.from_bytes(data[i + 7:i + 9], "big")
+            return (w, h) if w and h else None
+        i += 2 + length
+    return None
+
+def bytes_to_cv2_reduced(data, target_side: int):
+    """
+    Decodes at 1/2 or 1/4 resolution (libjpeg DCT scaling, much cheaper
+    than a full decode + resize) when the JPEG's long side is still at
+    least target_side after reduction.
+
+    Returns (BGR image or None, factor) where factor maps coordinates in
+    the returned image back to the full-resolution image (1.0 = full).
+    """
+    if not data:
+        return None, 1.0
+    size = jpeg_size(data)
+    if size:
+        long_side = max(size)
+        for f in (4, 2):
+            if long_side // f >= target_side:
+                nparr = np.frombuffer(data, dtype=np.uint8)
+                img = cv2.imdecode(nparr, _REDUCED_FLAGS[f])
+                if img is None:
+                    return None, 1.0
+                # max/max stays right when EXIF orientation rotated the image
+                return img, long_side / max(img.shape[:2])
+    return bytes_to_cv2(data), 1.0
+
+def b64_to_cv2(img_b64: str):
+    """
+    Accepts dataurl or raw base64. Returns BGR cv2 image or None.
+    """
+    return bytes_to_cv2(b64_to_bytes(img_b64))
@@ -21,3 +21,17 @@ def remove_dir(path):
     p = Path(path)
     if p.exists() and p.is_dir():
         shutil.rmtree(path, ignore_errors=True)
+
+# Never delete a folder immediately after file I/O + ML inference on
+# Windows: files can still be locked for a moment, so retry.
+def safe_rmtree(path, retries=5, delay=0.5):
+    import time
+    path = Path(path)
+    for i in range(retries):
+        try:
+            if path.exists():
+                shutil.rmtree(path)
+            return True
+        except Exception:
+            time.sleep(delay)
+    return False
@@ -0,0 +1,57 @@
+# utils/ttl_cache.py
+# Small thread-safe LRU cache whose entries expire after ttl seconds.
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    At most maxsize entries (least recently used evicted first); an entry
+    not touched for ttl seconds is gone. get() refreshes an entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()      # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        # entries are in last-touched order, so expired ones are at the front
+        while self._data:
+            key, (expires, _) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[key]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            item = self._data.get(key)
+            if item is None:
+                return default
+            self._data[key] = (now + self.ttl, item[1])
+            self._data.move_to_end(key)
+            return item[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def __len__(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return len(self._data)